@@ -0,0 +1,1123 @@
+import argparse
+import asyncio
+import collections
+import base64
+import csv
+import functools
+import contextlib
+import io
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+import numpy as np
+import data_utils
+from dataset import DataEntry
+import storage
+from image_index import ImageIndex
+from fakes import FakeBleakBackend, FakePicamera2, MockBleakClient
+
+DIR_PATH = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_CSV = os.path.join(DIR_PATH, 'data.csv')
+
+def timed(func, repeat=3):
+    '''
+    Run func `repeat` times and return (best wall time in seconds, result of the last run)
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def report(name, seconds, count, unit='rows'):
+    print(f'{name:<40} {seconds * 1000:10.2f} ms {count / seconds:14.0f} {unit}/s')
+
+def bench_reader(args):
+    '''
+    Compare parsing data.csv with csv.DictReader + roundData against the columnar readColumns
+    '''
+    def dict_reader():
+        count = 0
+        with open(args.csv, 'r', encoding='utf-8') as csv_file:
+            for row in csv.DictReader(csv_file):
+                [data_utils.roundData(row[x], 2) for x in data_utils.COLUMNS_OF_INTEREST if row[x] != '']
+                float(row['ev'])
+                count += 1
+        return count
+
+    def column_reader():
+        return sum(len(chunk['timestamp']) for chunk in data_utils.readColumns(args.csv))
+
+    seconds, count = timed(dict_reader, args.repeat)
+    report('DictReader + roundData', seconds, count)
+    seconds, count = timed(column_reader, args.repeat)
+    report('readColumns', seconds, count)
+
+def bench_timestamps(args):
+    '''
+    Compare converting the timestamp column of data.csv, repeated by each of the factors, to epoch seconds with
+    datetime.strptime per row, with the cached toEpoch and with the vectorized parseTimestamps
+    '''
+    from datetime import datetime
+    column = np.concatenate([chunk['timestamp'] for chunk in data_utils.readColumns(args.csv)])
+    for factor in args.factors:
+        timestamps = np.tile(column, factor)
+        values = timestamps.tolist()
+
+        def strptime():
+            return [int(datetime.strptime(value.replace('_base', ''), data_utils.TIMESTAMP_FORMAT).timestamp())
+                    for value in values]
+
+        def cached():
+            data_utils.toEpoch.cache_clear()
+            return [data_utils.toEpoch(value) for value in values]
+
+        seconds, expected = timed(strptime, args.repeat)
+        report(f'x{factor} strptime per row', seconds, len(values))
+        seconds, result = timed(cached, args.repeat)
+        assert result == expected
+        report(f'x{factor} cached toEpoch ({len(set(values))} distinct)', seconds, len(values))
+        for name, array in [('str', timestamps), ('bytes', timestamps.astype('S24'))]:
+            seconds, result = timed(lambda: data_utils.parseTimestamps(array), args.repeat)
+            assert result.tolist() == expected
+            report(f'x{factor} parseTimestamps ({name})', seconds, len(values))
+
+def scaled_copies(csv_path, directory, factors, header=True):
+    '''
+    Write copies of csv_path with its rows repeated by each of the given factors into directory
+    '''
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        header = f.readline() if header else ''
+        rows = f.read()
+    paths = []
+    for factor in factors:
+        path = os.path.join(directory, f'data_x{factor}.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(header)
+            for _ in range(factor):
+                f.write(rows)
+        paths.append(path)
+    return paths
+
+def bench_tail(args):
+    '''
+    Compare the latency of looking up the last row by parsing the whole file against readLastRow
+    as data.csv grows
+    '''
+    def full_parse(path):
+        with open(path, 'r', encoding='utf-8') as csv_file:
+            return list(csv.DictReader(csv_file))[-1]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for factor, path in zip(args.factors, scaled_copies(args.csv, directory, args.factors)):
+            size = os.path.getsize(path) / 1e6
+            seconds, _ = timed(lambda: full_parse(path), args.repeat)
+            print(f'{size:8.1f} MB  list(DictReader)[-1] {seconds * 1000:10.3f} ms')
+            seconds, _ = timed(lambda: data_utils.getLastRowReadable(path), args.repeat)
+            print(f'{size:8.1f} MB  getLastRowReadable   {seconds * 1000:10.3f} ms')
+
+def bench_writer(args):
+    '''
+    Compare writing data.csv one row at a time with write_to_csv against the batched append/flush
+    writer, with one batch per capture cycle of `frames` rows
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        entry = DataEntry(data_file=os.path.join(directory, 'data.csv'))
+        rows = args.cycles * args.frames
+
+        def per_row(fsync):
+            fsync_count = 0
+            for _ in range(rows):
+                entry.write_to_csv()
+                if fsync:
+                    with open(entry.data_file, 'a') as f:
+                        os.fsync(f.fileno())
+                    fsync_count += 1
+            return fsync_count
+
+        def batched():
+            start = entry.fsync_count
+            for _ in range(args.cycles):
+                for _ in range(args.frames):
+                    entry.append()
+                entry.flush()
+            return entry.fsync_count - start
+
+        seconds, fsyncs = timed(lambda: per_row(False), args.repeat)
+        report(f'write_to_csv ({fsyncs} fsyncs)', seconds, rows)
+        seconds, fsyncs = timed(lambda: per_row(True), args.repeat)
+        report(f'write_to_csv + fsync ({fsyncs} fsyncs)', seconds, rows)
+        seconds, fsyncs = timed(batched, args.repeat)
+        report(f'append/flush ({fsyncs} fsyncs)', seconds, rows)
+        entry.close()
+
+    # The CSV file and the column store are written through open handles and synced together once per batch
+    with tempfile.TemporaryDirectory() as directory:
+        entry = DataEntry(data_file=os.path.join(directory, 'data.csv'), log_level='ERROR',
+                          column_store=storage.ColumnStore(os.path.join(directory, 'columns')))
+        seconds, fsyncs = timed(batched, args.repeat)
+        report(f'append/flush + column store ({fsyncs} batches)', seconds, rows)
+        entry.close()
+
+    # A batch that fails partway, here at the fsync of data.csv or of a column, is written again whole by the
+    # next flush, without duplicating the rows of it that reached the files
+    expected = [f'{i:02d}.jpg' for i in range(2 * args.frames)]
+    for failing_fsync in [1, 2]:
+        with tempfile.TemporaryDirectory() as directory:
+            entry = DataEntry(data_file=os.path.join(directory, 'data.csv'), log_level='ERROR',
+                              column_store=storage.ColumnStore(os.path.join(directory, 'columns')))
+            for i in range(2 * args.frames):
+                entry.data['image'] = expected[i]
+                entry.append()
+                if i == args.frames - 1:
+                    entry.flush()
+            fsync, calls = os.fsync, []
+            def failing(fd):
+                calls.append(fd)
+                if len(calls) == failing_fsync:
+                    raise OSError('Simulated write failure')
+                fsync(fd)
+            os.fsync = failing
+            try:
+                entry.flush()
+            except OSError:
+                pass
+            finally:
+                os.fsync = fsync
+            entry.close()
+            with open(entry.data_file, newline='') as f:
+                images = [row[1] for row in csv.reader(f)]
+            stored = [image.decode() for image in storage.ColumnStore(os.path.join(directory, 'columns')).read('image')]
+        assert images == expected and stored == expected, f'rows lost or duplicated: {images}, {stored}'
+    print(f'failed flushes retried without duplicates: {len(images)} rows in data.csv and the column store')
+
+def bench_storage(args):
+    '''
+    Compare reading the plaintext columns and a vector field from data.csv against a column store
+    converted from it
+    '''
+    with tempfile.TemporaryDirectory() as store_dir:
+        seconds, count = timed(lambda: storage.convertCSV(args.csv, store_dir), 1)
+        report('convertCSV', seconds, count)
+
+        def from_csv():
+            return sum(len(chunk['timestamp']) for chunk in data_utils.readColumns(args.csv))
+
+        def from_store():
+            return sum(len(chunk['timestamp']) for chunk in data_utils.readColumns(store_dir))
+
+        def quat_from_csv():
+            with open(args.csv, 'r', encoding='utf-8', newline='') as csv_file:
+                return len([storage.parseCell(row['quat']) for row in csv.DictReader(csv_file)])
+
+        def quat_from_store():
+            return len(np.array(storage.ColumnStore(store_dir).read('quat')))
+
+        seconds, count = timed(from_csv, args.repeat)
+        report('readColumns data.csv', seconds, count)
+        seconds, count = timed(from_store, args.repeat)
+        report('readColumns column store', seconds, count)
+        seconds, count = timed(quat_from_csv, args.repeat)
+        report('quat from data.csv', seconds, count)
+        seconds, count = timed(quat_from_store, args.repeat)
+        report('quat from column store', seconds, count)
+
+    # Rows written by DataEntry to both outputs convert to the same plaintext, integers in float columns included
+    with tempfile.TemporaryDirectory() as directory:
+        entry = DataEntry(data_file=os.path.join(directory, 'rows.csv'), log_level='ERROR',
+                          column_store=storage.ColumnStore(os.path.join(directory, 'columns')))
+        entry.data.update(amb=120, r=40, g=50, b=30, humidity=59, gas=22357, co2=822, Lux=12.5, ev=0.0)
+        for i, (temp, pressure) in enumerate([(0, 0), (34.5, 1007.61), (35.0, 1007), (35, 1007.0)]):
+            entry.data.update(timestamp=1736584978 + i, image=f'{i:02d}.jpg', temp=temp, pressure=pressure)
+            entry.append()
+        entry.close()
+        csv_path = os.path.join(directory, 'data.csv')
+        with open(csv_path, 'w', newline='') as f:
+            f.write(','.join(entry.data) + '\r\n')
+            with open(entry.data_file, newline='') as rows:
+                f.write(rows.read())
+        texts = []
+        for source in [csv_path, os.path.join(directory, 'columns')]:
+            text_path = os.path.join(directory, 'plaintext.csv')
+            with contextlib.redirect_stdout(io.StringIO()):
+                data_utils.convertToPlaintextWithAugmentation(source, text_path, num_permutations=2, seed=0)
+            with open(text_path) as f:
+                texts.append(f.read())
+    assert texts[0] == texts[1], f'plaintext differs between data.csv and the column store:\n{texts[0]}\n{texts[1]}'
+    print(f'identical plaintext from data.csv and the column store: {len(texts[0].splitlines())} lines')
+
+def baseline_augmentation(csv_path, text_path, neutral_only=True, night_prob=0.9, incomplete_prob=0.1,
+                          num_permutations=10):
+    '''
+    convertToPlaintextWithAugmentation as it was before the vectorized engine, with csv.DictReader, roundData
+    and the random module per row, kept verbatim as the baseline of bench_augmentation
+    '''
+    PROPER_NAMES, COLUMNS_OF_INTEREST, roundData = data_utils.PROPER_NAMES, data_utils.COLUMNS_OF_INTEREST, data_utils.roundData
+    total_count = 0
+    night_count = 0
+    incomplete_count = 0
+    with open(csv_path, 'r', encoding='utf-8') as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+        curr_image_grp = 0
+        with open(text_path, 'w', encoding='utf-8') as text_file:
+            for row in csv_reader:
+
+                if "base" in row['timestamp']:
+                    curr_image_grp += 1
+
+                if row['ev'] == None: 
+                    print(row['image'])
+                    assert False
+
+                if neutral_only and float(row['ev']) != 0.0: continue # Skip rows with no data
+
+                filtered = [f'{PROPER_NAMES[x]}:{roundData(row[x], 2)}' for x in COLUMNS_OF_INTEREST if row[x] != '']
+
+                # Choose num_permutations many random permutations of the data
+                permutations = [filtered] + [random.sample(filtered, len(filtered)) for _ in range(num_permutations-1)]
+
+                for perm in permutations:
+                    if float(row['Lux']) < 100:
+                        # choose a night image only `night_prob` of the time
+                        if random.random() > night_prob: continue
+                        night_count += 1
+
+                    if len(filtered) < len(COLUMNS_OF_INTEREST):
+                        # drop an incomplete data entry only `incomplete_prob` of the time
+                        if random.random() > incomplete_prob: continue
+                        incomplete_count += 1
+
+                    text_file.write(f"{curr_image_grp}>{row['image']}>{','.join(perm)}\n")
+                    total_count += 1
+    print(f'Percentage of incomplete entries: {incomplete_count/total_count}')
+    print(f'Percentage of night images: {night_count/total_count}')
+
+def bench_augmentation(args):
+    '''
+    Compare the baseline per-row augmentation of data.csv against the vectorized convertToPlaintextWithAugmentation,
+    reading from data.csv and from a column store, at 10 permutations
+    '''
+    def baseline(csv_path, text_path):
+        with contextlib.redirect_stdout(io.StringIO()):
+            baseline_augmentation(csv_path, text_path)
+
+    def vectorized(csv_path, text_path):
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_utils.convertToPlaintextWithAugmentation(csv_path, text_path, num_permutations=10, seed=0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        text_path = os.path.join(directory, 'plaintext_data.csv')
+        store_dir = os.path.join(directory, 'columns')
+        storage.convertCSV(args.csv, store_dir)
+        base_seconds, _ = timed(lambda: baseline(args.csv, text_path), args.repeat)
+        report('baseline augmentation, data.csv', base_seconds, sum(1 for _ in open(text_path)), 'lines')
+        for name, csv_path in [('data.csv', args.csv), ('column store', store_dir)]:
+            seconds, count = timed(lambda: sum(1 for _ in data_utils.readColumns(csv_path)), args.repeat)
+            print(f'{"reading " + name + " alone":<40} {seconds * 1000:10.2f} ms')
+            seconds, _ = timed(lambda: vectorized(csv_path, text_path), args.repeat)
+            report(f'vectorized augmentation, {name}', seconds, sum(1 for _ in open(text_path)), 'lines')
+            print(f'{"speedup over the baseline":<40} {base_seconds / seconds:10.1f}x')
+
+def bench_parallel(args):
+    '''
+    Scaling of the sharded convertToPlaintextWithAugmentation with the number of worker processes
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = scaled_copies(args.csv, directory, [args.factors[-1]])[0]
+        text_path = os.path.join(directory, 'plaintext_data.csv')
+        for workers in args.workers:
+            def convert():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    data_utils.convertToPlaintextWithAugmentation(csv_path, text_path, seed=0, workers=workers)
+            seconds, _ = timed(convert, args.repeat)
+            report(f'{workers} workers (x{args.factors[-1]} data.csv)', seconds, sum(1 for _ in open(text_path)), 'lines')
+
+def bench_groups(args):
+    '''
+    Time and peak memory of extracImageGroup as the plaintext file grows
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        text_path = os.path.join(directory, 'plaintext_data.csv')
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_utils.convertToPlaintextWithAugmentation(args.csv, text_path, seed=0)
+        for factor, path in zip(args.factors, scaled_copies(text_path, directory, args.factors, header=False)):
+            def extract():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    data_utils.extracImageGroup(path, directory, num=1000, mode='base')
+            seconds, _ = timed(extract, args.repeat)
+            tracemalloc.start()
+            extract()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            lines = sum(1 for _ in open(path))
+            print(f'x{factor:<4} {lines:9d} lines {seconds * 1000:10.2f} ms  peak {peak / 1e6:8.2f} MB')
+
+def bench_index(args):
+    '''
+    Compare fetching the lines of one image group by scanning the plaintext file against getImageGroup
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        text_path = os.path.join(directory, 'plaintext_data.csv')
+        csv_path = scaled_copies(args.csv, directory, [args.factors[-1]])[0]
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_utils.convertToPlaintextWithAugmentation(csv_path, text_path, seed=0)
+        group = next(iter(data_utils.readPlaintextIndex(text_path)))
+
+        def scan():
+            with open(text_path, 'r', encoding='utf-8') as text_file:
+                return [line for line in text_file if line.split('>', 1)[0] == group]
+
+        seconds, lines = timed(scan, args.repeat)
+        print(f'{"scan for group " + group:<40} {seconds * 1000:10.3f} ms {len(lines):8d} lines')
+        seconds, lines = timed(lambda: data_utils.getImageGroup(group, text_path), args.repeat)
+        print(f'{"getImageGroup " + group:<40} {seconds * 1000:10.3f} ms {len(lines):8d} lines')
+
+def jpeg_payload(width, height, seed):
+    '''
+    Build an IMG message as sent by the ESP32CAM: 14 digit timestamp, camera id, aec level, agc gain and a base64 JPEG
+    '''
+    from PIL import Image
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    stream = io.BytesIO()
+    Image.fromarray(pixels).save(stream, format='JPEG', quality=80)
+    header = f'{20250101000000 + seed:14d}01{seed % 1000:05d}{seed % 100:03d}'
+    return b'IMG' + header.encode() + base64.b64encode(stream.getvalue())
+
+def bench_mqtt_image(args):
+    '''
+    Compare the wall time and CPU time per IMG message of re-encoding the JPEG with PIL against writing it as received
+    '''
+    from mqtt_sub import MQTTSubscriber
+    for width, height in [(320, 240), (800, 600), (1600, 1200)]:
+        messages = [SimpleNamespace(payload=jpeg_payload(width, height, seed)) for seed in range(args.cycles // 10)]
+        for reencode in [True, False]:
+            with tempfile.TemporaryDirectory() as directory:
+                subscriber = MQTTSubscriber(image_dir=directory, log_level='WARNING', reencode_images=reencode)
+                subscriber.image_index = ImageIndex(directory)
+                wall, cpu = time.perf_counter(), time.process_time()
+                for message in messages:
+                    subscriber.on_message(None, None, message)
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            name = f'{"re-encode" if reencode else "write as received"} {width}x{height}'
+            print(f'{name:<40} {wall / len(messages) * 1000:10.3f} ms {cpu / len(messages) * 1000:10.3f} ms CPU per message')
+
+def bench_mqtt_ingest(args):
+    '''
+    Stress the MQTT ingest pool with an in-process fake broker delivering bursts of IMG messages from 4 cameras
+    interleaved with SNR messages on one network thread, reporting how long the network thread is held up per
+    message, drops and the receive-to-saved latency. Every image is counted as processed or dropped as the drop
+    policy demands, and every camera's buffer ends up holding its newest saved image however the workers finish
+    '''
+    from mqtt_sub import MQTTSubscriber, DeviceState
+    bodies = [jpeg_payload(1600, 1200, seed)[3 + 24:] for seed in range(8)]
+    sensor = SimpleNamespace(topic='sensor/node', payload=b'SNRamb:10,r:1,g:2,b:3')
+    messages = []
+    for i in range(args.cycles):
+        # A burst of images from 4 cameras then a sensor reading, as the broker would deliver them, every image
+        # with its own timestamp so that its file tells which images were saved
+        header = f'{data_utils.formatEpoch(1735689600 + i)}{i % 4:02d}00100020'
+        messages.append(sensor if i % 5 == 4 else SimpleNamespace(payload=b'IMG' + header.encode() + bodies[i % len(bodies)]))
+    images = [bytes(message.payload[3:17]).decode() for message in messages if message is not sensor]
+    configs = [
+        ('inline', dict(num_workers=0)),
+        ('2 threads, drop_oldest', dict(num_workers=2, queue_size=8)),
+        ('2 threads, drop_newest', dict(num_workers=2, queue_size=8, drop_policy='drop_newest')),
+        ('2 threads, block', dict(num_workers=2, queue_size=8, drop_policy='block', block_timeout=30)),
+        ('2 threads + 2 decode processes', dict(num_workers=2, queue_size=8, decode_processes=2)),
+    ]
+    # Paced at about 100 images/s, then all at once to overflow the queue and make the drop policies act
+    for (name, config), (pace, interval) in [(config, pace) for pace in [('paced', 0.008), ('burst', 0)] for config in configs]:
+        with tempfile.TemporaryDirectory() as directory:
+            subscriber = MQTTSubscriber(image_dir=directory, log_level='ERROR', **config)
+            subscriber.image_index = ImageIndex(directory)
+            subscriber.start_workers()
+            stalls = []
+            start = time.perf_counter()
+            for i, message in enumerate(messages):
+                time.sleep(max(0, start + i * interval - time.perf_counter()))
+                received = time.perf_counter()
+                subscriber.on_message(None, None, message)
+                stalls.append(time.perf_counter() - received)
+            delivered = time.perf_counter() - start
+            subscriber.stop_workers()
+            total = time.perf_counter() - start
+            metrics = subscriber.metrics()
+            saved = sorted(image for image in os.listdir(directory) if image.endswith('.jpg'))
+            buffered = {device_id: device.data['image'] for device_id, device in subscriber.devices.items() if device_id != 'node'}
+
+        assert metrics['received'] == len(images) and metrics['failed'] == 0, metrics
+        assert metrics['processed'] == len(saved) and metrics['processed'] + metrics['dropped'] == len(images), \
+            f'{name}: {len(images)} images received, {metrics["processed"]} processed, {metrics["dropped"]} dropped'
+        if config.get('drop_policy') == 'block' or not config['num_workers']:
+            assert metrics['dropped'] == 0, f'{name}: {metrics["dropped"]} images dropped'
+        elif pace == 'burst':
+            # drop_oldest keeps the latest images, drop_newest the earliest ones
+            kept = images[-1] if config.get('drop_policy', 'drop_oldest') == 'drop_oldest' else images[0]
+            assert metrics['dropped'] > 0 and any(image.endswith(f'_{kept}.jpg') for image in saved), \
+                f'{name}: {metrics["dropped"]} images dropped, image {kept} among them'
+        newest = {image[:2]: image for image in saved} # Saved files are sorted by camera, then time
+        assert buffered == newest, f'{name}: buffered images {buffered}, newest saved images {newest}'
+
+        stalls = np.array(stalls) * 1000
+        print(f'{pace:<5} {name:<30} network thread p50 {np.percentile(stalls, 50):7.3f} ms max {stalls.max():8.3f} ms | '
+              f'delivered in {delivered:6.2f} s, drained in {total:6.2f} s | '
+              f'processed {metrics["processed"]:4d} dropped {metrics["dropped"]:4d} max depth {metrics["max_queue_depth"]:2d} | '
+              f'latency p95 {metrics["latency_p95"] * 1000:8.1f} ms')
+
+    # Updates of one device racing from many threads in shuffled order leave the newest timestamp buffered
+    device = DeviceState('01')
+    timestamps = list(range(10000))
+    random.Random(0).shuffle(timestamps)
+    threads = [threading.Thread(target=lambda part: [device.update({'image': t}, t, t) for t in part], args=(timestamps[k::8],))
+               for k in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert device.data['timestamp'] == device.data['image'] == max(timestamps), device.data
+    print(f'{len(timestamps)} racing updates from {len(threads)} threads left the newest reading buffered')
+
+def bench_mqtt_nodes(args):
+    '''
+    Load test of the per-device buffers: an in-process fake broker delivers 1 Hz messages from half as many cameras
+    as sensor nodes while the capture loop merges them every 100 ms, reporting the network thread time per message
+    and the time to merge all devices into a data entry. The merged entry must hold the latest readings of every
+    device in its own columns, and merging while devices are still being added must not fail
+    '''
+    from mqtt_sub import MQTTSubscriber
+    seconds = 5
+    for nodes in [10, 50, 200]:
+        cameras = nodes // 3
+        with tempfile.TemporaryDirectory() as directory:
+            camera_ids = [f'{node:02d}' for node in range(cameras)]
+            node_ids = [f'node{node}' for node in range(cameras, nodes)]
+            subscriber = MQTTSubscriber(image_dir=directory, log_level='ERROR', metrics_interval=0,
+                                        cameras=camera_ids, sensor_nodes=node_ids)
+            subscriber.image_index = ImageIndex(directory)
+            subscriber.start_workers()
+            jpeg = jpeg_payload(320, 240, 0)[3 + 24:] # Header filled in per camera and second
+            messages = []
+            for t in range(seconds):
+                for node in range(nodes):
+                    if node < cameras:
+                        payload = b'IMG' + f'{20250101000000 + t:14d}{node:02d}00100020'.encode() + jpeg
+                        messages.append((t + node / nodes, SimpleNamespace(topic=f'sensor/cam{node}', payload=payload)))
+                    else:
+                        payload = f'SNRamb:{t},r:{node},g:{node},b:{node}'.encode()
+                        messages.append((t + node / nodes, SimpleNamespace(topic=f'sensor/node{node}', payload=payload)))
+
+            def broker():
+                start = time.perf_counter()
+                for at, message in messages:
+                    time.sleep(max(0, start + at - time.perf_counter()))
+                    received = time.perf_counter()
+                    subscriber.on_message(None, None, message)
+                    callbacks.append(time.perf_counter() - received)
+
+            callbacks, merges = [], []
+            thread = threading.Thread(target=broker)
+            thread.start()
+            entry = DataEntry(data_file=os.path.join(directory, 'data.csv'), log_level='ERROR')
+            while thread.is_alive():
+                start = time.perf_counter()
+                subscriber.retreive(entry.data)
+                merges.append(time.perf_counter() - start)
+                time.sleep(0.1)
+            subscriber.stop_workers()
+            devices = len(subscriber.devices)
+            subscriber.retreive(entry.data)
+        last = 20250101000000 + seconds - 1 # Timestamp of the last images, as named by the cameras
+        for i, camera_id in enumerate(camera_ids):
+            prefix = f'{camera_id}_' if i else ''
+            assert entry.data[prefix + 'image'] == f'{camera_id}_{last}.jpg', (prefix, entry.data.get(prefix + 'image'))
+        for i, node_id in enumerate(node_ids):
+            prefix = f'{node_id}_' if i else ''
+            assert entry.data[prefix + 'amb'] == seconds - 1 and entry.data[prefix + 'r'] == cameras + i, \
+                (prefix, entry.data.get(prefix + 'amb'), entry.data.get(prefix + 'r'))
+        callbacks, merges = np.array(callbacks) * 1000, np.array(merges) * 1000
+        print(f'{nodes:4d} nodes ({devices:3d} devices) {len(messages) / seconds:6.0f} msg/s | '
+              f'network thread p50 {np.percentile(callbacks, 50):6.3f} ms p95 {np.percentile(callbacks, 95):6.3f} ms | '
+              f'retreive p50 {np.percentile(merges, 50):6.3f} ms p95 {np.percentile(merges, 95):6.3f} ms')
+
+def bench_ble_poll(args):
+    '''
+    Compare the poll cycle of BLEClient against a mock BleakClient: the original sequential reads with a start and stop
+    of the IMU notifications every cycle, sequential reads with persistent subscriptions, and concurrent reads
+    '''
+    from nicla_sense import BLEClient
+
+    async def legacy_poll(ble, client):
+        start = time.perf_counter()
+        for sensor, (uuid, fmt) in ble.sensor_map.items():
+            ble.buffer[sensor] = struct.unpack(fmt, await client.read_gatt_char(uuid))[0]
+        for sensor, (uuid, fmt) in ble.sensorMapNotif.items():
+            await client.start_notify(uuid, functools.partial(ble.notif_handler, sensor_name=sensor, data_format=fmt))
+            await client.stop_notify(uuid)
+        ble.poll_latencies.append(time.perf_counter() - start)
+
+    async def run(ble, client, poll, cycles, subscribe):
+        if subscribe:
+            await ble.subscribe(client)
+        for _ in range(cycles):
+            await poll(client)
+            await asyncio.sleep(0.01)
+        for task in client.notifiers.values():
+            task.cancel()
+
+    cycles = max(args.cycles // 10, 5)
+    for serialised in [True, False]:
+        for name, parallel in [('start/stop notify per cycle', None), ('sequential reads', False), ('concurrent reads', True)]:
+            ble = BLEClient(log_level='ERROR', parallel_reads=bool(parallel))
+            client = MockBleakClient(serialised=serialised)
+            if parallel is None:
+                asyncio.run(run(ble, client, functools.partial(legacy_poll, ble), cycles, subscribe=False))
+            else:
+                asyncio.run(run(ble, client, ble.poll, cycles, subscribe=True))
+            latencies = np.array(ble.poll_latencies) * 1000
+            notifications = sum(len(buffer) for buffer in ble.notif_buffers.values())
+            link = 'serialised link' if serialised else 'concurrent link'
+            print(f'{link + ", " + name:<48} poll {latencies.mean():7.1f} ms (max {latencies.max():6.1f} ms) '
+                  f'{notifications / cycles:6.1f} notifications per cycle')
+
+def bench_ble_retrieve(args):
+    '''
+    Call BLEClient.retreive every 20 ms, as the capture cycle does, while the client polls a board continuously over
+    an adversarially slow serialised link taking 0.4 s per GATT read, comparing a client holding its lock across the
+    reads of a poll against publishing a new snapshot per poll
+    '''
+    from nicla_sense import BLEClient
+
+    class LockedBLEClient(BLEClient):
+        '''BLEClient updating its buffer in place under a lock held across the GATT reads, as it used to'''
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.lock = threading.Lock()
+
+        async def poll(self, client):
+            with self.lock:
+                for sensor, (uuid, fmt) in self.sensor_map.items():
+                    self.buffer[sensor] = struct.unpack(fmt, await client.read_gatt_char(uuid))[0]
+                self.buffer['timestamp'] = int(time.time())
+            self.poll_count += 1
+
+        def retreive(self, buffer, window=None):
+            with self.lock:
+                super().retreive(buffer, window)
+
+    async def polling(ble, stop_event):
+        client = MockBleakClient(latency=0.4, serialised=True)
+        while not stop_event.is_set():
+            await ble.poll(client)
+            await asyncio.sleep(0.01)
+
+    seconds = 6
+    for name, client_class in [('lock held across reads', LockedBLEClient), ('snapshot swap', BLEClient)]:
+        ble = client_class(log_level='CRITICAL', parallel_reads=False)
+        buffer = dict(ble.buffer)
+        stop_event = threading.Event()
+        poller = threading.Thread(target=asyncio.run, args=(polling(ble, stop_event),))
+        poller.start()
+        latencies = []
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            ble.retreive(buffer)
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.02)
+        stop_event.set()
+        poller.join()
+        latencies = np.array(latencies) * 1000
+        print(f'{name:<24} {ble.poll_count:2d} polls | retreive p50 {np.percentile(latencies, 50):8.3f} ms '
+              f'p99 {np.percentile(latencies, 99):8.3f} ms max {latencies.max():8.3f} ms')
+
+def bench_imu(args):
+    '''
+    Ingest 60 s of 100 Hz accel notifications into the BLEClient ring buffer and a deque of unpacked tuples, then
+    compute the windowed mean, variance and max magnitude from each
+    '''
+    from nicla_sense import BLEClient
+    rate, seconds = 100, 60
+    now = time.time()
+    times = now - seconds + np.arange(rate * seconds) / rate
+    samples = [struct.pack('<fff', *xyz) for xyz in np.random.default_rng(0).normal(size=(rate * seconds, 3))]
+
+    ble = BLEClient(log_level='ERROR', notif_buffer_size=rate * seconds)
+    ring = ble.notif_buffers['accel']
+    start = time.perf_counter()
+    for t, data in zip(times, samples):
+        ring.append(t, np.frombuffer(data, dtype='<f4'))
+    report('ring buffer ingest', time.perf_counter() - start, len(samples), 'samples')
+
+    def fill():
+        notifs = collections.deque(maxlen=rate * seconds)
+        for t, data in zip(times, samples):
+            notifs.append((t, struct.unpack('<fff', data)))
+        return notifs
+
+    start = time.perf_counter()
+    notifs = fill()
+    report('deque ingest', time.perf_counter() - start, len(samples), 'samples')
+    del notifs
+    tracemalloc.start()
+    notifs = fill()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'{"memory ring buffer / deque":<40} {ring.nbytes / 1024:10.0f} KiB {memory / 1024:8.0f} KiB')
+
+    def python_stats(window):
+        values = [v for t, v in notifs if t >= now - window]
+        mean = [sum(axis) / len(values) for axis in zip(*values)]
+        var = [sum((x - m) ** 2 for x in axis) / len(values) for axis, m in zip(zip(*values), mean)]
+        return mean, var, max((x * x + y * y + z * z) ** 0.5 for x, y, z in values)
+
+    for window in [1, 10, 60]:
+        seconds_ring, _ = timed(lambda: ring.stats(window, now), args.repeat)
+        seconds_python, _ = timed(lambda: python_stats(window), args.repeat)
+        print(f'{f"stats over {window} s":<40} {seconds_ring * 1000:10.3f} ms {seconds_python * 1000:8.3f} ms in Python')
+
+def bench_ble_manager(args):
+    '''
+    Run BLEManager against a fake Bleak backend with healthy boards, boards that fail their first connections,
+    boards that drop the connection and a board raising an unexpected error, reporting connections, failures and
+    polls per board. The error must only restart its own board
+    '''
+    from nicla_sense import BLEManager
+    names = [f'NiclaSenseME-{i:04X}' for i in range(7)]
+    failures = {names[2]: 2, names[3]: 10}
+    drops = {names[4], names[5]}
+    crashes = {names[6]: 1}
+    backend = FakeBleakBackend(names, failures=failures, drops=drops, drop_after=5 * 3, crashes=crashes)
+    stop_event = threading.Event()
+    manager = BLEManager(dev_names=names, polling_interval=1, log_level='CRITICAL', stop_event=stop_event,
+                         backoff_initial=0.25, backoff_max=2, scanner=backend, client_class=backend.client)
+    seconds = 8
+    threading.Timer(seconds, stop_event.set).start()
+    start = time.perf_counter()
+    manager.run()
+    print(f'{len(names)} boards for {seconds} s, stopped after {time.perf_counter() - start:.2f} s, {backend.scans} scans')
+    for name in names:
+        kind = f'fails {failures[name]} connections' if name in failures else 'drops every 5 polls' if name in drops else \
+            f'raises {crashes[name]} error' if name in crashes else 'healthy'
+        client = manager.clients[name]
+        print(f'{name} {kind:<22} connections {client.connects:3d} failures {client.failures:3d} '
+              f'polls {client.poll_count:3d} last poll {data_utils.formatEpoch(client.buffer["timestamp"])}')
+    assert manager.clients[names[6]].poll_count > 0, 'the board raising an error was not restarted'
+    assert manager.clients[names[0]].poll_count >= seconds - 1, 'the error of one board stopped the others'
+
+    # The row holds the readings of every board, the first in the plain columns and the others in prefixed ones
+    buffer = dict(DataEntry(data_file=os.devnull, log_level='ERROR').data)
+    manager.retreive(buffer)
+    for name, client in manager.clients.items():
+        prefix = manager.column_prefix(name)
+        assert all(buffer[prefix + key] == value for key, value in client.buffer.items() if key != 'timestamp'), name
+    assert buffer['timestamp'] == max(client.buffer['timestamp'] for client in manager.clients.values())
+    print(f'row holds the readings of all {len(names)} boards in {len(buffer)} columns')
+
+def bench_ble_reconnect(args):
+    '''
+    Poll a board over a flaky fake link that drops every 3 polls, with scans taking 1.5 s, comparing a scan before
+    every reconnection against reconnecting to the cached device, which must shorten the reconnects and data gaps.
+    Then check that the backoff of a board failing every connection doubles up to backoff_max and stays there
+    '''
+    from nicla_sense import BLEClient
+    seconds = 12
+    results = {}
+    for name, rescan_after in [('scan on every reconnect', 1), ('cached device, rescan after 3', 3)]:
+        backend = FakeBleakBackend(['NiclaSenseME-B806'], drops=['NiclaSenseME-B806'], drop_after=3 * 5,
+                                   latency=0.02, scan_latency=1.5)
+        stop_event = threading.Event()
+        client = BLEClient(polling_interval=1, log_level='CRITICAL', stop_event=stop_event)
+        device = backend.devices['NiclaSenseME-B806']
+        threading.Timer(seconds, stop_event.set).start()
+        asyncio.run(client.maintain(device, scanner=backend, client_class=backend.client,
+                                    backoff_initial=0.1, rescan_after=rescan_after))
+        metrics = client.link_metrics()
+        print(f'{name:<32} {metrics["polls"]:3d} polls, {metrics["connects"]:2d} connections, {backend.scans:2d} scans | '
+              f'reconnect mean {metrics["reconnect_mean"]:5.2f} s max {metrics["reconnect_max"]:5.2f} s | '
+              f'gap mean {metrics["gap_mean"]:5.2f} s max {metrics["gap_max"]:5.2f} s')
+        results[rescan_after] = metrics
+    scanning, cached = results[1], results[3]
+    assert cached['reconnect_mean'] < scanning['reconnect_mean'] and cached['gap_mean'] < scanning['gap_mean'], \
+        f'reconnecting to the cached device is not faster: {cached} against {scanning}'
+    assert cached['polls'] > scanning['polls'], f'{cached["polls"]} polls against {scanning["polls"]} with scans'
+
+    backoff_initial, backoff_max, latency = 0.1, 0.8, 0.02
+    backend = FakeBleakBackend(['NiclaSenseME-B806'], failures={'NiclaSenseME-B806': 1000}, latency=latency)
+    stop_event = threading.Event()
+    client = BLEClient(polling_interval=1, log_level='CRITICAL', stop_event=stop_event)
+    threading.Timer(6, stop_event.set).start()
+    asyncio.run(client.maintain(backend.devices['NiclaSenseME-B806'], scanner=backend, client_class=backend.client,
+                                backoff_initial=backoff_initial, backoff_max=backoff_max, rescan_after=1000))
+    waits = np.diff(backend.connect_times) - latency
+    expected = np.minimum(backoff_initial * 2 ** np.arange(len(waits)), backoff_max)
+    print(f'failing board: {len(backend.connect_times)} attempts, waits ' + ' '.join(f'{wait:.2f}' for wait in waits) + ' s')
+    assert len(waits) >= 6 and np.all(np.abs(waits - expected) < 0.1), f'backoff {waits} instead of {expected}'
+
+def stub_picam(directory, **kwargs):
+    '''PiCam saving to directory with a FakePicamera2 as its camera.'''
+    try:
+        import picamera2 # noqa: F401
+    except ImportError:
+        # Only the import is needed, the camera itself is the stub
+        sys.modules['picamera2'] = SimpleNamespace(Picamera2=FakePicamera2)
+    from picam import PiCam
+    return PiCam(image_dir=directory, log_level='ERROR', camera=FakePicamera2(), **kwargs)
+
+def bench_picam(args):
+    '''
+    Time 5-frame EV brackets with a stubbed Picamera2: fixed 1 s sleeps with a mode switch per frame against waiting
+    for the exposure to settle and writing in the background, with the exposure error of the captured frames
+    '''
+    brackets = max(args.repeat, 2)
+    for name, pipelined in [('sleep and mode switch per frame', False), ('pipelined', True)]:
+        with tempfile.TemporaryDirectory() as directory:
+            camera = stub_picam(directory, pipelined=pipelined)
+            times, errors = [], []
+            for _ in range(brackets):
+                start = time.perf_counter()
+                metadatas = camera.ev_bracketing_capture(-2, 2, 5)
+                times.append(time.perf_counter() - start)
+                errors += [abs(m['ExposureTime'] - m['Target']) / m['Target'] for m in metadatas]
+            camera.close()
+            images = len(os.listdir(directory))
+        print(f'{name:<32} {np.mean(times):6.2f} s per bracket (max {np.max(times):5.2f} s) | '
+              f'exposure error max {np.max(errors) * 100:5.2f}% | {images} images written')
+
+def fake_source(keys, latency):
+    '''Sensor source taking latency seconds to read, like the APDS9960 I2C reads, setting keys to the time halfway through the read.'''
+    def retrieve(buffer):
+        retrieve.reads += 1
+        time.sleep(latency / 2)
+        read = time.time()
+        time.sleep(latency / 2)
+        for key in keys:
+            buffer[key] = read
+    retrieve.reads = 0
+    retrieve.__qualname__ = f'fake_source({", ".join(keys)})'
+    return retrieve
+
+class FakeBufferedSource:
+    '''
+    Sensor source buffered by a background thread, like MQTTSubscriber and BLEManager, taking new readings every
+    period seconds and setting keys to the time they were taken
+    '''
+    def __init__(self, keys, period):
+        self.keys = keys
+        self.period = period
+        self.taken = time.time()
+        self.updates = 0
+        self.reads = 0
+        self.stop_event = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while not self.stop_event.wait(self.period):
+            self.taken = time.time()
+            self.updates += 1
+
+    def reading_time(self):
+        return self.taken
+
+    def retreive(self, buffer):
+        self.reads += 1
+        taken = self.taken
+        for key in self.keys:
+            buffer[key] = taken
+
+def bench_cycle(args):
+    '''
+    Compare the sensor-to-image skew of reading the sources one after another before the bracket against
+    CaptureCycle, with an MQTT-like buffer updated every 0.3 s, a BLE-like one every 2 s and a source read on demand
+    as slow as the blocking APDS9960 I2C reads. The skew of a row is that of its reading furthest from the capture.
+    CaptureCycle must report the skew of the readings it wrote, read the buffers again only when they have new readings
+    and the slow source only before and after the bracket
+    '''
+    from capture import CaptureCycle
+    cycles = max(args.repeat, 2)
+    keys = ['aec_level', 'temp', 'amb', 'r', 'g', 'b']
+    for name in ['serial', 'CaptureCycle']:
+        mqtt, ble = FakeBufferedSource(['aec_level'], 0.3), FakeBufferedSource(['temp'], 2)
+        apds = fake_source(['amb', 'r', 'g', 'b'], 0.2)
+        sources = [mqtt.retreive, ble.retreive, apds]
+        with tempfile.TemporaryDirectory() as directory:
+            camera = stub_picam(directory, pipelined=True)
+            capture_times = []
+            bracketing_capture = camera.ev_bracketing_capture
+            def recording_capture(*ev_bracket):
+                metadatas = bracketing_capture(*ev_bracket)
+                capture_times.extend(metadata['captureTime'] for metadata in metadatas)
+                return metadatas
+            camera.ev_bracketing_capture = recording_capture
+            entry = DataEntry(data_file=os.path.join(directory, 'data.csv'), log_level='ERROR')
+            cycle = CaptureCycle(camera, sources, entry, reading_times=[mqtt.reading_time, ble.reading_time, None],
+                                 log_level='ERROR')
+            skews, cycle_times = [], []
+            for _ in range(cycles):
+                start = time.perf_counter()
+                if name == 'serial':
+                    for source in sources:
+                        source(entry.data)
+                    for metadata in camera.ev_bracketing_capture(-2, 2, 5):
+                        capture_time = metadata.pop('captureTime')
+                        skews.append(max((entry.data[key] - capture_time for key in keys), key=abs))
+                        entry.data.update(metadata)
+                        entry.append()
+                    entry.flush()
+                else:
+                    skews += cycle.run((-2, 2, 5))
+                cycle_times.append(time.perf_counter() - start)
+            cycle.close()
+            camera.close()
+            entry.close()
+            mqtt.stop_event.set()
+            ble.stop_event.set()
+            with open(os.path.join(directory, 'data.csv'), newline='') as f:
+                rows = list(csv.DictReader(f, fieldnames=list(entry.data)))
+        # The skew reported must be that of the readings written, not of when they were copied
+        written = [max((float(row[key]) - capture_time for key in keys), key=abs) for row, capture_time in zip(rows, capture_times)]
+        assert len(written) == len(skews) == 5 * cycles and np.allclose(written, skews, atol=0.05), \
+            f'{name} reported skews {skews} for readings {written}'
+        skews = np.abs(skews) * 1000
+        print(f'{name:<16} cycle {np.mean(cycle_times):5.2f} s | skew mean {skews.mean():7.1f} ms max {skews.max():7.1f} ms | '
+              f'reads of MQTT {mqtt.reads:3d} BLE {ble.reads:3d} APDS9960 {apds.reads:3d}')
+    assert apds.reads == 2 * cycles, f'the slow source was read {apds.reads} times in {cycles} cycles'
+    for source in (mqtt, ble):
+        assert source.reads <= cycles + source.updates, f'{source.reads} reads of {source.updates} buffer updates in {cycles} cycles'
+    print(f'reported skews match the readings written, buffers only read again on new readings')
+
+    # A reading equal to the previous cycle's must reach every row, even when an earlier source, like the MQTT
+    # subscriber, resets the keys it has no fresh value for to None in its copy of the buffer
+    def resetting(buffer):
+        buffer.update(dict.fromkeys(['amb', 'r', 'g', 'b', 'temp'], None))
+    def constant(buffer):
+        buffer.update(amb=120, r=40, g=50, b=30)
+    with tempfile.TemporaryDirectory() as directory:
+        camera = stub_picam(directory, pipelined=True)
+        entry = DataEntry(data_file=os.path.join(directory, 'data.csv'), log_level='ERROR')
+        cycle = CaptureCycle(camera, [resetting, constant], entry, log_level='ERROR')
+        for _ in range(3):
+            cycle.run((-2, 2, 5))
+        cycle.close()
+        camera.close()
+        entry.close()
+        with open(os.path.join(directory, 'data.csv'), newline='') as f:
+            rows = list(csv.DictReader(f, fieldnames=list(entry.data)))
+    assert len(rows) == 15 and all((row['amb'], row['r'], row['g'], row['b']) == ('120', '40', '50', '30') for row in rows), \
+        'repeated readings were dropped from the rows'
+    print(f'repeated readings kept in all {len(rows)} rows of 3 cycles')
+
+def bench_e2e(args):
+    '''
+    Run server.main end to end without hardware on data.csv replayed at 1000x real time, with the capture cycles
+    back to back and pipelined brackets, as sequential ones wait a second per frame, reporting captures/s, the latency of the batch writes and the peak traced memory. The rows
+    written must hold the recorded sensor readings, timestamped in replay time, see replay.verify
+    '''
+    import replay
+    cycles = max(args.cycles // 10, 5)
+    for image_size in [(320, 256), (1280, 1024)]:
+        settings = dict(speed=1000, cycles=cycles, image_size=image_size, image_interval=0, pipelined=True)
+        with tempfile.TemporaryDirectory() as directory:
+            stats = replay.replay(args.csv, os.path.join(directory, 'timed'), **settings)
+            tracemalloc.start()
+            replay.replay(args.csv, os.path.join(directory, 'traced'), **settings)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        assert stats['rows'] > 0 and not stats['failures'], '\n'.join(stats['failures'][:10])
+        latencies = np.array(stats['write_latencies']) * 1000
+        print(f'{f"{image_size[0]}x{image_size[1]} frames":<20} {stats["rows"]:4d} rows in {stats["seconds"]:5.2f} s '
+              f'{stats["rows"] / stats["seconds"]:7.1f} captures/s | write p50 {np.percentile(latencies, 50):6.2f} ms '
+              f'p95 {np.percentile(latencies, 95):6.2f} ms | peak memory {peak / 2 ** 20:6.1f} MiB')
+
+def process_wakeups():
+    '''Context switches of all threads of this process so far, each one a wakeup of a thread'''
+    total = 0
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            with open(f'/proc/self/task/{tid}/status') as f:
+                for line in f:
+                    if 'ctxt_switches' in line:
+                        total += int(line.split(':')[1])
+        except FileNotFoundError:
+            pass # The thread exited
+    return total
+
+def bench_idle(args):
+    '''
+    Leave the waits of the server between captures, of the MQTT subscriber and of a BLE board between polls idle
+    for a while, comparing the previous sleep loops against waiting on the stop event, in wakeups per minute
+    '''
+    import replay
+    replay.install_hardware_placeholders()
+    import server
+    from nicla_sense import BLEClient
+    seconds = 15
+
+    def polling(stop_event):
+        def server_wait():
+            end = time.monotonic() + 1800
+            while not stop_event.is_set() and time.monotonic() < end:
+                time.sleep(max(0, min(2, end - time.monotonic())))
+
+        def mqtt_wait():
+            while not stop_event.is_set():
+                time.sleep(1)
+
+        async def ble_wait():
+            while not stop_event.is_set():
+                for _ in range(10 * 2):
+                    if stop_event.is_set():
+                        break
+                    await asyncio.sleep(0.5)
+        return [server_wait, mqtt_wait, lambda: asyncio.run(ble_wait())]
+
+    def event_driven(stop_event):
+        client = BLEClient(polling_interval=10, log_level='CRITICAL', stop_event=stop_event)
+
+        def mqtt_wait():
+            while not stop_event.wait(60):
+                pass
+
+        async def ble_wait():
+            while not await client.wait(client.polling_interval):
+                pass
+        return [lambda: server.wait_until(time.monotonic() + 1800), mqtt_wait, lambda: asyncio.run(ble_wait())]
+
+    for name, waits in [('sleep loops', polling), ('stop_event.wait', event_driven)]:
+        stop_event = server.stop_event
+        stop_event.clear()
+        threads = [threading.Thread(target=wait) for wait in waits(stop_event)]
+        for thread in threads:
+            thread.start()
+        time.sleep(1) # Let the threads settle into their waits
+        before = process_wakeups()
+        time.sleep(seconds)
+        wakeups = process_wakeups() - before
+        stop_event.set()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        print(f'{name:<20} {wakeups * 60 / seconds:7.1f} idle wakeups/min, stopped in '
+              f'{(time.perf_counter() - start) * 1000:6.1f} ms')
+
+def bench_logging(args):
+    '''
+    Emit log records through the Logger formatter to an in-memory stream, comparing the previous converter calling
+    get_localzone for every record against the cached timezone. Then compare, with debug records disabled, the
+    per-poll debug records of BLEClient as eager f-strings per field against one lazy record, and time the metrics
+    '''
+    from datetime import datetime
+    from tzlocal import get_localzone
+    from logger import Logger
+    import metrics
+    from nicla_sense import BLEClient
+    count = 20000
+    stream = io.StringIO()
+    logger = Logger('BenchLogging', 'INFO').get()
+    handler = logger.handlers[0]
+    handler.setStream(stream)
+    cached = handler.formatter.converter
+
+    def emit():
+        for _ in range(count):
+            logger.info('Received update from %s in %.0f ms', 'NiclaSenseME-B806', 12.3)
+        stream.seek(0)
+        stream.truncate()
+        return count
+
+    for name, converter in [('get_localzone per record', lambda *args: datetime.now(tz=get_localzone()).timetuple()),
+                            ('cached timezone', cached)]:
+        handler.formatter.converter = converter
+        seconds, records = timed(emit, args.repeat)
+        report(f'emitted, {name}', seconds, records, 'records')
+    handler.formatter.converter = cached
+
+    readings = BLEClient(log_level='CRITICAL').buffer
+
+    def eager():
+        for _ in range(count):
+            for sensor, value in readings.items():
+                logger.debug(f'{sensor}: {value}')
+            logger.debug('--------------------------------')
+        return count
+
+    def lazy():
+        for _ in range(count):
+            logger.debug('Readings of %s: %s', 'NiclaSenseME-B806', readings)
+        return count
+
+    for name, func in [('disabled, f-string per field', eager), ('disabled, one lazy record', lazy)]:
+        seconds, polls = timed(func, args.repeat)
+        report(name, seconds, polls, 'polls')
+
+    registry = metrics.MetricsRegistry()
+    counter = registry.counter('bench_total', 'Benchmark counter', ('device',)).labels(device='NiclaSenseME-B806')
+    histogram = registry.histogram('bench_seconds', 'Benchmark histogram')
+    values = np.random.default_rng(0).exponential(0.05, count).tolist()
+
+    def increment():
+        for _ in range(count):
+            counter.inc()
+        return count
+
+    def observe():
+        for value in values:
+            histogram.observe(value)
+        return count
+
+    for name, func in [('Counter.inc', increment), ('Histogram.observe', observe)]:
+        seconds, operations = timed(func, args.repeat)
+        report(name, seconds, operations, 'ops')
+    seconds, text = timed(registry.render, args.repeat)
+    report(f'render ({len(text.splitlines())} lines)', seconds, 1, 'renders')
+
+BENCHMARKS = {
+    'reader': bench_reader,
+    'timestamps': bench_timestamps,
+    'tail': bench_tail,
+    'writer': bench_writer,
+    'storage': bench_storage,
+    'augmentation': bench_augmentation,
+    'parallel': bench_parallel,
+    'groups': bench_groups,
+    'index': bench_index,
+    'mqtt_image': bench_mqtt_image,
+    'mqtt_ingest': bench_mqtt_ingest,
+    'mqtt_nodes': bench_mqtt_nodes,
+    'ble_poll': bench_ble_poll,
+    'ble_retrieve': bench_ble_retrieve,
+    'imu': bench_imu,
+    'ble_manager': bench_ble_manager,
+    'ble_reconnect': bench_ble_reconnect,
+    'picam': bench_picam,
+    'cycle': bench_cycle,
+    'e2e': bench_e2e,
+    'idle': bench_idle,
+    'logging': bench_logging,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the data collection pipeline')
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS), 
+                        help=f'benchmarks to run, any of {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('--csv', default=SAMPLE_CSV, help='data.csv to benchmark against')
+    parser.add_argument('--factors', type=int, nargs='+', default=[1, 10, 50], 
+                        help='size multiples of data.csv for the scaling benchmarks')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], 
+                        help='worker counts for the parallel benchmark')
+    parser.add_argument('--cycles', type=int, default=200, help='capture cycles for the writer benchmark')
+    parser.add_argument('--frames', type=int, default=5, help='frames per capture cycle')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the best is reported')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+    for name in args.benchmarks:
+        print(f'--- {name} ---')
+        BENCHMARKS[name](args)
@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logger import Logger
+from metrics import REGISTRY
+
+CYCLE_SECONDS = REGISTRY.histogram("capture_cycle_seconds", "Seconds from the first sensor snapshot of a cycle to queueing its rows")
+BRACKET_SECONDS = REGISTRY.histogram("capture_bracket_seconds", "Seconds taken to capture an EV bracket")
+SNAPSHOT_SECONDS = REGISTRY.histogram("capture_snapshot_seconds", "Seconds taken to read the sensor sources sampled at once")
+SKEW_SECONDS = REGISTRY.histogram("capture_skew_seconds", "Seconds between the capture of a frame and the oldest or newest sensor reading paired with it")
+
+class WrittenBuffer(dict):
+    '''Copy of the data buffer recording every key a source writes to it, even with an unchanged value.'''
+    def __init__(self, base):
+        super().__init__(base)
+        self.written = {}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.written[key] = value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+class CaptureCycle:
+    def __init__(self,
+                 camera,
+                 sources,
+                 data_entry,
+                 reading_times = None,
+                 snapshot_interval = 0.5,
+                 log_level = "INFO",
+                 clock = time.time):
+        '''
+            One capture cycle of the server: the sensor sources are read concurrently before and after the EV bracket,
+            and during it whenever a buffered source has new readings, every frame is paired with the readings of each
+            source taken closest to it in time, and the rows are written in the background while the next cycle runs
+            camera: PiCam capturing the brackets
+            sources: Functions filling a data buffer with the latest readings of a sensor source, such as
+                MQTTSubscriber.retreive, in the order their readings are merged
+            data_entry: DataEntry the rows are written to
+            reading_times: For every source, a function returning the epoch time its buffered readings were taken,
+                such as MQTTSubscriber.reading_time, or None for a source reading its sensor when called, such as
+                APDS9960Reader.retrieve, whose readings are timed by the read. By default all sources read their sensor
+            snapshot_interval: Seconds between checks of the buffered sources for new readings while the bracket is captured
+            log_level: Logging level
+            clock: Function returning the current epoch time, the clock of the camera capture times
+        '''
+        self.camera = camera
+        self.sources = sources
+        self.data_entry = data_entry
+        self.reading_times = list(reading_times) if reading_times is not None else [None] * len(sources)
+        self.snapshot_interval = snapshot_interval
+        self.clock = clock
+        self.logger = Logger("CaptureCycle", log_level).get()
+        self.readers = ThreadPoolExecutor(max_workers=len(sources))
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.flushing = None # Future of the flush of the previous cycle
+        self.skews = deque(maxlen=1000) # Seconds from capture to the paired readings of recent rows
+
+    def read(self, source, base):
+        '''Let a source fill a copy of base, returning the keys it wrote with their values.'''
+        buffer = WrittenBuffer(base)
+        try:
+            source(buffer)
+        except Exception:
+            self.logger.exception(f"Failed to read {source.__qualname__}, keeping its previous readings")
+            return {}
+        return buffer.written
+
+    def reading_time(self, index):
+        '''Epoch time the buffered readings of a source were taken, None if unknown or read on demand.'''
+        reading_time = self.reading_times[index]
+        return reading_time() if reading_time is not None else None
+
+    def sample(self, indices, base):
+        '''
+        Read the sources at indices concurrently, each into its own copy of base. Returns for each the epoch time
+        its readings were taken, halfway through the read for the sources reading their sensor, and the keys it wrote
+        '''
+        times = [self.reading_time(i) for i in indices]
+        start = self.clock()
+        writes = list(self.readers.map(self.read, [self.sources[i] for i in indices], [base] * len(indices)))
+        end = self.clock()
+        SNAPSHOT_SECONDS.observe(end - start)
+        return {i: ((start + end) / 2 if taken is None else taken, written) for i, taken, written in zip(indices, times, writes)}
+
+    @staticmethod
+    def merge(base, writes):
+        '''
+        Apply the keys every source wrote in source order, whether or not they equal the previous row. A key
+        cleared to None by a source only clears a value carried over from the previous row, not one another
+        source has just read
+        '''
+        readings = dict(base)
+        read = set() # Keys given a value by a source in these readings
+        for written in writes:
+            for key, value in written.items():
+                if key == "timestamp" or (value is None and key in read):
+                    continue
+                readings[key] = value
+                if value is not None:
+                    read.add(key)
+        readings["timestamp"] = max([base["timestamp"]] + [written["timestamp"] for written in writes if "timestamp" in written])
+        return readings
+
+    def run(self, ev_bracket):
+        '''Capture a bracket and queue its rows for writing, returning the sensor-to-image skew of every row in seconds.'''
+        start = time.perf_counter()
+        base = dict(self.data_entry.data)
+        samples = [[] for _ in self.sources] # (epoch time of the readings, keys written) of every read of each source
+        # Reading time of the last read of each buffered source, only read again once it has newer readings
+        seen = {i: self.reading_time(i) for i in range(len(self.sources)) if self.reading_times[i] is not None}
+
+        def sample(indices):
+            if indices:
+                for i, taken in self.sample(indices, base).items():
+                    samples[i].append(taken)
+
+        def changed():
+            current = {i: self.reading_time(i) for i in seen}
+            indices = [i for i in seen if current[i] != seen[i]]
+            seen.update(current)
+            return indices
+
+        sample(range(len(self.sources)))
+        bracket_done = threading.Event()
+
+        def sampler_loop():
+            while not bracket_done.wait(self.snapshot_interval):
+                sample(changed())
+
+        sampler = threading.Thread(target=sampler_loop, daemon=True)
+        sampler.start()
+        try:
+            bracket_start = time.perf_counter()
+            metadatas = self.camera.ev_bracketing_capture(*ev_bracket)
+            BRACKET_SECONDS.observe(time.perf_counter() - bracket_start)
+        finally:
+            bracket_done.set()
+            sampler.join()
+        sample([i for i in range(len(self.sources)) if i not in seen] + changed())
+
+        # The rows of the previous cycle must be written before new ones are queued
+        if self.flushing is not None:
+            self.flushing.result()
+
+        skews = []
+        data = self.data_entry.data
+        for metadata in metadatas:
+            capture_time = metadata.pop("captureTime")
+            paired = [min(source_samples, key=lambda sample: abs(sample[0] - capture_time)) for source_samples in samples]
+            data.update(self.merge(base, [written for _, written in paired]))
+
+            # The sensor timestamp is in epoch seconds like the capture time
+            if capture_time - data["timestamp"] > 600:
+                self.logger.warning("Image timestamp is more than 10 minutes ahead of sensor data timestamp!")
+
+            for key in metadata:
+                data[key] = metadata[key]
+            self.data_entry.append()
+
+            # The skew of a row is that of its reading furthest from the capture
+            skew = max((taken - capture_time for taken, _ in paired), key=abs)
+            skews.append(skew)
+            SKEW_SECONDS.observe(abs(skew))
+            self.logger.info("%s: sensor readings up to %+.0f ms from capture, %d reads in cycle",
+                             metadata['image'], skew * 1000, sum(map(len, samples)))
+        self.skews.extend(skews)
+
+        # One write and fsync for all frames of the bracket, overlapping with the next cycle
+        self.flushing = self.writer.submit(self.data_entry.flush)
+        CYCLE_SECONDS.observe(time.perf_counter() - start)
+        return skews
+
+    def close(self):
+        '''Wait for the last rows to be written.'''
+        if self.flushing is not None:
+            self.flushing.result()
+        self.writer.shutdown()
+        self.readers.shutdown()
@@ -1,14 +1,24 @@
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta
 import argparse
+import functools
+import json
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from operator import itemgetter
 import os
 import random
+import mmap
 import re
+import shutil
+import numpy as np
+from storage import ColumnStore, toFloat, INT_MISSING
 
 ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 CSV_FILE = os.path.join(ROOT_DIR, 'data.csv')
 TEXT_FILE = os.path.join(ROOT_DIR, 'plaintext_data.csv')
+STORE_DIR = os.path.join(ROOT_DIR, 'columns')
 TRAIN_DIR = ROOT_DIR
 COLUMNS_OF_INTEREST = ['amb', 'r', 'g', 'b', 'temp', 'pressure', 'co2', 'humidity', 'gas', 'Lux']
 PROPER_NAMES = {
@@ -23,6 +33,13 @@ PROPER_NAMES = {
     'gas': 'Gas',
     'Lux': 'Lux'
 }
+TEXT_COLUMNS = ['timestamp', 'image']
+NUMERIC_COLUMNS = COLUMNS_OF_INTEREST + ['ev']
+CHUNK_SIZE = 4096
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
+LATEST_SUFFIX = '.latest' # Sidecar file holding the header and the latest row of data.csv
+INDEX_SUFFIX = '.index' # Sidecar file holding the byte range and line count of every image group of a plaintext file
+CHECKPOINT_SUFFIX = '.checkpoint' # Sidecar file recording how far the CSV file was converted to a plaintext file
 
 def roundData(data, ndigits):
     ''' 
@@ -32,89 +49,505 @@ def roundData(data, ndigits):
         return round(float(data), ndigits)
     return data
 
+@functools.lru_cache(maxsize=4096)
 def readableTimestamp(timestamp):
     ''' 
-    Convert the timestamp to a human-readable format
+    Convert the timestamp to a human-readable format. The rows of an image group share their
+    timestamp, so each distinct timestamp is only parsed once
     '''
     if timestamp.endswith('_base'):
         timestamp = timestamp[:-5]
-    timestamp = datetime.strptime(timestamp,"%Y%m%d%H%M%S")
+    timestamp = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
     return timestamp.strftime("%Y-%m-%d %H:%M:%S")
 
-def convertToPlaintext(csv_path=CSV_FILE, text_path=TEXT_FILE, neutral_only=True):
+@functools.lru_cache(maxsize=4096)
+def toEpoch(timestamp, timezone=None, timestamp_format=TIMESTAMP_FORMAT):
     ''' 
-    Create plaintext representation of the data row-wise by selecting columns of interest 
-    and putting in a key-value pair format. If neutral_only is set to True, only rows with
-    ev = 0.0 will be included in the plaintext file
+    Convert a timestamp string (with or without the "_base" suffix) in timezone, local time if None,
+    to integer epoch seconds. Each distinct timestamp is only parsed once
     '''
-    with open(csv_path, 'r', encoding='utf-8') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        curr_image_grp = 0
-        with open(text_path, 'w', encoding='utf-8') as text_file:
-            for row in csv_reader:
+    if timestamp.endswith('_base'):
+        timestamp = timestamp[:-5]
+    return int(datetime.strptime(timestamp, timestamp_format).replace(tzinfo=timezone).timestamp())
 
-                if "base" in row['timestamp']:
-                    curr_image_grp += 1
+@functools.lru_cache(maxsize=4096)
+def formatEpoch(epoch, timezone=None, timestamp_format=TIMESTAMP_FORMAT):
+    ''' 
+    Format integer epoch seconds as a timestamp string in timezone, local time if None. The rows of
+    a capture cycle share their timestamp, so each distinct one is only formatted once
+    '''
+    return datetime.fromtimestamp(epoch, timezone).strftime(timestamp_format)
 
-                if row['ev'] == None: 
-                    print(row['image'])
-                    assert False
+def parseTimestamps(timestamps, timezone=None):
+    ''' 
+    Vectorized toEpoch over an array of %Y%m%d%H%M%S timestamps, str or bytes (as read from a column
+    store), with or without the "_base" suffix. Returns int64 epoch seconds with INT_MISSING for
+    the cells that are not valid timestamps. The digits are decoded with NumPy and the UTC offset
+    of timezone, local time if None, is only looked up once per distinct hour
+    '''
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind not in 'SU':
+        timestamps = timestamps.astype(str)
+    if len(timestamps) == 0:
+        return np.empty(0, dtype=np.int64)
+    # Character codes of the fixed-width strings, padded with zeros, of which the first 15 are needed
+    code = np.uint32 if timestamps.dtype.kind == 'U' else np.uint8
+    width = timestamps.dtype.itemsize // np.dtype(code).itemsize
+    if width < 15:
+        timestamps, width = timestamps.astype(f'{timestamps.dtype.kind}15'), 15
+    codes = np.ascontiguousarray(timestamps).view(code).reshape(len(timestamps), width)[:, :15]
+    digits = codes[:, :14] - code(ord('0')) # Characters below '0' wrap around to large values
+    valid = (digits <= 9).all(axis=1) & ((codes[:, 14] == 0) | (codes[:, 14] == ord('_')))
+    pairs = digits[:, 0::2].astype(np.int64) * 10 + digits[:, 1::2]
+    year = pairs[:, 0] * 100 + pairs[:, 1]
+    month, day, hour, minute, second = pairs[:, 2], pairs[:, 3], pairs[:, 4], pairs[:, 5], pairs[:, 6]
+    valid &= (year >= 1970) & (month >= 1) & (month <= 12) & (day >= 1) & (hour < 24) & (minute < 60) & (second < 60)
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0)
+    days = months.astype('M8[M]').astype('M8[D]').astype(np.int64) + np.where(valid, day - 1, 0)
+    valid &= days.astype('M8[D]').astype('M8[M]').astype(np.int64) == months # Day within the month
+    naive = np.where(valid, days * 86400 + hour * 3600 + minute * 60 + second, 0)
+
+    # Rows are mostly in time order, so the offsets are looked up per run of rows within the same hour
+    hours = naive // 3600
+    starts = np.flatnonzero(np.concatenate(([True], hours[1:] != hours[:-1])))
+    distinct, inverse = np.unique(hours[starts], return_inverse=True)
+    offsets = np.array([utcOffset(datetime(1970, 1, 1) + timedelta(hours=int(h)), timezone) for h in distinct],
+                       dtype=np.int64)
+    offsets = np.repeat(offsets[inverse.reshape(-1)], np.diff(np.append(starts, len(naive))))
+    return np.where(valid, naive - offsets, INT_MISSING)
+
+def utcOffset(naive, timezone=None):
+    ''' 
+    Seconds the naive datetime in timezone, local time if None, is ahead of UTC
+    '''
+    aware = naive.replace(tzinfo=timezone) if timezone is not None else naive.astimezone()
+    return int(aware.utcoffset().total_seconds())
 
-                if neutral_only and float(row['ev']) != 0.0: continue # Skip rows with no data
+def readColumns(csv_path=CSV_FILE, chunk_size=CHUNK_SIZE, start=None, stop=None):
+    ''' 
+    Stream the CSV file in chunks of at most `chunk_size` rows, parsing only the columns listed in
+    TEXT_COLUMNS and NUMERIC_COLUMNS. Each chunk is a dict of NumPy arrays keyed by column name:
+    text columns are str arrays, numeric columns are float64 arrays with NaN for empty cells.
+    chunk['decimals'] maps each numeric column to a bool mask of the cells written with a decimal
+    point, so that values can be formatted back the same way roundData does.
+    start and stop restrict the rows read to the byte range [start, stop) of the file, which must
+    be at row boundaries (see groupSegments).
+    If csv_path is the directory of a column store, the columns are memory-mapped from it instead
+    and start and stop are row indices
+    '''
+    if os.path.isdir(csv_path):
+        yield from readStoreColumns(csv_path, chunk_size, start, stop)
+        return
+
+    with open(csv_path, 'rb') as csv_file:
+        header = next(csv.reader([csv_file.readline().decode('utf-8')]))
+        if start is not None:
+            csv_file.seek(start)
+        csv_reader = csv.reader(decodedLines(csv_file, stop))
+        non_empty = (row for row in csv_reader if row) # Blank lines are skipped, as csv.DictReader does
+        columns = TEXT_COLUMNS + NUMERIC_COLUMNS
+        getter = itemgetter(*[header.index(x) for x in columns])
+        while True:
+            try:
+                rows = [getter(row) for row in islice(non_empty, chunk_size)]
+            except IndexError:
+                raise ValueError(f'Incomplete row at line {csv_reader.line_num} of {csv_path}')
+            if not rows:
+                break
+
+            chunk = {'decimals': {}}
+            for x, cells in zip(columns, zip(*rows)):
+                if x in TEXT_COLUMNS:
+                    chunk[x] = np.array(cells, dtype=str)
+                    continue
+                chunk[x] = np.array([float(c) if c else np.nan for c in cells], dtype=np.float64)
+                chunk['decimals'][x] = np.array(['.' in c for c in cells], dtype=bool)
+            yield chunk
+
+def decodedLines(binary_file, stop=None):
+    ''' 
+    Iterate over the lines of a file opened in binary mode from its current position up to the
+    byte offset stop
+    '''
+    pos = binary_file.tell()
+    for line in binary_file:
+        if stop is not None and pos >= stop:
+            break
+        pos += len(line)
+        yield line.decode('utf-8')
+
+def readStoreColumns(store_dir=STORE_DIR, chunk_size=CHUNK_SIZE, start=None, stop=None):
+    ''' 
+    Same as readColumns, reading rows [start, stop) from a column store (see storage.py). Only the
+    needed columns are memory-mapped, and the values of float columns written with a decimal point are
+    flagged by the store, all of them if it has no flags
+    '''
+    store = ColumnStore(store_dir)
+    length = len(store)
+    columns = {x: store.read(x, length) for x in TEXT_COLUMNS + NUMERIC_COLUMNS}
+    decimals = {x: store.read_decimals(x, length) if columns[x].dtype.kind == 'f' else None for x in NUMERIC_COLUMNS}
+    start = start or 0
+    stop = length if stop is None else min(stop, length)
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        chunk = {'decimals': {}}
+        for x in TEXT_COLUMNS:
+            chunk[x] = columns[x][chunk_start:chunk_stop].astype(str)
+        for x in NUMERIC_COLUMNS:
+            chunk[x] = toFloat(columns[x][chunk_start:chunk_stop])
+            if decimals[x] is not None:
+                chunk['decimals'][x] = np.array(decimals[x][chunk_start:chunk_stop])
+            else:
+                chunk['decimals'][x] = np.full(len(chunk[x]), columns[x].dtype.kind == 'f', dtype=bool)
+        yield chunk
+
+def groupSegments(csv_path=CSV_FILE, stop=None):
+    ''' 
+    Split the CSV file (or column store) up to `stop` into image groups without parsing the rows.
+    Returns a list of (start, stop, group) where [start, stop) is the byte range (row range for a
+    column store) of an image group and group is the id of the group before it, as passed to
+    filteredChunks
+    '''
+    if os.path.isdir(csv_path):
+        store = ColumnStore(csv_path)
+        timestamps = store.read('timestamp')[:stop]
+        starts = [0] + np.flatnonzero(np.char.find(timestamps, b'base') >= 0).tolist() + [len(timestamps)]
+    else:
+        with open(csv_path, 'rb') as csv_file:
+            header = next(csv.reader([csv_file.readline().decode('utf-8')]))
+            index = header.index('timestamp') # Assumes no quoted commas before the timestamp column
+            pos = csv_file.tell()
+            end = os.fstat(csv_file.fileno()).st_size if stop is None else stop
+            starts = [pos]
+            if end > pos:
+                # Only the few occurrences of "base" are looked at, rather than every line
+                with mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ) as csv_map:
+                    base_lines = []
+                    for match in re.compile(b'base').finditer(csv_map, pos, end):
+                        line_start = max(csv_map.rfind(b'\n', pos, match.start()) + 1, pos)
+                        if csv_map[line_start:match.start()].count(b',') == index and base_lines[-1:] != [line_start]:
+                            base_lines.append(line_start)
+                    starts += base_lines
+            starts.append(max(end, pos))
+
+    # Rows before the first "_base" timestamp belong to group 0
+    return [(starts[i], starts[i + 1], max(i - 1, 0)) for i in range(len(starts) - 1) if starts[i] < starts[i + 1]]
+
+def formatValue(value, decimal, ndigits=2):
+    ''' 
+    Format a value parsed by readColumns the way roundData formats the raw cell
+    '''
+    return str(round(value, ndigits)) if decimal else str(int(value))
 
-                filtered = [f'{PROPER_NAMES[x]}:{roundData(row[x], 2)}' for x in COLUMNS_OF_INTEREST if row[x] != '']
+def formatColumn(values, decimals, ndigits=2, prefix=''):
+    ''' 
+    Vectorized formatValue over a column, with an empty string for NaN. Each distinct value is
+    formatted only once, after the given prefix
+    '''
+    formatted = np.full(len(values), '', dtype=object)
+    for decimal in (True, False):
+        mask = (decimals == decimal) & ~np.isnan(values)
+        uniques, inverse = np.unique(values[mask], return_inverse=True)
+        strings = np.array([prefix + formatValue(value, decimal, ndigits) for value in uniques.tolist()], dtype=object)
+        formatted[mask] = strings[inverse]
+    return formatted
+
+def filteredChunks(csv_path=CSV_FILE, neutral_only=True, chunk_size=CHUNK_SIZE, start=None, stop=None, group=0):
+    ''' 
+    Iterate over the CSV file chunk by chunk, yielding (image groups, images, lux, fields) arrays
+    for the rows of the chunk, where fields[i, j] is the key-value pair of the j-th column of
+    interest of row i, or an empty string if the cell is empty, followed by the image group of the
+    last row of the chunk. A new image group starts at every timestamp with the "_base" suffix.
+    If neutral_only is set to True, only rows with ev = 0.0 are included. start, stop and group
+    select a range of rows as returned by groupSegments
+    '''
+    curr_image_grp = group
+    for chunk in readColumns(csv_path, chunk_size, start, stop):
+        groups = curr_image_grp + np.cumsum(np.char.find(chunk['timestamp'], 'base') >= 0)
+        curr_image_grp = groups[-1]
+        keep = chunk['ev'] == 0.0 if neutral_only else np.ones(len(groups), dtype=bool)
+
+        fields = np.empty((int(keep.sum()), len(COLUMNS_OF_INTEREST)), dtype=object)
+        for j, x in enumerate(COLUMNS_OF_INTEREST):
+            fields[:, j] = formatColumn(chunk[x][keep], chunk['decimals'][x][keep], prefix=PROPER_NAMES[x] + ':')
+        yield groups[keep], chunk['image'][keep], chunk['Lux'][keep], fields, int(curr_image_grp)
+
+def filteredRows(csv_path=CSV_FILE, neutral_only=True, chunk_size=CHUNK_SIZE):
+    ''' 
+    Iterate over the rows of the CSV file, yielding (image group, image, lux, filtered) where
+    filtered is the list of key-value pairs of the non-empty columns of interest (see filteredChunks)
+    '''
+    for groups, images, lux, fields, _ in filteredChunks(csv_path, neutral_only, chunk_size):
+        for row in zip(groups.tolist(), images.tolist(), lux.tolist(), fields.tolist()):
+            yield row[0], row[1], row[2], [field for field in row[3] if field]
 
-                text_file.write(f"{curr_image_grp}>{row['image']}>{','.join(filtered)[:-1]}\n")
+def convertToPlaintext(csv_path=CSV_FILE, text_path=TEXT_FILE, neutral_only=True):
+    ''' 
+    Create plaintext representation of the data row-wise by selecting columns of interest 
+    and putting in a key-value pair format. If neutral_only is set to True, only rows with
+    ev = 0.0 will be included in the plaintext file
+    '''
+    sizes = []
+    with open(text_path, 'wb') as text_file:
+        for curr_image_grp, image, _, filtered in filteredRows(csv_path, neutral_only):
+            line = f"{curr_image_grp}>{image}>{','.join(filtered)[:-1]}\n".encode('utf-8')
+            text_file.write(line)
+            addGroupSize(sizes, curr_image_grp, len(line), 1)
+    writePlaintextIndex(text_path, sizes)
+
+def augmentChunk(rng, fields, lux, night_prob, incomplete_prob, num_permutations):
+    ''' 
+    Draw the augmented entries of a chunk of rows from filteredChunks in one go. The first
+    permutation of every row keeps the column order, the others are random permutations of the
+    non-empty fields. A permutation of a night image (Lux < 100) is kept only `night_prob` of the
+    time, and one of an incomplete row only `incomplete_prob` of the time.
+    All random numbers of a row are drawn consecutively, so the result does not depend on how the
+    rows drawn from the same generator are split into chunks.
+    Returns (row index, field order) of the kept permutations and the number of kept night and
+    incomplete permutations
+    '''
+    n, num_columns = fields.shape
+    present = fields != ''
+    draws = rng.random((n, num_permutations * (num_columns + 2)))
+
+    # Sorting random keys gives uniform random permutations, empty fields are sorted to the end
+    keys = draws[:, :num_permutations * num_columns].reshape(n, num_permutations, num_columns)
+    keys[:, 0, :] = np.arange(num_columns)
+    keys[~np.broadcast_to(present[:, None, :], keys.shape)] = np.inf
+    orders = np.argsort(keys, axis=2)
+
+    night = (lux < 100)[:, None]
+    incomplete = (present.sum(axis=1) < num_columns)[:, None]
+    night_draws, incomplete_draws = np.split(draws[:, num_permutations * num_columns:], 2, axis=1)
+    night_kept = night & (night_draws <= night_prob)
+    incomplete_kept = incomplete & (incomplete_draws <= incomplete_prob)
+    kept = (~night | night_kept) & (~incomplete | incomplete_kept)
+
+    rows, perms = np.nonzero(kept)
+    night_count = int((night_kept & (~incomplete | incomplete_kept)).sum())
+    incomplete_count = int((incomplete_kept & (~night | night_kept)).sum())
+    return rows, orders[rows, perms], night_count, incomplete_count
+
+def augmentSegment(csv_path, text_path, start, stop, group, neutral_only, night_prob, incomplete_prob, num_permutations, seed, 
+                   resume=None, mode='wb'):
+    ''' 
+    Write the augmented plaintext entries of the rows in [start, stop) (see groupSegments) to
+    text_path. Every image group draws from its own generator seeded with (seed, group id), so the
+    output of a group does not depend on how the file is split. resume is the (group id, generator
+    state) returned by the run that ended at `start`, to continue the draws of a group split
+    across runs. Returns the number of entries written, the number of night and incomplete entries
+    among them, the sizes of the groups written (see addGroupSize), the image group of the last row
+    and the (group id, generator state) to resume from
+    '''
+    total_count = 0
+    night_count = 0
+    incomplete_count = 0
+    sizes = []
+    rng, rng_group = None, None
+    if resume is not None:
+        rng_group, state = resume
+        rng = np.random.default_rng()
+        rng.bit_generator.state = state
+    with open(text_path, mode) as text_file:
+        for groups, images, lux, fields, group in filteredChunks(csv_path, neutral_only, start=start, stop=stop, group=group):
+            if not len(groups):
+                continue
+            blocks = []
+            bounds = [0] + (np.flatnonzero(np.diff(groups)) + 1).tolist() + [len(groups)]
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                curr_image_grp = int(groups[lo])
+                if curr_image_grp != rng_group:
+                    rng, rng_group = np.random.default_rng([seed, curr_image_grp]), curr_image_grp
+                rows, orders, grp_night, grp_incomplete = augmentChunk(
+                    rng, fields[lo:hi], lux[lo:hi], night_prob, incomplete_prob, num_permutations)
+                night_count += grp_night
+                incomplete_count += grp_incomplete
+                total_count += len(rows)
+
+                # Empty fields are ordered last, so every caption is the join of the first `present` fields
+                prefix = f'{curr_image_grp}>'
+                present = np.count_nonzero(fields[lo:hi] != '', axis=1)[rows].tolist()
+                permuted = np.take_along_axis(fields[lo:hi][rows], orders, axis=1).tolist()
+                block = ''.join([f'{prefix}{image}>{",".join(perm[:count])}\n'
+                                 for image, perm, count in zip(images[lo:hi][rows].tolist(), permuted, present)])
+                blocks.append(block.encode('utf-8'))
+                addGroupSize(sizes, curr_image_grp, len(blocks[-1]), len(rows))
+            text_file.write(b''.join(blocks))
+    resume = (rng_group, rng.bit_generator.state) if rng is not None else resume
+    return total_count, night_count, incomplete_count, sizes, group, resume
 
 def convertToPlaintextWithAugmentation(csv_path=CSV_FILE, 
                                        text_path=TEXT_FILE, 
                                        neutral_only=True, 
                                        night_prob=0.9,
                                        incomplete_prob=0.1, 
-                                       num_permutations=10):
+                                       num_permutations=10,
+                                       seed=None,
+                                       workers=1,
+                                       incremental=False):
     ''' 
     Create plaintext representation of the data row-wise by selecting columns of interest 
     and putting in a key-value pair format. If neutral_only is set to True, only rows with
-    ev = 0.0 will be included in the plaintext file
+    ev = 0.0 will be included in the plaintext file. Each row is written as num_permutations
+    random permutations of its key-value pairs (see augmentChunk), drawn from generators derived
+    from `seed` so that the output is reproducible.
+    With workers > 1, the file is split at image group boundaries into shards that are converted
+    in parallel processes and concatenated in order. The output is the same for any number of workers.
+    Every run records how far the CSV file was converted in a checkpoint next to the plaintext file.
+    With incremental set to True, only the rows added since are converted and appended, giving the
+    same output as converting the whole file again. The whole file is converted if the checkpoint
+    is missing or was made with other settings or another CSV file
     '''
-    total_count = 0
-    night_count = 0
-    incomplete_count = 0
-    with open(csv_path, 'r', encoding='utf-8') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        curr_image_grp = 0
-        with open(text_path, 'w', encoding='utf-8') as text_file:
-            for row in csv_reader:
-
-                if "base" in row['timestamp']:
-                    curr_image_grp += 1
-
-                if row['ev'] == None: 
-                    print(row['image'])
-                    assert False
-
-                if neutral_only and float(row['ev']) != 0.0: continue # Skip rows with no data
-
-                filtered = [f'{PROPER_NAMES[x]}:{roundData(row[x], 2)}' for x in COLUMNS_OF_INTEREST if row[x] != '']
-
-                # Choose num_permutations many random permutations of the data
-                permutations = [filtered] + [random.sample(filtered, len(filtered)) for _ in range(num_permutations-1)]
-
-                for perm in permutations:
-                    if float(row['Lux']) < 100:
-                        # choose a night image only `night_prob` of the time
-                        if random.random() > night_prob: continue
-                        night_count += 1
-
-                    if len(filtered) < len(COLUMNS_OF_INTEREST):
-                        # drop an incomplete data entry only `incomplete_prob` of the time
-                        if random.random() > incomplete_prob: continue
-                        incomplete_count += 1
+    settings = {'csv_path': os.path.abspath(csv_path), 'neutral_only': neutral_only, 'night_prob': night_prob,
+                'incomplete_prob': incomplete_prob, 'num_permutations': num_permutations}
+    stop = convertedSize(csv_path)
+    checkpoint = readCheckpoint(text_path) if incremental else None
+    index = readPlaintextIndex(text_path) if checkpoint is not None else None
+    if checkpoint is not None and (index is None or checkpoint['settings'] != settings or checkpoint['stop'] > stop or 
+                                   (seed is not None and seed != checkpoint['seed'])):
+        print('Checkpoint does not match the data or settings, converting the whole file')
+        checkpoint = None
+    if seed is None:
+        seed = checkpoint['seed'] if checkpoint is not None else np.random.SeedSequence().entropy
+    params = (neutral_only, night_prob, incomplete_prob, num_permutations, seed)
+
+    if checkpoint is not None:
+        sizes = [[int(group), end - begin, lines] for group, (begin, end, lines) in index.items()]
+        total_count, night_count, incomplete_count, new_sizes, group, resume = augmentSegment(
+            csv_path, text_path, checkpoint['stop'], stop, checkpoint['group'], *params, resume=checkpoint['resume'], mode='ab')
+        for size in new_sizes:
+            addGroupSize(sizes, *size)
+        print(f'Appended {total_count} entries converted from the new rows')
+    elif workers <= 1:
+        total_count, night_count, incomplete_count, sizes, group, resume = augmentSegment(
+            csv_path, text_path, None, stop, 0, *params)
+    else:
+        shards = shardSegments(groupSegments(csv_path, stop), workers * 4)
+        shard_paths = [f'{text_path}.{i}' for i in range(len(shards))]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(augmentSegment, csv_path, shard_path, *shard, *params)
+                       for shard, shard_path in zip(shards, shard_paths)]
+            counts = [future.result() for future in futures]
+        with open(text_path, 'wb') as text_file:
+            for shard_path in shard_paths:
+                with open(shard_path, 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, text_file)
+                os.remove(shard_path)
+        total_count, night_count, incomplete_count = [sum(count) for count in list(zip(*counts))[:3]]
+        sizes = []
+        for _, _, _, shard_sizes, _, _ in counts:
+            for size in shard_sizes:
+                addGroupSize(sizes, *size)
+        group, resume = counts[-1][4:] if counts else (0, None)
+    writePlaintextIndex(text_path, sizes)
+    writeCheckpoint(text_path, {'settings': settings, 'seed': seed, 'stop': stop, 'group': group, 'resume': resume})
+
+    if total_count:
+        print(f'Percentage of incomplete entries: {incomplete_count/total_count}')
+        print(f'Percentage of night images: {night_count/total_count}')
+
+def convertedSize(csv_path=CSV_FILE):
+    ''' 
+    End of the complete rows of the CSV file: the byte offset after its last newline, as a row
+    still being written must not be converted. For a column store, the number of rows
+    '''
+    if os.path.isdir(csv_path):
+        return len(ColumnStore(csv_path))
+    with open(csv_path, 'rb') as csv_file:
+        pos = csv_file.seek(0, os.SEEK_END)
+        while pos > 0:
+            step = min(4096, pos)
+            csv_file.seek(pos - step)
+            block = csv_file.read(step)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                return pos - step + newline + 1
+            pos -= step
+    return 0
+
+def readCheckpoint(text_path=TEXT_FILE):
+    ''' 
+    Read the conversion checkpoint of a plaintext file, or None if there is none or the plaintext
+    file was modified after it
+    '''
+    checkpoint_path = text_path + CHECKPOINT_SUFFIX
+    if not os.path.isfile(checkpoint_path) or not os.path.isfile(text_path) or \
+            os.path.getmtime(checkpoint_path) < os.path.getmtime(text_path):
+        return None
+    with open(checkpoint_path, 'r', encoding='utf-8') as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def writeCheckpoint(text_path, checkpoint):
+    tmp_path = text_path + CHECKPOINT_SUFFIX + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(tmp_path, text_path + CHECKPOINT_SUFFIX)
+
+def shardSegments(segments, num_shards):
+    ''' 
+    Merge consecutive image group segments from groupSegments into at most num_shards shards of
+    similar size
+    '''
+    if not segments:
+        return []
+    target = (segments[-1][1] - segments[0][0]) / num_shards
+    shards = []
+    for start, stop, group in segments:
+        if shards and stop - shards[-1][0] <= target:
+            shards[-1] = (shards[-1][0], stop, shards[-1][2])
+        else:
+            shards.append((start, stop, group))
+    return shards
+
+def addGroupSize(sizes, group, num_bytes, num_lines):
+    ''' 
+    Account num_bytes and num_lines written for an image group to sizes, a list of
+    [group, bytes, lines] in the order the groups are written
+    '''
+    if sizes and sizes[-1][0] == group:
+        sizes[-1][1] += num_bytes
+        sizes[-1][2] += num_lines
+    elif num_lines:
+        sizes.append([group, num_bytes, num_lines])
 
-                    text_file.write(f"{curr_image_grp}>{row['image']}>{','.join(perm)}\n")
-                    total_count += 1
-    print(f'Percentage of incomplete entries: {incomplete_count/total_count}')
-    print(f'Percentage of night images: {night_count/total_count}')
+def writePlaintextIndex(text_path, sizes):
+    ''' 
+    Write the index of a plaintext file from the sizes of its groups (see addGroupSize). Each row
+    of the index holds the group id, the byte range [start, stop) of its lines and their count
+    '''
+    start = 0
+    with open(text_path + INDEX_SUFFIX, 'w', encoding='utf-8', newline='') as index_file:
+        writer = csv.writer(index_file)
+        writer.writerow(['group', 'start', 'stop', 'lines'])
+        for group, num_bytes, num_lines in sizes:
+            writer.writerow([group, start, start + num_bytes, num_lines])
+            start += num_bytes
+
+def readPlaintextIndex(text_path=TEXT_FILE):
+    ''' 
+    Read the index of a plaintext file as a dict mapping group id to (start, stop, lines), in file
+    order. Returns None if there is no index or it does not match the plaintext file anymore
+    '''
+    index_path = text_path + INDEX_SUFFIX
+    if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(text_path):
+        return None
+    with open(index_path, 'r', encoding='utf-8', newline='') as index_file:
+        index = {row['group']: (int(row['start']), int(row['stop']), int(row['lines'])) 
+                 for row in csv.DictReader(index_file)}
+    last_stop = max((stop for _, stop, _ in index.values()), default=0)
+    return index if last_stop == os.path.getsize(text_path) else None
+
+def getImageGroup(group, text_path=TEXT_FILE, index=None):
+    ''' 
+    Get the lines of an image group from a plaintext file through its index, without reading the
+    rest of the file. index is the result of readPlaintextIndex, read from the file if not given
+    '''
+    index = index or readPlaintextIndex(text_path)
+    if index is None:
+        raise ValueError(f'No up-to-date index for {text_path}')
+    start, stop, _ = index[str(group)]
+    with open(text_path, 'rb') as text_file, mmap.mmap(text_file.fileno(), 0, access=mmap.ACCESS_READ) as text_map:
+        return text_map[start:stop].decode('utf-8').splitlines()
 
 def extracImageGroup(input_path=TEXT_FILE, output_path=TRAIN_DIR, num=10, mode='base'):
     ''' 
@@ -124,99 +557,209 @@ def extracImageGroup(input_path=TEXT_FILE, output_path=TRAIN_DIR, num=10, mode='
     train_path: path to store the extracted image group. This will be used by the dataloader subsequently
     num: number of image groups to extract counting from the back
     mode: the output csv base file name
+    The input is streamed twice: a first pass only finds where the last `num` groups start (or
+    they are taken from the index of the plaintext file), and the second pass seeks there and
+    writes each group to its file as it is read
     '''
     print('Extracting image groups...')
-    buffer = deque(iterable=[], maxlen=num) if num >= 0 else deque([]) # Circular buffer
+    offsets = deque(maxlen=num) if num >= 0 else deque([]) # Start offsets of the last `num` groups
     num_total = 0
     num_extracted = 0
     num_groups = 0
-    curr_grp = 0
-    
-    # Read in `num` many groups of images
-    with open(input_path, 'r', encoding='utf-8') as input_file:
-        for line in input_file:
-            
-            num_total += 1
-            line = line.strip()
-            group, image, caption = line.strip().split('>')
-
-            if group != curr_grp:
-                num_groups += 1
-                curr_grp = group
-                if num != 0:
-                    buffer.append([]) # Create anew image group
-
-            # Process the data
-            _, image, caption = line.strip().split('>')
+    curr_grp = None
+
+    # First pass: count the lines and record where the groups start, from the index if there is one
+    index = readPlaintextIndex(input_path)
+    if index is not None:
+        for start, _, lines in index.values():
+            num_total += lines
+            num_groups += 1
             if num != 0:
-                buffer[-1].append((image, caption)) # Append to the latest image group
-
-
-
-    # Write the extracted image groups to the train file
-    for i, group in enumerate(buffer):
-        grp_count = 0
-        group_output_path = os.path.join(output_path, f'{mode}{i}.csv')        
-        with open(group_output_path, 'w', encoding='utf-8') as output_file:
-            for image, caption in group:
-                output_file.write(f'{image}>{caption}\n')
+                offsets.append(start)
+    else:
+        with open(input_path, 'rb') as input_file:
+            pos = 0
+            for line in input_file:
+                num_total += 1
+                group = line[:line.index(b'>')].strip()
+                if group != curr_grp:
+                    num_groups += 1
+                    curr_grp = group
+                    if num != 0:
+                        offsets.append(pos)
+                pos += len(line)
+
+    # Second pass: write the extracted image groups to the train files
+    if offsets:
+        with open(input_path, 'rb') as input_file:
+            input_file.seek(offsets[0])
+            output_file = None
+            grp_count = 0
+            curr_grp = None
+            i = -1
+            for line in input_file:
+                group, _, entry = line.strip().partition(b'>')
+                if group != curr_grp:
+                    if output_file is not None:
+                        output_file.close()
+                        print(f'{grp_count} entries extracted to {group_output_path}')
+                    curr_grp = group
+                    i += 1
+                    grp_count = 0
+                    group_output_path = os.path.join(output_path, f'{mode}{i}.csv')
+                    output_file = open(group_output_path, 'wb')
+                output_file.write(entry + b'\n')
                 num_extracted += 1
                 grp_count += 1
-        print(f'{grp_count} entries extracted to {group_output_path}')
-        grp_count = 0
+            output_file.close()
+            print(f'{grp_count} entries extracted to {group_output_path}')
 
-    print(f'Number of image groups extracted: {len(buffer)}/{num_groups}')
+    print(f'Number of image groups extracted: {len(offsets)}/{num_groups}')
     print(f'Number of images extracted: {num_extracted}/{num_total}')
     print('Percentage of images extracted:', num_extracted / num_total * 100)
 
 
-def getLastRowReadable(file):
+def readLastRow(file, block_size=4096):
     ''' 
-    Get the last row of the CSV file and convert it to a key-value pair format
+    Get the last complete row of the CSV file as a dict keyed by the header, reading backwards from
+    the end of the file block by block so that the cost does not depend on the size of the file.
+    A trailing row without a terminating newline is treated as incomplete and skipped
     '''
-    with open(file, 'r', encoding='utf-8') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        last_row = list(csv_reader)[-1]
-        filtered = [f'{PROPER_NAMES[x]} : {roundData(last_row[x], 2)}\n' for x in COLUMNS_OF_INTEREST if last_row[x] != '']
-        filtered.append(f'Image : {last_row["image"]}\n')
-        filtered.append(f'Timestamp : {readableTimestamp(last_row["timestamp"])}\n')
-        filtered.reverse()
-        return ''.join(filtered)[:-1]
+    with open(file, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8')]))
+        header_end = f.tell()
+        pos = f.seek(0, os.SEEK_END)
+        tail = b''
+        while pos > header_end:
+            step = min(block_size, pos - header_end)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+
+            # The last element is either empty or an incomplete row, the first one is only known
+            # to be complete once the start of the data is reached
+            lines = tail.split(b'\n')
+            complete = lines[:-1] if pos == header_end else lines[1:-1]
+            for line in reversed(complete):
+                if line.strip():
+                    row = next(csv.reader([line.decode('utf-8')]))
+                    if len(row) != len(header):
+                        raise ValueError(f'Malformed last row in {file}')
+                    return dict(zip(header, row))
+    raise ValueError(f'No complete row found in {file}')
 
-def create_train_test_split(input_path = TRAIN_DIR, ratio=0.2, mode='base'):
+def getLastRowReadable(file):
+    ''' 
+    Get the last row of the CSV file and convert it to a key-value pair format. Falls back to the
+    latest row cached by DataEntry when the tail of the CSV file cannot be read
+    '''
+    try:
+        last_row = readLastRow(file)
+    except (OSError, ValueError):
+        last_row = readLastRow(file + LATEST_SUFFIX)
+    filtered = [f'{PROPER_NAMES[x]} : {roundData(last_row[x], 2)}\n' for x in COLUMNS_OF_INTEREST if last_row[x] != '']
+    filtered.append(f'Image : {last_row["image"]}\n')
+    filtered.append(f'Timestamp : {readableTimestamp(last_row["timestamp"])}\n')
+    filtered.reverse()
+    return ''.join(filtered)[:-1]
+
+def create_train_test_split(input_path = TRAIN_DIR, ratio=0.2, mode='base', val_groups=None, seed=None, buffer_size=10000):
     '''
     Create a train-test split of the data in the input path. The input path is expected to contain multiple CSV files 
     with names matching that of the mode argument specified by in the extractImageGroup function. 
     The ratio argument specifies the ratio of the test set to the total data.
+    The files are streamed line by line: each line goes to the test set with probability `ratio`, drawn
+    from a generator seeded with `seed`, and the lines of each output are shuffled through a buffer
+    of at most `buffer_size` lines, so that memory does not depend on the size of the files.
+    If val_groups is given, the split is made by image group instead: all files named {mode}{i}.csv
+    are used, those with i in val_groups make up the test set and the others the train set
     '''
+    rng = random.Random(seed)
     train_file_path = os.path.join(input_path, 'train.csv')
     test_file_path = os.path.join(input_path, 'val.csv')
     train_file = open(train_file_path, 'w', encoding='utf-8')
     test_file = open(test_file_path, 'w', encoding='utf-8')
-
-    regex = re.compile(rf"{mode}[0-9]?+\.csv$")
-    for file in os.listdir(input_path):
-        if regex.search(file):
-
+    train_buffer = []
+    test_buffer = []
+    num_line_train = 0
+    num_line_test = 0
+
+    if val_groups is not None:
+        val_groups = {str(group) for group in val_groups}
+        regex = re.compile(rf"^{mode}([0-9]+)\.csv$")
+    else:
+        regex = re.compile(rf"{mode}[0-9]?+\.csv$")
+    for file in sorted(os.listdir(input_path)):
+        match = regex.search(file)
+        if match:
+
+            to_test = match.group(1) in val_groups if val_groups is not None else None
             with open(os.path.join(input_path, file), 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                random.shuffle(lines)
-                train_file.writelines(lines[:int(len(lines)*(1-ratio))])
-                test_file.writelines(lines[int(len(lines)*(1-ratio)):])
+                for line in f:
+                    if to_test if to_test is not None else rng.random() < ratio:
+                        writeShuffled(test_file, test_buffer, line, rng, buffer_size)
+                        num_line_test += 1
+                    else:
+                        writeShuffled(train_file, train_buffer, line, rng, buffer_size)
+                        num_line_train += 1
+
+    for output_file, buffer in [(train_file, train_buffer), (test_file, test_buffer)]:
+        rng.shuffle(buffer)
+        output_file.writelines(buffer)
+        output_file.close()
 
-    train_file.close()
-    test_file.close()
-
-    num_line_train = sum(1 for line in open(train_file_path, 'rb'))
-    num_line_test = sum(1 for line in open(test_file_path, 'rb'))
     print(f'Number of lines in train file: {num_line_train}')
     print(f'Number of lines in test file: {num_line_test}')
     print(f'Total number of lines: {num_line_train + num_line_test}')
     print(f'Final train ratio: {num_line_train / (num_line_train+num_line_test)}')
 
-
-mode = 'base'
-convertToPlaintextWithAugmentation(night_prob=0.5, num_permutations=10)
-extracImageGroup(num=1000, mode=mode)
-create_train_test_split(mode='base7')
-
+def writeShuffled(output_file, buffer, line, rng, buffer_size):
+    '''
+    Write a line through a shuffle buffer: once the buffer is full, a random line from the buffer is
+    written and replaced by the new line. The remaining lines are left in the buffer for the caller
+    '''
+    if len(buffer) < buffer_size:
+        buffer.append(line)
+        return
+    i = rng.randrange(buffer_size)
+    output_file.write(buffer[i])
+    buffer[i] = line
+
+if __name__ == '__main__':
+    STEPS = ['convert', 'extract', 'split']
+    parser = argparse.ArgumentParser(description='Post-process data.csv into plaintext image-sensor pairs and train/val splits')
+    parser.add_argument('steps', nargs='*', default=STEPS, help=f'steps to run, any of {", ".join(STEPS)} (default: all)')
+    parser.add_argument('--csv_path', default=CSV_FILE, help='data.csv or a column store directory')
+    parser.add_argument('--text_path', default=TEXT_FILE)
+    parser.add_argument('--train_dir', default=TRAIN_DIR)
+    parser.add_argument('--all_ev', action='store_true', help='include the rows of all EV brackets, not only ev = 0')
+    parser.add_argument('--night_prob', type=float, default=0.5)
+    parser.add_argument('--incomplete_prob', type=float, default=0.1)
+    parser.add_argument('--num_permutations', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--incremental', action='store_true', help='only convert the rows added since the last conversion')
+    parser.add_argument('--num', type=int, default=1000, help='number of image groups to extract counting from the back')
+    parser.add_argument('--mode', default='base', help='base file name of the extracted image groups')
+    parser.add_argument('--split_mode', default='base7', help='file name pattern of the image groups to split')
+    parser.add_argument('--ratio', type=float, default=0.2, help='ratio of the test set')
+    parser.add_argument('--val_groups', type=int, nargs='+', default=None, help='image groups to use as the test set')
+    args = parser.parse_args()
+    for step in args.steps:
+        if step not in STEPS:
+            parser.error(f'unknown step {step}')
+
+    if 'convert' in args.steps:
+        convertToPlaintextWithAugmentation(args.csv_path, 
+                                           args.text_path, 
+                                           neutral_only=not args.all_ev,
+                                           night_prob=args.night_prob, 
+                                           incomplete_prob=args.incomplete_prob,
+                                           num_permutations=args.num_permutations, 
+                                           seed=args.seed, 
+                                           workers=args.workers,
+                                           incremental=args.incremental)
+    if 'extract' in args.steps:
+        extracImageGroup(args.text_path, args.train_dir, num=args.num, mode=args.mode)
+    if 'split' in args.steps:
+        create_train_test_split(args.train_dir, ratio=args.ratio, mode=args.split_mode, val_groups=args.val_groups, seed=args.seed)
@@ -1,17 +1,39 @@
 import csv
+import os
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
 from logger import Logger
+from metrics import REGISTRY
+from data_utils import LATEST_SUFFIX, formatEpoch
 from os.path import join, dirname, abspath
 
 DIR_PATH = dirname(abspath(__file__))
+WRITE_SECONDS = REGISTRY.histogram("data_write_seconds", "Seconds taken to write a batch of rows, including the fsync")
+ROWS = REGISTRY.counter("data_rows_total", "Rows written")
 
 class DataEntry:
     def __init__(self, 
                  timestamp_format = "%Y%m%d%H%M%S",
                  data_file = join(DIR_PATH, 'data', 'data.csv'),
                  log_level = "INFO",
+                 column_store = None,
+                 write_csv = True,
+                 timezone = ZoneInfo("Asia/Singapore"),
                  ):
+        '''
+            Combined sensor data and image metadata written as one row per image. The timestamp is kept
+            as integer epoch seconds and only formatted when the row is written
+            timestamp_format: Format of the timestamp
+            data_file: CSV file the rows are appended to
+            log_level: Logging level
+            column_store: Optional storage.ColumnStore the rows are also written to as typed columns
+            write_csv: Set to False to write the rows to the column store only. The latest row
+                sidecar of data_file is kept up to date either way
+            timezone: Timezone the timestamp is written in
+        '''
         self.data = {
-            "timestamp": 20250101000000,
+            "timestamp": int(datetime(2025, 1, 1, tzinfo=timezone).timestamp()),
             "image": None,
             "aec_level": None,
             "agc_gain": None,
@@ -29,13 +51,23 @@ class DataEntry:
             "quat": (0, 0, 0, 0),
         }
         self.data_file = data_file
+        self.latest_file = data_file + LATEST_SUFFIX
         self.timestamp_format = timestamp_format
+        self.timezone = timezone
+        self.column_store = column_store
+        self.write_csv = write_csv
         self.logger = Logger("DataEntry", log_level).get()
 
+        # Long-lived writer used by append/flush
+        self.batch = []
+        self.file = None
+        self.writer = None
+        self.fsync_count = 0
+
     def __str__(self):
         res = ""
-        for key in self.data:
-            res += f"{key}: {self.data[key]}, "
+        for key, value in zip(self.data, self.to_csv_row()):
+            res += f"{key}: {value}, "
         res = res[:-2]
         return res
 
@@ -43,13 +75,112 @@ class DataEntry:
         """Convert the object into a list suitable for writing to a CSV file."""
         res = []
         for key in self.data:
-            res.append(self.data[key])
+            value = self.data[key]
+            if key == "timestamp" and isinstance(value, int):
+                value = formatEpoch(value, self.timezone, self.timestamp_format)
+            res.append(value)
         return res
 
     def write_to_csv(self):
-        with open(self.data_file, mode="a", newline="") as f:
+        row = self.to_csv_row()
+        if self.write_csv:
+            with open(self.data_file, mode="a", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(row)
+        if self.column_store is not None:
+            self.column_store.append([dict(zip(self.data.keys(), row))])
+        self.write_latest(row)
+
+    def append(self):
+        """Queue the current data as a row to be written by the next flush."""
+        self.batch.append(self.to_csv_row())
+
+    def flush(self):
+        """
+        Write all queued rows through the long-lived file handles of data_file and the column store, and fsync
+        them together once for the batch
+        """
+        if not self.batch:
+            return
+        start = time.perf_counter()
+        pos = length = None
+        try:
+            if self.write_csv:
+                if self.file is None:
+                    self.open()
+                pos = os.fstat(self.file.fileno()).st_size
+                self.writer.writerows(self.batch)
+                self.file.flush()
+            if self.column_store is not None:
+                length = len(self.column_store)
+                self.column_store.append([dict(zip(self.data.keys(), row)) for row in self.batch])
+            if self.write_csv:
+                os.fsync(self.file.fileno())
+            if self.column_store is not None:
+                self.column_store.sync()
+        except OSError:
+            # The batch is kept and written again by the next flush, so the rows of it that were written are removed
+            if pos is not None:
+                self.discard(pos)
+            if length is not None:
+                self.discard_columns(length)
+            raise
+        self.fsync_count += 1
+        self.logger.debug("Wrote %d rows to %s", len(self.batch), self.data_file)
+        self.write_latest(self.batch[-1])
+        WRITE_SECONDS.observe(time.perf_counter() - start)
+        ROWS.inc(len(self.batch))
+        self.batch = []
+
+    def open(self):
+        # Terminate a row cut short by a previous crash so that it does not swallow the next row
+        if os.path.isfile(self.data_file) and os.path.getsize(self.data_file) > 0:
+            with open(self.data_file, mode="rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.logger.warning(f"Incomplete last row in {self.data_file}, terminating it")
+                    f.write(b"\r\n")
+        self.file = open(self.data_file, mode="a", newline="")
+        self.writer = csv.writer(self.file)
+
+    def discard(self, pos):
+        """Drop the file handle with anything it still buffers and cut the file back to pos bytes."""
+        try:
+            self.file.close()
+        except OSError:
+            pass # Its buffer is lost, the rows are written again by the next flush
+        self.file = None
+        self.writer = None
+        try:
+            os.truncate(self.data_file, pos)
+        except OSError:
+            self.logger.exception(f"Failed to remove the partly written rows from {self.data_file}")
+
+    def discard_columns(self, length):
+        """Cut the column store back to length rows."""
+        try:
+            self.column_store.truncate(length)
+        except OSError:
+            self.logger.exception(f"Failed to remove the partly written rows from {self.column_store.store_dir}")
+
+    def close(self):
+        """Flush any queued rows and release the file handles."""
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.writer = None
+        if self.column_store is not None:
+            self.column_store.close()
+
+    def write_latest(self, row):
+        """Replace the sidecar file with the header and the given row, used as a fallback for looking up the latest data."""
+        tmp_file = self.latest_file + ".tmp"
+        with open(tmp_file, mode="w", newline="") as f:
             writer = csv.writer(f)
-            writer.writerow(self.to_csv_row())
+            writer.writerow(self.data.keys())
+            writer.writerow(row)
+        os.replace(tmp_file, self.latest_file)
 
     def print_header(self):
         res = ""
@@ -0,0 +1,189 @@
+import asyncio
+import contextlib
+import struct
+import time
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image
+from bleak import BleakError
+
+class FakePicamera2:
+    def __init__(self, frame_period = 0.1, control_delay = 2, converge_rate = 0.5, switch_time = 0.25,
+                 image_size = (1280, 1024), metadata = None):
+        '''
+            Stand-in for Picamera2 delivering a synthetic image of image_size every frame_period seconds, or at once
+            if 0. A change of ExposureValue reaches the sensor control_delay frames later, after which the AE closes
+            converge_rate of the remaining error every frame and reports AeLocked within 1%. A mode switch takes
+            switch_time
+            metadata: Function returning the metadata of a captured frame, such as that of a recorded row, instead
+                of the simulated exposure with its Target
+        '''
+        pixels = np.random.default_rng(0).integers(0, 256, (image_size[1], image_size[0], 3), dtype=np.uint8)
+        self.image = Image.fromarray(pixels)
+        self.image_size = image_size
+        self.frame_period = frame_period
+        self.control_delay = control_delay
+        self.converge_rate = converge_rate
+        self.switch_time = switch_time
+        self.metadata = metadata
+        self.helpers = SimpleNamespace(save=self.save)
+        self.exposure = self.target = 10000.0
+        self.pending = [] # (frame, target exposure)
+        self.start_time = time.monotonic()
+        self.frame = 0
+
+    def create_still_configuration(self, main, display = None):
+        return {"main": main}
+
+    def configure(self, config):
+        pass
+
+    def stream_configuration(self, name):
+        return {"size": self.image_size, "format": "BGR888"}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def set_controls(self, controls):
+        self.pending.append((self.frame + self.control_delay, 10000.0 * 2 ** controls["ExposureValue"]))
+
+    def next_frame(self):
+        '''Wait for the next frame and run the AE for all frames since the last one.'''
+        frame = self.frame + 1
+        if self.frame_period:
+            now = time.monotonic()
+            frame = max(frame, int((now - self.start_time) / self.frame_period) + 1)
+            time.sleep(max(0, self.start_time + frame * self.frame_period - now))
+        for f in range(self.frame + 1, frame + 1):
+            while self.pending and self.pending[0][0] <= f:
+                self.target = self.pending.pop(0)[1]
+            self.exposure += (self.target - self.exposure) * self.converge_rate
+        self.frame = frame
+        return {"ExposureTime": int(self.exposure), "AnalogueGain": 1.0, "DigitalGain": 1.0,
+                "AeLocked": abs(self.exposure - self.target) <= 0.01 * self.target, "Target": self.target}
+
+    def capture_metadata(self):
+        return self.next_frame()
+
+    def captured_metadata(self):
+        '''Metadata of a captured frame, see metadata.'''
+        metadata = self.next_frame()
+        return self.metadata() if self.metadata is not None else metadata
+
+    def capture_request(self):
+        metadata = self.captured_metadata()
+        return SimpleNamespace(make_image=lambda name: self.image.copy(), get_metadata=lambda: metadata,
+                               release=lambda: None)
+
+    def switch_mode_and_capture_file(self, config, path, wait = False):
+        time.sleep(self.switch_time)
+        metadata = self.captured_metadata()
+        self.save(self.image, metadata, path)
+        return metadata
+
+    def wait(self, job):
+        return job
+
+    def save(self, image, metadata, path):
+        image.save(path, format="JPEG", quality=90)
+
+class MockBleakClient:
+    def __init__(self, latency = 0.015, serialised = True, notify_hz = 100, value = None):
+        '''
+            Stand-in for a connected BleakClient with a fixed latency per GATT operation, either handled one at a time
+            like a single ATT bearer or concurrently, sending IMU notifications at notify_hz while subscribed
+            value: Function returning the bytes of a characteristic by uuid, by default the float 1.0 for reads and
+                zeros for notifications
+        '''
+        self.latency = latency
+        self.lock = asyncio.Lock() if serialised else contextlib.nullcontext()
+        self.notify_hz = notify_hz
+        self.value = value
+        self.notifiers = {}
+
+    async def operation(self):
+        if isinstance(self.lock, asyncio.Lock):
+            async with self.lock:
+                await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+
+    async def read_gatt_char(self, uuid):
+        await self.operation()
+        return self.value(uuid) if self.value is not None else b"\x00\x00\x80\x3f"
+
+    async def start_notify(self, uuid, callback):
+        await self.operation()
+        fmt = "<ffff" if "-7001-" in uuid else "<fff" # quat or accel/gyro
+
+        async def notify():
+            while True:
+                await asyncio.sleep(1 / self.notify_hz)
+                callback(uuid, bytearray(self.value(uuid) if self.value is not None else struct.calcsize(fmt)))
+        self.notifiers[uuid] = asyncio.ensure_future(notify())
+
+    async def stop_notify(self, uuid):
+        await self.operation()
+        self.notifiers.pop(uuid).cancel()
+
+class FakeBleakBackend:
+    def __init__(self, names, failures = None, drops = (), drop_after = 20, latency = 0.015, scan_latency = 0.015,
+                 crashes = None, notify_hz = 100, value = None):
+        '''
+            Stand-in for BleakScanner and BleakClient serving the boards in names. Connecting to a board fails the first
+            failures[name] times, raises an unexpected error the first crashes[name] times, and a connection to a board in
+            drops is lost after drop_after reads. Connecting and every read take latency, scans take scan_latency
+            notify_hz, value: See MockBleakClient
+        '''
+        self.devices = {name: SimpleNamespace(name=name, address=f"AA:BB:CC:DD:EE:{i:02X}") for i, name in enumerate(names)}
+        self.failures = dict(failures or {})
+        self.crashes = dict(crashes or {})
+        self.connect_times = [] # Monotonic times of the connection attempts
+        self.drops = set(drops)
+        self.drop_after = drop_after
+        self.latency = latency
+        self.scan_latency = scan_latency
+        self.notify_hz = notify_hz
+        self.value = value
+        self.scans = 0
+
+    async def discover(self, timeout = 5):
+        self.scans += 1
+        await asyncio.sleep(self.scan_latency)
+        return list(self.devices.values())
+
+    async def find_device_by_name(self, name, timeout = 10):
+        self.scans += 1
+        await asyncio.sleep(self.scan_latency)
+        return self.devices.get(name)
+
+    def client(self, device):
+        backend = self
+
+        class Connection(MockBleakClient):
+            async def __aenter__(self):
+                backend.connect_times.append(time.monotonic())
+                await asyncio.sleep(backend.latency)
+                if backend.failures.get(device.name, 0) > 0:
+                    backend.failures[device.name] -= 1
+                    raise BleakError(f"Failed to connect to {device.address}")
+                if backend.crashes.get(device.name, 0) > 0:
+                    backend.crashes[device.name] -= 1
+                    raise RuntimeError(f"Unexpected error of {device.address}")
+                self.reads = 0
+                return self
+
+            async def __aexit__(self, *exc):
+                for task in self.notifiers.values():
+                    task.cancel()
+
+            async def read_gatt_char(self, uuid):
+                self.reads += 1
+                if device.name in backend.drops and self.reads > backend.drop_after:
+                    raise BleakError(f"Disconnected from {device.address}")
+                return await super().read_gatt_char(uuid)
+
+        return Connection(latency=self.latency, serialised=False, notify_hz=self.notify_hz, value=self.value)
@@ -0,0 +1,83 @@
+import argparse
+from contextlib import contextmanager
+import os
+import sqlite3
+import time
+
+DIR_PATH = os.path.dirname(os.path.abspath(__file__))
+INDEX_NAME = 'images.sqlite'
+
+class ImageIndex:
+    def __init__(self,
+                 image_dir = os.path.join(DIR_PATH, 'data', 'images'),
+                 index_file = None,
+                 timeout = 10):
+        '''
+            Catalogue of the images saved in image_dir, kept in a SQLite database so that the number
+            of images and the latest image can be looked up without listing the directory.
+            image_dir: Directory the images are saved to
+            index_file: Path of the SQLite database, defaults to images.sqlite next to image_dir
+            timeout: Seconds to wait for another process holding a lock on the database
+        '''
+        self.image_dir = image_dir
+        self.index_file = index_file or os.path.join(os.path.dirname(os.path.normpath(image_dir)), INDEX_NAME)
+        self.timeout = timeout
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS images (name TEXT PRIMARY KEY, added REAL)")
+
+    @contextmanager
+    def connect(self):
+        # A connection per call, as the index is shared between threads and processes
+        conn = sqlite3.connect(self.index_file, timeout=self.timeout)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, name):
+        with self.connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO images VALUES (?, ?)", (name, time.time()))
+
+    def count(self):
+        # Images are never removed other than by reconcile, which rebuilds the table, so the
+        # largest rowid is the number of rows
+        with self.connect() as conn:
+            return conn.execute("SELECT IFNULL(MAX(rowid), 0) FROM images").fetchone()[0]
+
+    def latest(self):
+        '''Name of the latest image, i.e. the last one in sorted order, or None if there are no images.'''
+        with self.connect() as conn:
+            row = conn.execute("SELECT name FROM images ORDER BY name DESC LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def reconcile(self):
+        '''
+        Rebuild the index from the images present in image_dir, returning the number of images. The directory
+        is listed while holding the write lock of the index, so that an image added meanwhile is either listed
+        or indexed by its add once the rebuild is committed, never dropped
+        '''
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            names = sorted(entry.name for entry in os.scandir(self.image_dir)
+                           if entry.name.endswith('.jpg') and entry.is_file())
+            now = time.time()
+            conn.execute("DELETE FROM images")
+            conn.executemany("INSERT INTO images VALUES (?, ?)", [(name, now) for name in names])
+        return len(names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the catalogue of captured images')
+    parser.add_argument('command', choices=['reconcile', 'count', 'latest'])
+    parser.add_argument('--image_dir', default=os.path.join(DIR_PATH, 'data', 'images'))
+    parser.add_argument('--index_file', default=None)
+    args = parser.parse_args()
+
+    index = ImageIndex(args.image_dir, args.index_file)
+    if args.command == 'reconcile':
+        print(f'Indexed {index.reconcile()} images in {index.index_file}')
+    elif args.command == 'count':
+        print(index.count())
+    else:
+        print(index.latest())
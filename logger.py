@@ -4,6 +4,15 @@ from datetime import datetime
 from zoneinfo import ZoneInfoNotFoundError
 from tzlocal import get_localzone
 
+try:
+    # Looked up once, the record timestamps are converted to it by every formatted record
+    LOCAL_TIMEZONE = get_localzone()
+except ZoneInfoNotFoundError:
+    LOCAL_TIMEZONE = None # Local time of the system
+
+def localTime(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=LOCAL_TIMEZONE).timetuple()
+
 class Logger:
     def __init__(self, name="Logger", log_level="INFO",):
         self.logger = logging.getLogger(name)  # Use the provided name instead of hardcoding "Logger"
@@ -15,7 +24,7 @@ class Logger:
                 '%(asctime)s [%(name)s][%(levelname)s] - %(message)s'
             )
             log_format.datefmt = "%Y-%m-%d %H:%M:%S"
-            logging.Formatter.converter = lambda *args: datetime.now(tz=get_localzone()).timetuple()
+            log_format.converter = localTime # Time the record was created, in the cached local timezone
             console_handler.setFormatter(log_format)
             self.logger.addHandler(console_handler)
 
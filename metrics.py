@@ -0,0 +1,198 @@
+import abc
+import bisect
+import math
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the histogram buckets, covering image decodes up to slow BLE polls and brackets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def formatNumber(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+class Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames = (), labelvalues = ()):
+        '''
+            A metric family, or with labelvalues one of its series. The series of a family with labelnames
+            are created on first use by labels()
+            name: Metric name, following the Prometheus naming conventions
+            documentation: Help text of the metric
+            labelnames: Names of the labels distinguishing the series of the family
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.labelvalues = tuple(labelvalues)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, **labels):
+        '''The series of the family with the given label values, to be kept by callers on hot paths.'''
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.child(key))
+        return child
+
+    def child(self, labelvalues):
+        return type(self)(self.name, self.documentation, labelvalues=labelvalues)
+
+    def series(self):
+        '''The (labels, metric) of every series, the family itself if it has no labels.'''
+        if not self.labelnames:
+            return [((), self)]
+        return [(tuple(zip(self.labelnames, key)), child) for key, child in list(self.children.items())]
+
+    @abc.abstractmethod
+    def samples(self):
+        '''The (name suffix, extra labels, value) of the samples of this series.'''
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for labels, metric in self.series():
+            for suffix, extra, value in metric.samples():
+                pairs = ','.join(f'{name}="{escapeLabel(value)}"' for name, value in labels + extra)
+                lines.append(f'{self.name}{suffix}{{{pairs}}} {formatNumber(value)}' if pairs else
+                             f'{self.name}{suffix} {formatNumber(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0
+
+    def inc(self, amount = 1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount = 1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount = 1):
+        self.inc(-amount)
+
+    def samples(self):
+        return [('', (), self.value)]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames = (), labelvalues = (), buckets = DEFAULT_BUCKETS):
+        '''
+            Counts of observations per bucket, with their sum, see Metric
+            buckets: Increasing upper bounds of the buckets, the +Inf bucket is added
+        '''
+        super().__init__(name, documentation, labelnames, labelvalues)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def child(self, labelvalues):
+        return Histogram(self.name, self.documentation, labelvalues=labelvalues, buckets=self.buckets)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(('_bucket', (('le', formatNumber(bound)),), cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), cumulative))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        '''
+            Counters, gauges and histograms of the data collection pipeline, rendered in the Prometheus text
+            exposition format to a file, e.g. for the textfile collector of node_exporter, or over HTTP
+        '''
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        '''Add a metric, or return the one of the same name and type registered before.'''
+        with self.lock:
+            existing = self.metrics.setdefault(metric.name, metric)
+        if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+            raise ValueError(f'Metric {metric.name} is already registered as a different metric')
+        return existing
+
+    def counter(self, name, documentation, labelnames = ()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames = ()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames = (), buckets = DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return ''.join(metric.render() + '\n' for metric in metrics)
+
+    def write(self, path):
+        '''Replace the file at path with the current metrics, so that readers never see a partial file.'''
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_file, path)
+
+    def serve(self, port = 8000, host = '127.0.0.1'):
+        '''Serve the metrics at http://host:port/metrics from a daemon thread, returning the server.'''
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Scrapes are not worth a log line each
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+# Registry the components record their metrics in
+REGISTRY = MetricsRegistry()
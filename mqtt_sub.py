@@ -1,18 +1,82 @@
 import threading
+import queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from zoneinfo import ZoneInfo
 import paho.mqtt.client as mqtt
 import ssl
 import base64
+import binascii
 from PIL import Image
 import io
-from datetime import datetime
 import os
 import csv
 import numpy as np
 from logger import Logger
+from image_index import ImageIndex
+from data_utils import toEpoch, formatEpoch
+from metrics import REGISTRY
 import time
 
 DIR_PATH = os.path.dirname(os.path.abspath(__file__))
+DROP_POLICIES = ("block", "drop_oldest", "drop_newest")
+MESSAGES = REGISTRY.counter("mqtt_messages_total", "MQTT messages received, by message type", ("type",))
+IMAGES = REGISTRY.counter("mqtt_images_total", "Images received, processed, dropped or failed", ("outcome",))
+DECODE_SECONDS = REGISTRY.histogram("mqtt_image_decode_seconds", "Seconds taken to check or re-encode and write an image")
+IMAGE_LATENCY = REGISTRY.histogram("mqtt_image_latency_seconds", "Seconds from receiving an image to buffering it")
+QUEUE_DEPTH = REGISTRY.gauge("mqtt_image_queue_depth", "Images waiting for the ingest workers")
+
+# Fields of the data entry provided by each kind of MQTT device
+DEVICE_FIELDS = {"camera": ("image", "aec_level", "agc_gain"), "node": ("amb", "r", "g", "b")}
+FIELDS = DEVICE_FIELDS["camera"] + DEVICE_FIELDS["node"]
+
+def decode_image_payload(image_string, reencode = False):
+    '''
+    Decode the base64 JPEG of an IMG message, returning the bytes to write to file or None if it is not
+    a complete JPEG. Module-level so that it can run in a process pool
+    '''
+    image_data = binascii.a2b_base64(image_string)
+    if reencode:
+        image_stream = io.BytesIO()
+        Image.open(io.BytesIO(image_data)).save(image_stream, format="JPEG")
+        return image_stream.getvalue()
+    if not is_jpeg(image_data):
+        return None
+    return image_data
+
+def is_jpeg(data):
+    # Starts with the SOI marker and has the EOI marker at the end, allowing for some padding
+    return data[:2] == b"\xff\xd8" and data.rfind(b"\xff\xd9", max(len(data) - 32, 0)) >= 0
+
+class DeviceState:
+    def __init__(self, device_id, kind = "camera"):
+        '''
+            Latest readings of one ESP32CAM or sensor node. Writers of a device take its own lock, so devices
+            do not contend with each other, and replace the readings as a whole, so readers need no lock
+            device_id: Camera id for cameras, topic suffix for sensor nodes
+            kind: "camera" or "node", see DEVICE_FIELDS
+        '''
+        self.device_id = device_id
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.data = {"timestamp": None, "received": None, "taken": None}
+
+    def update(self, values, received, timestamp = None, taken = None):
+        '''
+        Merge values received at monotonic time received, and taken at epoch time taken, into the readings. Returns
+        False and leaves the readings unchanged if timestamp, in epoch seconds, is older than the buffered one
+        '''
+        with self.lock:
+            if timestamp is not None and self.data["timestamp"] is not None and timestamp < self.data["timestamp"]:
+                return False
+            data = dict(self.data)
+            data.update(values)
+            data["received"] = received
+            data["taken"] = taken
+            if timestamp is not None:
+                data["timestamp"] = timestamp
+            self.data = data
+            return True
 
 class MQTTSubscriber:
     def __init__(self, 
@@ -29,9 +93,43 @@ class MQTTSubscriber:
                  timezone = ZoneInfo("Asia/Singapore"),
                  delay_tolerance = 600,
                  log_level = "INFO",
-                 stop_event = None):
+                 stop_event = None,
+                 reencode_images = False,
+                 num_workers = 2,
+                 decode_processes = 0,
+                 queue_size = 32,
+                 drop_policy = "drop_oldest",
+                 block_timeout = 1,
+                 metrics_interval = 60,
+                 cameras = None,
+                 sensor_nodes = None,
+                 clock = time.time):
+        '''
+            Subscribes to the ESP32CAM and sensor topics and keeps the latest readings of every camera, keyed
+            by camera id, and every sensor node, keyed by the topic suffix under sensor_topic.
+            Images are decoded and written by a pool of worker threads fed by a bounded queue, so that
+            paho's network loop only parses the message type.
+            num_workers: Worker threads writing images, 0 to handle images inline in the network loop
+            decode_processes: Processes to decode images in, 0 to decode in the worker threads
+            queue_size: Maximum number of images waiting for a worker
+            drop_policy: What to do with an image when the queue is full, one of
+                "block": wait up to block_timeout seconds for space, holding up the network loop, then drop it
+                "drop_oldest": drop the oldest queued image to make room
+                "drop_newest": drop the received image
+            delay_tolerance: Readings of a device received more than this many seconds ago are not used
+            metrics_interval: Seconds between logging the ingest metrics, 0 to disable
+            cameras: Ids of the ESP32CAMs whose readings are written. The first fills the image, aec_level and
+                agc_gain columns and every other one its own columns prefixed with its id, such as 02_image.
+                None to write those of the first camera heard from only
+            sensor_nodes: Topic suffixes of the sensor nodes whose readings are written, filling the amb, r, g and
+                b columns the same way as cameras. None to write those of the first sensor node heard from only
+            clock: Function returning the current epoch time, for images received without a timestamp
+        '''
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"drop_policy must be one of {DROP_POLICIES}, got {drop_policy}")
         self.timestamp_format = timestamp_format
         self.timezone = timezone
+        self.clock = clock
         self.mqtt_broker_ip = mqtt_broker_ip
         self.mqtt_port = mqtt_port
         self.ca_cert_path = ca_cert_path
@@ -41,109 +139,299 @@ class MQTTSubscriber:
         self.username = username
         self.password = password
         self.image_dir = image_dir
-        self.buffer = {
-            "timestamp": 20250101000000,
-            "image": None,
-            "aec_level": None,
-            "agc_gain": None,
-            "amb": None,
-            "r": None,
-            "g": None,
-            "b": None
-        }
+        self.image_index = None
+        self.devices = {} # Device id: DeviceState, replaced as a whole when a device is added
+        self.devices_lock = threading.Lock()
+        self.device_ids = {"camera": tuple(cameras) if cameras else None,
+                           "node": tuple(sensor_nodes) if sensor_nodes else None} # Devices written, by kind
         self.logger = Logger("MQTTSubscriber", log_level).get()
         self.stop_event = stop_event
         self.delay_tolerance = delay_tolerance
-        self.lock = threading.Lock()
+        self.reencode_images = reencode_images # Decode and re-encode received JPEGs with PIL instead of writing them as received
 
+        # Image ingest pool
+        self.num_workers = num_workers
+        self.decode_processes = decode_processes
+        self.drop_policy = drop_policy
+        self.block_timeout = block_timeout
+        self.metrics_interval = metrics_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        self.decode_pool = None
+        self.metrics_lock = threading.Lock()
+        self.latencies = deque(maxlen=1000) # Seconds from receiving to saving the most recent images
+        self.counters = {"received": 0, "processed": 0, "dropped": 0, "failed": 0, "max_queue_depth": 0}
+        self.messages = {msg_type: MESSAGES.labels(type=msg_type) for msg_type in ("IMG", "SNR", "unknown")}
+        self.images = {outcome: IMAGES.labels(outcome=outcome) for outcome in ("received", "processed", "dropped", "failed")}
 
     def run(self):
-        if not os.path.isdir(self.image_dir):
-            self.logger.critical(f"Image is to be saved at {self.image_dir} but it is not present.")
-            self.logger.critical("Check that the USB is properly mounted and the target directory is correct")
-            raise Exception("Image directory not found!")
+        self.start()
         self.client = mqtt.Client()
         self.client.username_pw_set(self.username, self.password)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.connect(self.mqtt_broker_ip, self.mqtt_port, 60)
         self.client.loop_start()
-        while not self.stop_event.is_set():
-            time.sleep(1)
-            pass
+        # The network thread of paho does the work, this one only wakes up to report the metrics
+        while not self.stop_event.wait(self.metrics_interval or None):
+            self.log_metrics()
         self.client.disconnect()
         self.client.loop_stop()
+        self.stop_workers()
+        self.log_metrics()
         self.logger.info("MQTT Subscriber stopped!")
 
+    def start(self):
+        """Check the image directory and start the ingest workers, after which messages can be handled."""
+        if not os.path.isdir(self.image_dir):
+            self.logger.critical(f"Image is to be saved at {self.image_dir} but it is not present.")
+            self.logger.critical("Check that the USB is properly mounted and the target directory is correct")
+            raise Exception("Image directory not found!")
+        self.image_index = ImageIndex(self.image_dir)
+        self.start_workers()
+
+    def start_workers(self):
+        if self.decode_processes > 0:
+            self.decode_pool = ProcessPoolExecutor(self.decode_processes)
+        self.workers = [threading.Thread(target=self.ingest_worker, daemon=True) for _ in range(self.num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def stop_workers(self):
+        # Let the workers finish the queued images, then stop them with one sentinel each
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown()
+            self.decode_pool = None
+
+    def ingest_worker(self):
+        while True:
+            item = self.queue.get()
+            QUEUE_DEPTH.set(self.queue.qsize())
+            try:
+                if item is None:
+                    break
+                self.decode_image_str(*item)
+            except Exception:
+                self.count("failed")
+                self.logger.exception("Failed to save received image")
+            finally:
+                self.queue.task_done()
+
     def on_connect(self, client, userdata, flags, rc):
         self.logger.info(f"Connected with result code {rc}")
         client.subscribe(self.sensor_topic)
 
     def on_message(self, client, userdata, msg):
-        payload = msg.payload
-        msg_type = payload[:3]
+        payload = memoryview(msg.payload) # Slice the payload without copying it
+        msg_type = bytes(payload[:3])
         if msg_type == b'IMG':
-            self.decode_image_str(payload[3:])
+            self.messages["IMG"].inc()
+            self.count("received")
+            if self.workers:
+                self.enqueue((payload[3:], time.monotonic()))
+            else:
+                self.decode_image_str(payload[3:], time.monotonic())
         elif msg_type == b'SNR':
-            self.update_sensor_data(payload[3:].decode())
+            self.messages["SNR"].inc()
+            self.update_sensor_data(bytes(payload[3:]).decode(), self.topic_device(msg.topic), time.monotonic())
         else:
-            self.logger.error(f"Unknown message type {msg_type} received! Check message definition!")
+            self.messages["unknown"].inc()
+            self.logger.error("Unknown message type %s received! Check message definition!", msg_type)
 
-    def decode_image_str(self, image_string):
-        timestamp = image_string[0:14].decode()
+    def topic_device(self, topic):
+        '''Device id of a sensor node, the part of its topic matched by the wildcard of sensor_topic.'''
+        prefix = self.sensor_topic.rstrip("#")
+        device_id = topic[len(prefix):] if topic.startswith(prefix) else topic
+        return device_id or "default"
+
+    def update_device(self, device_id, kind, values, received, timestamp = None):
+        '''
+        Update the readings of a device, see DeviceState.update, adding the device if it is new. The readings
+        are taken at timestamp if given, such as the capture time of an image, or else when they were received
+        '''
+        taken = timestamp if timestamp is not None else self.clock() - (time.monotonic() - received)
+        device = self.devices.get(device_id)
+        if device is None:
+            with self.devices_lock:
+                device = self.devices.get(device_id)
+                if device is None:
+                    # Only added once it holds its first readings, as retreive reads the devices without a lock
+                    device = DeviceState(device_id, kind)
+                    device.update(values, received, timestamp, taken)
+                    if self.device_ids[kind] is None:
+                        self.device_ids[kind] = (device_id,)
+                    if self.column_prefix(device) is None:
+                        self.logger.warning(f"MQTT device {device_id} is not listed in the {kind}s written, ignoring its readings")
+                    else:
+                        self.logger.info("New MQTT device %s", device_id)
+                    self.devices = {**self.devices, device_id: device}
+                    return True
+        return device.update(values, received, timestamp, taken)
+
+    def column_prefix(self, device):
+        '''
+        Prefix of the columns of a device in the main data buffer, none for the first device of its kind and None
+        for a device whose readings are not written
+        '''
+        device_ids = self.device_ids[device.kind] or ()
+        if device.device_id not in device_ids:
+            return None
+        return "" if device.device_id == device_ids[0] else f"{device.device_id}_"
+
+    def enqueue(self, item):
+        '''Queue an image for the workers, applying the drop policy if the queue is full.'''
+        if self.drop_policy == "drop_oldest":
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    pass
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.count("dropped")
+                    self.logger.warning("Image queue full, dropped the oldest image")
+                except queue.Empty:
+                    pass
+        else:
+            try:
+                self.queue.put(item, block=self.drop_policy == "block", timeout=self.block_timeout)
+            except queue.Full:
+                self.count("dropped")
+                self.logger.warning("Image queue full, dropped the received image")
+                return
+        depth = self.queue.qsize()
+        QUEUE_DEPTH.set(depth)
+        with self.metrics_lock:
+            self.counters["max_queue_depth"] = max(self.counters["max_queue_depth"], depth)
+
+    def decode_image_str(self, image_string, received = None):
+        received = time.monotonic() if received is None else received
+        header = bytes(image_string[:24]).decode()
+        timestamp = header[0:14]
         if all(c == '0' for c in timestamp):
             # Time not set on ESP32CAM, use time of receival instead
-            timestamp = datetime.now(self.timezone).strftime(self.timestamp_format)
-        cam_id = image_string[14:16].decode()
-
-        self.lock.acquire()
-        self.buffer["image"] = cam_id + "_" + timestamp + ".jpg"
-        self.buffer["aec_level"] = image_string[16:21].decode()
-        self.buffer["agc_gain"] = image_string[21:24].decode()
-        image_string = image_string[24:]
-        self.buffer["timestamp"] = timestamp
-        self.lock.release()
-
-        self.logger.debug(f"Decoding image - Camera {cam_id}: {timestamp} |" + \
-                          f" aec: {self.buffer['aec_level']} |" + \
-                          f" agc_gain: {self.buffer['agc_gain']}")
-
-        # Decode the image and save to file
-        image_data = base64.b64decode(image_string)
-        image_bytes = bytes(image_data)
-        image_stream = io.BytesIO(image_bytes)
-        image = Image.open(image_stream)
-        image.save(os.path.join(self.image_dir, self.buffer["image"]))  
-
-    def update_sensor_data(self, msg):
-        self.logger.info(f"Updating sensor data: {msg}")
-
-        self.lock.acquire()
+            epoch = int(self.clock() - (time.monotonic() - received))
+            timestamp = formatEpoch(epoch, self.timezone, self.timestamp_format)
+        else:
+            epoch = toEpoch(timestamp, self.timezone, self.timestamp_format)
+        cam_id = header[14:16]
+        aec_level = header[16:21]
+        agc_gain = header[21:24]
+        filename = cam_id + "_" + timestamp + ".jpg"
+
+        self.logger.debug("Decoding image - Camera %s: %s | aec: %s | agc_gain: %s", cam_id, timestamp, aec_level, agc_gain)
+
+        # Decode the image and save to file. The ESP32CAM already sends JPEG, so unless asked to
+        # re-encode it, only check that it is a complete JPEG and write it as is
+        start = time.perf_counter()
+        if self.decode_pool is not None:
+            image_data = self.decode_pool.submit(decode_image_payload, bytes(image_string[24:]), self.reencode_images).result()
+        else:
+            image_data = decode_image_payload(image_string[24:], self.reencode_images)
+        if image_data is None:
+            self.count("failed")
+            self.logger.error("Image %s is not a complete JPEG, discarding it", filename)
+            return
+        with open(os.path.join(self.image_dir, filename), "wb") as f:
+            f.write(image_data)
+        self.image_index.add(filename)
+        DECODE_SECONDS.observe(time.perf_counter() - start)
+
+        # Workers can finish out of order, so only an image newer than the buffered one replaces it
+        values = {"image": filename, "aec_level": aec_level, "agc_gain": agc_gain}
+        if not self.update_device(cam_id, "camera", values, received, epoch):
+            self.logger.debug("Image %s is older than the buffered image of camera %s", filename, cam_id)
+
+        latency = time.monotonic() - received
+        IMAGE_LATENCY.observe(latency)
+        self.images["processed"].inc()
+        with self.metrics_lock:
+            self.counters["processed"] += 1
+            self.latencies.append(latency)
+
+    def count(self, name):
+        self.images[name].inc()
+        with self.metrics_lock:
+            self.counters[name] += 1
+
+    def metrics(self):
+        '''Ingest counters, current queue depth and the processing latency percentiles of recent images in seconds.'''
+        with self.metrics_lock:
+            metrics = dict(self.counters)
+            latencies = np.array(self.latencies)
+        metrics["queue_depth"] = self.queue.qsize()
+        for q in (50, 95, 100):
+            metrics[f"latency_p{q}"] = float(np.percentile(latencies, q)) if len(latencies) else None
+        return metrics
+
+    def log_metrics(self):
+        metrics = self.metrics()
+        latency = "n/a" if metrics["latency_p50"] is None else \
+            f"{metrics['latency_p50'] * 1000:.1f}/{metrics['latency_p95'] * 1000:.1f}/{metrics['latency_p100'] * 1000:.1f} ms"
+        self.logger.info(f"Images received: {metrics['received']} | processed: {metrics['processed']} |" + \
+                         f" dropped: {metrics['dropped']} | failed: {metrics['failed']} |" + \
+                         f" queue: {metrics['queue_depth']} (max {metrics['max_queue_depth']}) |" + \
+                         f" latency p50/p95/max: {latency}")
+
+    def update_sensor_data(self, msg, device_id = "default", received = None):
+        self.logger.info("Updating sensor data of %s: %s", device_id, msg)
+
+        values = {}
         for data in msg.split(','):
             name, val = data.split(':')
-            self.buffer[name] = int(val)
-        self.lock.release()
+            values[name] = int(val)
+        self.update_device(device_id, "node", values, time.monotonic() if received is None else received)
 
 
+    def reading_time(self):
+        '''Epoch time the newest readings of the devices written were taken, None before any are received.'''
+        return max((device.data["taken"] for device in self.devices.values() if self.column_prefix(device) is not None),
+                   default=None)
+
     def retreive(self, buffer):
-        self.lock.acquire()
-        
-        main_buffer_time = datetime.strptime(str(buffer["timestamp"]), self.timestamp_format)
-        curr_buffer_time = datetime.strptime(str(self.buffer["timestamp"]), self.timestamp_format)
-        dt = (curr_buffer_time - main_buffer_time).seconds
-        dt *= 1 if curr_buffer_time > main_buffer_time else -1
-        self.logger.debug(f"Time between main buffer and current buffer: {dt}s")
-        if dt > self.delay_tolerance:
-            self.logger.warning(f"Data in main buffer outdated by >{self.delay_tolerance}s!")
-            for key in buffer:
-                if key != "timestamp":
-                    buffer[key] = None
-
-        if dt >= 0:
-            for key in self.buffer:
-                if key not in buffer:
-                    self.logger.error(f"Key {key} not found in main data buffer!")
-                buffer[key] = self.buffer[key]
-        
-        self.lock.release()
+        '''
+        Copy the readings of the devices written into the main data buffer. The first of cameras and of sensor_nodes
+        fill the columns of their fields, such as image and amb, and every other device its own columns prefixed
+        with its id, such as 02_image, written from the first row on so that the columns of the rows do not change.
+        The readings of a device not heard from within delay_tolerance seconds are cleared. The main timestamp is
+        advanced to the newest camera timestamp.
+        '''
+        now = time.monotonic()
+        merged = dict.fromkeys(FIELDS)
+        for kind, device_ids in self.device_ids.items():
+            for device_id in (device_ids or ())[1:]:
+                merged.update(dict.fromkeys(f"{device_id}_{key}" for key in DEVICE_FIELDS[kind]))
+        outdated = []
+        written = 0
+        for device_id, device in self.devices.items():
+            prefix = self.column_prefix(device)
+            if prefix is None:
+                continue
+            data = device.data
+            age = now - data["received"]
+            if age > self.delay_tolerance:
+                outdated.append(device_id)
+                continue
+            written += 1
+            for key, value in data.items():
+                if key in ("timestamp", "received", "taken"):
+                    continue
+                if key not in buffer and prefix + key not in merged:
+                    self.logger.error(f"Key {key} of {device_id} not found in main data buffer!")
+                merged[prefix + key] = value
+            timestamp = data["timestamp"]
+            if timestamp is not None and timestamp >= merged.get("timestamp", buffer["timestamp"]):
+                merged["timestamp"] = timestamp
+        if outdated:
+            self.logger.warning(f"Data of {', '.join(outdated)} outdated by >{self.delay_tolerance}s!")
+
+        buffer.update(merged)
+        self.logger.debug("Merged readings of %d/%d MQTT devices", written, len(self.devices))
 
@@ -3,9 +3,92 @@ from zoneinfo import ZoneInfo
 from bleak import BleakClient, BleakScanner, BleakError
 import struct
 import asyncio
+import functools
+import time
+from collections import deque
 from logger import Logger
+from metrics import REGISTRY
 from datetime import datetime
 import sys
+import numpy as np
+
+POLL_SECONDS = REGISTRY.histogram("ble_poll_seconds", "Seconds taken to read all characteristics of a board", ("device",))
+NOTIFICATIONS = REGISTRY.counter("ble_notifications_total", "IMU notifications received from a board", ("device",))
+CONNECTS = REGISTRY.counter("ble_connects_total", "Connection attempts to a board", ("device",))
+FAILURES = REGISTRY.counter("ble_failures_total", "Failed connection attempts and lost connections of a board", ("device",))
+RECONNECT_SECONDS = REGISTRY.histogram("ble_reconnect_seconds", "Seconds from losing a board to connecting to it again",
+                                       ("device",))
+
+def stop_future(stop_event):
+    '''
+    Future of the running event loop that is resolved once the threading stop_event is set, so that
+    coroutines can wait for it without polling. A daemon thread blocks on the event until then
+    '''
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def notify():
+        stop_event.wait()
+        try:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+        except RuntimeError:
+            pass # The event loop has already been closed
+
+    threading.Thread(target=notify, daemon=True).start()
+    return future
+
+class RingBuffer:
+    def __init__(self, capacity, width):
+        '''
+            Fixed-size buffer of the latest timestamped samples of a vector stream, preallocated so that its
+            memory does not grow with the sample rate or the run time
+            capacity: Number of samples kept
+            width: Number of values per sample
+        '''
+        self.capacity = capacity
+        self.times = np.full(capacity, np.nan)
+        self.values = np.zeros((capacity, width))
+        self.count = 0 # Samples appended in total, the next one goes to count % capacity
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.values.nbytes
+
+    def append(self, timestamp, values):
+        with self.lock:
+            i = self.count % self.capacity
+            self.times[i] = timestamp
+            self.values[i] = values
+            self.count += 1
+
+    def latest(self):
+        '''The latest sample as a tuple, or None if there is none.'''
+        with self.lock:
+            if self.count == 0:
+                return None
+            return tuple(self.values[(self.count - 1) % self.capacity].tolist())
+
+    def stats(self, seconds, now = None):
+        '''
+        Number of samples, per-axis mean and variance and the largest vector magnitude of the samples
+        received in the last seconds, with None for the statistics if there are no samples
+        '''
+        now = time.time() if now is None else now
+        with self.lock:
+            n = len(self)
+            values = self.values[:n][self.times[:n] >= now - seconds]
+        if len(values) == 0:
+            return {"count": 0, "mean": None, "var": None, "max_magnitude": None}
+        return {
+            "count": len(values),
+            "mean": tuple(values.mean(axis=0).tolist()),
+            "var": tuple(values.var(axis=0).tolist()),
+            "max_magnitude": float(np.sqrt(np.einsum("ij,ij->i", values, values).max())),
+        }
 
 class BLEClient:
     def __init__(self,
@@ -15,7 +98,10 @@ class BLEClient:
                  timezone = ZoneInfo("Asia/Singapore"),
                  delay_tolerance = 600,
                  log_level = "INFO",
-                 stop_event = None):
+                 stop_event = None,
+                 parallel_reads = True,
+                 notif_buffer_size = 6000,
+                 clock = time.time):
         '''
             Wrapper class for BLE communication with NiclaSenseME
             polling_interval: Interval between each polling in seconds
@@ -26,10 +112,14 @@ class BLEClient:
                 if delay exceeds this value, previous sensor readings by other sensors will be discarded
             log_level: Logging level
             stop_event: Synchronization signal for stopping the BLEClient
+            parallel_reads: Issue the reads of all characteristics at once instead of one after another
+            notif_buffer_size: Number of notifications kept per IMU characteristic, 60 s at 100 Hz by default
+            clock: Function returning the current epoch time, for the timestamp of the readings
         '''
         self.polling_interval = polling_interval
         self.timestamp_format = timestamp_format
         self.timezone = timezone
+        self.clock = clock
         self.device_name = dev_name
         self.sensor_map = {
             "temp" : (BLEClient.formatUUID("2001"), "<f"),
@@ -44,7 +134,7 @@ class BLEClient:
             "quat" : (BLEClient.formatUUID("7001"), "<ffff"),
         }
         self.buffer = {
-            "timestamp" : 20250101000000,
+            "timestamp" : int(datetime(2025, 1, 1, tzinfo=timezone).timestamp()), # Epoch seconds
             "temp" : 0,
             "humidity" : 0,
             "pressure" : 0,
@@ -53,12 +143,29 @@ class BLEClient:
             "accel" : (0, 0, 0),
             "gyro" : (0, 0, 0),
             "quat" : (0, 0, 0, 0),
-        }
+        } # Latest readings, replaced as a whole by every poll and never modified once published
         self.device = None
         self.logger = Logger("BLEClient", log_level).get()
         self.stop_event = stop_event
+        self.stopped = None # Future of stop_event in the running event loop, see wait
         self.delay_tolerance = delay_tolerance
-        self.lock = threading.Lock()
+        self.parallel_reads = parallel_reads
+        # Ring buffer of timestamped samples per IMU characteristic, filled by notifications
+        self.notif_buffers = {sensor: RingBuffer(notif_buffer_size, struct.calcsize(fmt) // 4)
+                              for sensor, (_, fmt) in self.sensorMapNotif.items()}
+        self.poll_latencies = deque(maxlen=100) # Seconds taken by the most recent polls
+        self.poll_count = 0
+        self.read_time = None # Epoch time the published readings were polled at
+
+        # Link metrics
+        self.connects = 0
+        self.failures = 0
+        self.last_poll = None # Monotonic time of the last poll
+        self.disconnected_at = None # Monotonic time the link was found to be down, None while it is up
+        self.reconnect_times = deque(maxlen=100) # Seconds from finding the link down to connecting again
+        self.gap_durations = deque(maxlen=100) # Seconds between the last poll before and the first poll after an outage
+        self.metrics = {metric.name: metric.labels(device=self.device_name)
+                        for metric in (POLL_SECONDS, NOTIFICATIONS, CONNECTS, FAILURES, RECONNECT_SECONDS)}
 
     @staticmethod
     def formatUUID(id):
@@ -72,14 +179,23 @@ class BLEClient:
     def run(self):
         asyncio.run(self.main())
     
-    def retreive(self, buffer):
-        self.lock.acquire()
-        
-        main_buffer_time = datetime.strptime(str(buffer["timestamp"]), self.timestamp_format)
-        curr_buffer_time = datetime.strptime(str(self.buffer["timestamp"]), self.timestamp_format)
-        dt = (curr_buffer_time - main_buffer_time).seconds
-        dt *= 1 if curr_buffer_time > main_buffer_time else -1
-        self.logger.debug(f"Time between main buffer and current buffer: {dt}s")
+    def retreive(self, buffer, window = None):
+        '''
+        Copy the latest readings into the main data buffer. If window is given, also add the statistics
+        of the IMU samples received in the last window seconds as {sensor}_mean, {sensor}_var and {sensor}_max
+        '''
+        if window is not None:
+            for sensor, stats in self.imu_stats(window).items():
+                buffer[f"{sensor}_mean"] = stats["mean"]
+                buffer[f"{sensor}_var"] = stats["var"]
+                buffer[f"{sensor}_max"] = stats["max_magnitude"]
+
+        # The readings are taken from one published snapshot, without waiting for a poll in progress
+        snapshot = self.buffer
+
+        # Both timestamps are epoch seconds, so the difference is signed and does not wrap after a day
+        dt = snapshot["timestamp"] - buffer["timestamp"]
+        self.logger.debug("Time between main buffer and current buffer: %ds", dt)
 
         if dt >= 0:
             if dt > self.delay_tolerance:
@@ -87,12 +203,10 @@ class BLEClient:
                 for key in buffer:
                     if key != "timestamp":
                         buffer[key] = None
-            for key in self.buffer:
+            for key, value in snapshot.items():
                 if key not in buffer:
                     self.logger.error(f"Key {key} not found in main data buffer!")
-                buffer[key] = self.buffer[key]
-
-        self.lock.release()
+                buffer[key] = value
             
     async def find_nicla_device(self):
         self.device = await BleakScanner.find_device_by_name(self.device_name)
@@ -103,60 +217,270 @@ class BLEClient:
             self.logger.info(f"Device {self.device_name} found!")
             return self.device
 
+    def imu_stats(self, window, now = None):
+        """Statistics of the IMU samples received in the last window seconds, see RingBuffer.stats."""
+        return {sensor: notifs.stats(window, now) for sensor, notifs in self.notif_buffers.items()}
+
     def notif_handler(self, sender, data, sensor_name, data_format):
         """Handle incoming notifications."""
-        self.buffer[sensor_name] = struct.unpack(data_format, data)
+        # The IMU characteristics are vectors of float32, written straight into the ring buffer
+        self.notif_buffers[sensor_name].append(time.time(), np.frombuffer(data, dtype="<f4"))
+        self.metrics["ble_notifications_total"].inc()
+
+    async def subscribe(self, client):
+        """Subscribe to the IMU notifications, once per connection."""
+        for sensor, (uuid, fmt) in self.sensorMapNotif.items():
+            await client.start_notify(uuid, functools.partial(self.notif_handler, sensor_name=sensor, data_format=fmt))
+
+    async def poll(self, client):
+        """Read all characteristics and update the buffer with them and the latest notified IMU values."""
+        # Timestamp of data is taken at the start of polling
+        read_time = self.clock()
+        start_time = int(read_time)
+        start = time.perf_counter()
+        uuids = [uuid for uuid, _ in self.sensor_map.values()]
+        if self.parallel_reads:
+            data = await asyncio.gather(*(client.read_gatt_char(uuid) for uuid in uuids))
+        else:
+            data = [await client.read_gatt_char(uuid) for uuid in uuids]
+        values = {sensor: struct.unpack(fmt, d)[0] for (sensor, (_, fmt)), d in zip(self.sensor_map.items(), data)}
+        for sensor, notifs in self.notif_buffers.items():
+            if len(notifs):
+                values[sensor] = notifs.latest()
+
+        # A new snapshot with the values and their timestamp is published by a single reference assignment,
+        # so that readers never see a partial update
+        snapshot = dict(self.buffer)
+        snapshot.update(values)
+        snapshot["timestamp"] = start_time
+        self.buffer = snapshot
+        # Published after the readings, so a reader seeing the new read_time finds the new readings too
+        self.read_time = read_time
+        latency = time.perf_counter() - start
+        self.poll_latencies.append(latency)
+        self.metrics["ble_poll_seconds"].observe(latency)
+        self.poll_count += 1
+        now = time.monotonic()
+        if self.disconnected_at is not None:
+            if self.last_poll is not None:
+                self.gap_durations.append(now - self.last_poll)
+            self.disconnected_at = None
+        self.last_poll = now
+
+    async def session(self, device, client_class = BleakClient):
+        """Connect to the device, subscribe to its notifications and poll it until stopped or disconnected."""
+        async with client_class(device) as client:
+            self.logger.info("Connected to %s", self.device_name)
+            if self.disconnected_at is not None:
+                self.reconnect_times.append(time.monotonic() - self.disconnected_at)
+                self.metrics["ble_reconnect_seconds"].observe(self.reconnect_times[-1])
+            await self.subscribe(client)
+            while not self.stop_event.is_set():
+                await self.poll(client)
+
+                self.logger.info("Received update from %s in %.0f ms", self.device_name, self.poll_latencies[-1] * 1000)
+                # One record for the whole snapshot, only formatted if debug records are emitted
+                self.logger.debug("Readings of %s: %s", self.device_name, self.buffer)
+
+                if await self.wait(self.polling_interval):
+                    break
+
+    async def maintain(self,
+                       device = None,
+                       scanner = BleakScanner,
+                       client_class = BleakClient,
+                       backoff_initial = 1,
+                       backoff_max = 60,
+                       rescan_after = 3,
+                       scan_timeout = 10):
+        '''
+        Keep the device connected and polled until stopped. The device found by the last scan is reconnected
+        to directly, and only scanned for again after rescan_after consecutive failed attempts. Attempts are
+        retried with exponential backoff, from backoff_initial up to backoff_max seconds
+        '''
+        self.device = device
+        backoff = backoff_initial
+        attempts = 0 # Consecutive failed attempts
+        while not self.stop_event.is_set():
+            polls = self.poll_count
+            try:
+                if self.device is None:
+                    self.logger.debug("Scanning for %s...", self.device_name)
+                    self.device = await scanner.find_device_by_name(self.device_name, timeout=scan_timeout)
+                    if self.device is None:
+                        raise BleakError(f"Device {self.device_name} not found")
+                self.logger.debug("Connecting to %s at %s...", self.device_name, self.device.address)
+                self.connects += 1
+                self.metrics["ble_connects_total"].inc()
+                await self.session(self.device, client_class)
+            except (BleakError, asyncio.TimeoutError, OSError) as e:
+                # Failures of the link are retried, any other error is a bug and stops the client
+                self.failures += 1
+                self.metrics["ble_failures_total"].inc()
+                if self.disconnected_at is None:
+                    self.disconnected_at = time.monotonic()
+                if self.poll_count > polls:
+                    # The connection was working, so start over
+                    backoff = backoff_initial
+                    attempts = 0
+                attempts += 1
+                if attempts >= rescan_after:
+                    self.device = None
+                    attempts = 0
+                if isinstance(e, asyncio.TimeoutError):
+                    self.logger.warning(f"BLE Connection Timeout error, retrying in {backoff}s")
+                else:
+                    self.logger.error(f"Error during BLE communication with {self.device_name}: {e}, retrying in {backoff}s")
+                await self.wait(backoff)
+                backoff = min(backoff * 2, backoff_max)
+
+    async def wait(self, seconds):
+        '''Sleep for the given seconds or until stopped, returning whether it was stopped.'''
+        loop = asyncio.get_running_loop()
+        if self.stopped is None or self.stopped.get_loop() is not loop:
+            self.stopped = stop_future(self.stop_event)
+        try:
+            await asyncio.wait_for(asyncio.shield(self.stopped), seconds)
+        except asyncio.TimeoutError:
+            pass
+        return self.stop_event.is_set()
+
+    def link_metrics(self):
+        """Connection counts and the mean and longest reconnect times and data gaps in seconds."""
+        metrics = {"connects": self.connects, "failures": self.failures, "polls": self.poll_count}
+        for name, values in (("reconnect", self.reconnect_times), ("gap", self.gap_durations)):
+            metrics[f"{name}_mean"] = float(np.mean(values)) if values else None
+            metrics[f"{name}_max"] = float(np.max(values)) if values else None
+        return metrics
 
     async def listen_to_device(self, device):
         """Connect to the BLE device and listen for data."""
         try:
-            while not self.stop_event.is_set():
-                try:
-                    self.logger.debug("Connecting to device...")
-                    self.device = await BleakScanner.find_device_by_name(self.device_name)
-                    async with BleakClient(self.device) as client:
-                        self.logger.info(f"Connected to {self.device_name}")                        
-                        while not self.stop_event.is_set():
-
-                            # Timestamp of data is taken at the start of polling
-                            start_time = datetime.now(self.timezone)
-                            self.lock.acquire()
-
-                            for sensor, (uuid, fmt) in self.sensor_map.items():
-                                data = await client.read_gatt_char(uuid)
-                                value = struct.unpack(fmt, data)[0]
-                                self.buffer[sensor] = value
-
-                            for sensor, (uuid, fmt) in self.sensorMapNotif.items():
-                                await client.start_notify(
-                                    uuid, 
-                                    lambda x, y : self.notif_handler(x, 
-                                                                     y, 
-                                                                     sensor_name=sensor, 
-                                                                     data_format=fmt))
-                                await client.stop_notify(uuid)
-
-                            # Timestamp is updated at the end of polling to ensure all
-                            # values has already been updated
-                            self.buffer["timestamp"] = start_time.strftime(self.timestamp_format)
-                            self.lock.release()
-
-                            self.logger.info("Received update from NiclaSenseME")
-                            for sensor, value in self.buffer.items():
-                                self.logger.debug(f"{sensor}: {value}")
-                            self.logger.debug("--------------------------------")
-                            
-                            for _ in range(self.polling_interval * 2):
-                                if self.stop_event.is_set():
-                                    break
-                                await asyncio.sleep(0.5)  # Adjust polling interval
-
-                except BleakError as e:
-                    self.logger.error(f"Error during BLE communication: {e}")
-                except TimeoutError as e:
-                    self.logger.warning(f"BLE Connection Timeout error")
-
+            await self.maintain(device)
         except asyncio.CancelledError:
             self.logger.info("Listening task canceled, cleaning up...")           
         finally:
             self.logger.debug("BLEClient stopped!")
+
+class BLEManager:
+    def __init__(self,
+                 dev_names = ("NiclaSenseME-B806",),
+                 polling_interval = 10,
+                 timestamp_format = "%Y%m%d%H%M%S",
+                 timezone = ZoneInfo("Asia/Singapore"),
+                 delay_tolerance = 600,
+                 log_level = "INFO",
+                 stop_event = None,
+                 scan_timeout = 10,
+                 backoff_initial = 1,
+                 backoff_max = 60,
+                 rescan_after = 3,
+                 scanner = BleakScanner,
+                 client_class = BleakClient,
+                 **client_kwargs):
+        '''
+            Polls several NiclaSenseME boards from one event loop. The boards are found with one scan and
+            connected to concurrently, each by its own task, so that a board failing to connect is retried
+            with exponential backoff without holding up the others
+            dev_names: Names of the BLE devices
+            polling_interval, timestamp_format, timezone, delay_tolerance, log_level, stop_event: See BLEClient
+            scan_timeout: Seconds to scan for the devices
+            backoff_initial: Seconds to wait before the first reconnection attempt of a device
+            backoff_max: Longest wait between reconnection attempts, the wait doubles after every failure
+            rescan_after: Consecutive failed attempts to connect to a device directly before scanning for it again
+            scanner: BleakScanner or a replacement providing discover and find_device_by_name
+            client_class: BleakClient or a replacement, called with the device to connect to
+            client_kwargs: Further arguments of BLEClient
+        '''
+        self.clients = {name: BLEClient(polling_interval = polling_interval,
+                                        dev_name = name,
+                                        timestamp_format = timestamp_format,
+                                        timezone = timezone,
+                                        delay_tolerance = delay_tolerance,
+                                        log_level = log_level,
+                                        stop_event = stop_event,
+                                        **client_kwargs) for name in dev_names}
+        self.scan_timeout = scan_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.rescan_after = rescan_after
+        self.scanner = scanner
+        self.client_class = client_class
+        self.stop_event = stop_event
+        self.logger = Logger("BLEManager", log_level).get()
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        found = await self.scan()
+        await asyncio.gather(*(self.maintain(name, found.get(name)) for name in self.clients))
+        self.logger.debug("BLEManager stopped!")
+
+    async def scan(self):
+        """Scan once for all devices, returning the devices found by name."""
+        devices = await self.scanner.discover(timeout=self.scan_timeout)
+        found = {device.name: device for device in devices if device.name in self.clients}
+        for name in self.clients:
+            if name in found:
+                self.logger.info(f"Device {name} found!")
+            else:
+                self.logger.warning(f"Device {name} not found, will retry")
+        return found
+
+    async def maintain(self, name, device):
+        """
+        Keep one device connected and polled, see BLEClient.maintain. An unexpected error of a device is logged
+        and its client restarted after backoff_max seconds, so that one device cannot stop the others
+        """
+        client = self.clients[name]
+        while not self.stop_event.is_set():
+            try:
+                await client.maintain(device,
+                                      scanner = self.scanner,
+                                      client_class = self.client_class,
+                                      backoff_initial = self.backoff_initial,
+                                      backoff_max = self.backoff_max,
+                                      rescan_after = self.rescan_after,
+                                      scan_timeout = self.scan_timeout)
+            except Exception:
+                self.logger.exception(f"Unexpected error polling {name}, restarting it in {self.backoff_max}s")
+                device = client.device # Reconnect to the device last found
+                if await client.wait(self.backoff_max):
+                    break
+
+    def link_metrics(self):
+        return {name: client.link_metrics() for name, client in self.clients.items()}
+
+    def column_prefix(self, name):
+        '''Prefix of the columns of a device in the main data buffer, none for the first of dev_names.'''
+        return "" if name == next(iter(self.clients)) else f"{name}_"
+
+    def reading_time(self):
+        '''Epoch time the newest readings of the devices were polled at, None before the first poll.'''
+        return max((client.read_time for client in self.clients.values() if client.read_time is not None), default=None)
+
+    def retreive(self, buffer, window = None, device = None):
+        '''
+        Copy the readings of every device into the main data buffer as BLEClient.retreive does, or only those
+        of device. The first of dev_names fills the columns of the readings, such as temp, and every other device
+        its own columns prefixed with its name, such as NiclaSenseME-B807_temp, written from the first row on so
+        that the columns of the rows do not change. The timestamp is that of the most recent readings copied
+        '''
+        if device is not None:
+            self.clients[device].retreive(buffer, window)
+            return
+        timestamp = buffer["timestamp"]
+        for name, client in self.clients.items():
+            prefix = self.column_prefix(name)
+            if not prefix:
+                client.retreive(buffer, window)
+                continue
+            readings = {key: buffer.get(prefix + key) for key in client.buffer}
+            readings["timestamp"] = timestamp
+            client.retreive(readings, window)
+            for key, value in readings.items():
+                if key == "timestamp":
+                    buffer["timestamp"] = max(buffer["timestamp"], value)
+                else:
+                    buffer[prefix + key] = value
@@ -1,7 +1,9 @@
 import os
 from picamera2 import Picamera2
 import time
+from concurrent.futures import ThreadPoolExecutor
 from logger import Logger
+from image_index import ImageIndex
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
@@ -13,8 +15,30 @@ class PiCam:
                  location_id = "00",
                  timestamp_format = "%Y%m%d%H%M%S",
                  timezone = ZoneInfo("Asia/Singapore"),
-                 log_level="INFO"):
-        self.picam2 = Picamera2()
+                 log_level="INFO",
+                 pipelined = False,
+                 settle_frames = 2,
+                 settle_tolerance = 0.02,
+                 settle_timeout = 2,
+                 camera = None,
+                 clock = time.time):
+        '''
+            Raspberry Pi camera capturing EV-bracketed stills
+            image_dir: Directory the images are saved to
+            location_id: Prefix of the image file names
+            timestamp_format: Format of the timestamp in the image file names
+            timezone: Timezone for formatting timestamp
+            log_level: Logging level
+            pipelined: Capture brackets by waiting for the exposure to settle, capturing from the running still
+                configuration and encoding and writing each frame in the background while the next exposure
+                settles. Otherwise each frame waits a fixed second and is captured with a mode switch
+            settle_frames: Frames to skip after changing the exposure value before checking for convergence
+            settle_tolerance: Largest relative change of the total exposure between frames for it to count as settled
+            settle_timeout: Seconds to wait for the exposure to settle before capturing anyway
+            camera: Picamera2 instance to use instead of opening the camera
+            clock: Function returning the current epoch time, for the file names and capture times
+        '''
+        self.picam2 = camera if camera is not None else Picamera2()
         self.still_config = self.picam2.create_still_configuration(
                                 main={"size": (1280, 1024)},  # Set resolution to SXGA
                                 display=None  # Disable preview display
@@ -22,19 +46,30 @@ class PiCam:
         self.picam2.configure(self.still_config)
         self.logger = Logger("PiCam", log_level).get()
         self.image_dir = image_dir
+        self.image_index = ImageIndex(image_dir)
         self.timestamp_format = timestamp_format
         self.location_id = location_id
         self.timezone = timezone
+        self.clock = clock
         self.image_format = self.picam2.stream_configuration("main")
+        self.pipelined = pipelined
+        self.settle_frames = settle_frames
+        self.settle_tolerance = settle_tolerance
+        self.settle_timeout = settle_timeout
+        self.writer = ThreadPoolExecutor(max_workers=1) # Encodes and writes the pipelined captures
+        self.last_timestamp = None
+        self.same_timestamp = 0 # Captures with the same timestamp so far, to keep their file names apart
         self.picam2.start()
         time.sleep(1)
 
-    def ev_bracketing_capture(self, min, max, num_frames):
+    def ev_bracketing_capture(self, min, max, num_frames, pipelined = None):
         interval = None
         if num_frames == 1:
             interval = int((max - min) / 2)
         else:
             interval = int((max - min) / (num_frames - 1))
+        if self.pipelined if pipelined is None else pipelined:
+            return self.pipelined_bracket([min + i * interval for i in range(num_frames)])
         metadatas = []
         for i in range(num_frames):
             
@@ -50,16 +85,97 @@ class PiCam:
 
         return metadatas
 
+    def pipelined_bracket(self, evs):
+        '''
+        Capture a frame at each exposure value, waiting only for the exposure to settle. Frames are encoded
+        and written in the background and all of them are on disk when this returns.
+        '''
+        metadatas = []
+        writes = []
+        for ev in evs:
+            self.picam2.set_controls({"ExposureValue": ev})
+            if not self.wait_for_exposure():
+                self.logger.warning(f"Exposure did not settle within {self.settle_timeout}s for EV {ev}, capturing anyway")
+
+            self.logger.debug(f"Capturing image with EV {ev}")
+            metadata, write = self.capture_pipelined()
+            metadata["ev"] = ev
+            metadatas.append(metadata)
+            writes.append(write)
+        for write in writes:
+            write.result()
+        return metadatas
+
+    def wait_for_exposure(self):
+        '''
+        Wait for the auto exposure to converge after a change of the controls: skip the frames the change
+        may not have reached yet, then wait for a locked AE with a stable total exposure. Returns False on timeout
+        '''
+        deadline = time.monotonic() + self.settle_timeout
+        previous = None
+        frame = 0
+        while True:
+            metadata = self.picam2.capture_metadata()
+            exposure = metadata["ExposureTime"] * metadata["AnalogueGain"] * metadata.get("DigitalGain", 1)
+            if frame >= self.settle_frames and metadata.get("AeLocked") and previous is not None \
+                    and abs(exposure - previous) <= self.settle_tolerance * previous:
+                return True
+            if time.monotonic() > deadline:
+                return False
+            previous = exposure
+            frame += 1
+
+    def capture_pipelined(self):
+        '''
+        Capture a frame from the running still configuration without a mode switch, returning its
+        metadata and the future of its background write
+        '''
+        timestamp = datetime.fromtimestamp(self.clock(), self.timezone).strftime(self.timestamp_format)
+        filename = self.unique_filename(timestamp)
+        request = self.picam2.capture_request()
+        capture_time = self.clock()
+        try:
+            image = request.make_image("main")
+            metadata = request.get_metadata()
+        finally:
+            request.release() # Hand the buffer back to the camera before the slow encode
+        write = self.writer.submit(self.save, image, dict(metadata), filename)
+
+        metadata["captureTimestamp"] = timestamp
+        metadata["captureTime"] = capture_time # Epoch time for pairing with sensor readings, not a column
+        metadata["image_format"] = self.image_format
+        metadata["image"] = filename
+        self.logger.debug(metadata)
+        self.logger.debug("--------------------------")
+        return metadata, write
+
+    def save(self, image, metadata, filename):
+        self.picam2.helpers.save(image, metadata, os.path.join(self.image_dir, filename))
+        self.image_index.add(filename)
+        self.logger.info(f"Captured: {filename}")
+
+    def unique_filename(self, timestamp):
+        # Frames no longer take a second each, so number the ones sharing a timestamp after the first
+        if timestamp == self.last_timestamp:
+            self.same_timestamp += 1
+            return f"{self.location_id}_{timestamp}_{self.same_timestamp}.jpg"
+        self.last_timestamp = timestamp
+        self.same_timestamp = 0
+        return f"{self.location_id}_{timestamp}.jpg"
+
     def capture(self, **kwargs):
-        timestamp = datetime.now(self.timezone).strftime(self.timestamp_format)
+        timestamp = datetime.fromtimestamp(self.clock(), self.timezone).strftime(self.timestamp_format)
         filename = f"{self.location_id}_{timestamp}.jpg"
         full_filename = os.path.join(self.image_dir, filename)
         
         job = self.picam2.switch_mode_and_capture_file(self.still_config, full_filename, wait=False)
         metadata = self.picam2.wait(job)
+        capture_time = self.clock()
+        self.image_index.add(filename)
 
         self.logger.info(f"Captured: {filename}")
         metadata["captureTimestamp"] = timestamp
+        metadata["captureTime"] = capture_time # Epoch time for pairing with sensor readings, not a column
         metadata["image_format"] = self.image_format
         metadata["image"] = filename
         self.logger.debug(metadata)
@@ -67,5 +183,6 @@ class PiCam:
         return metadata
 
     def close(self):
+        self.writer.shutdown()
         self.picam2.stop()
 
@@ -0,0 +1,308 @@
+import argparse
+import base64
+import bisect
+import csv
+import importlib
+import io
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+from types import ModuleType, SimpleNamespace
+import numpy as np
+from PIL import Image
+from tzlocal import get_localzone
+from fakes import FakeBleakBackend, FakePicamera2
+from mqtt_sub import MQTTSubscriber
+from data_utils import TIMESTAMP_FORMAT, parseTimestamps, toEpoch
+from storage import parseCell
+
+DIR_PATH = os.path.dirname(os.path.abspath(__file__))
+HARDWARE_MODULES = ("picamera2", "apds9960", "apds9960.const", "smbus2")
+# Columns of data.csv that come from the Picamera2 metadata
+CAMERA_COLUMNS = ["AeLocked", "SensorTemperature", "SensorBlackLevels", "AnalogueGain", "ColourCorrectionMatrix",
+                  "FocusFoM", "ColourTemperature", "ColourGains", "AfPauseState", "SensorTimestamp", "Lux",
+                  "ScalerCrop", "LensPosition", "FrameDuration", "ExposureTime", "AfState", "DigitalGain"]
+# Columns of data.csv read from the APDS9960 and NiclaSenseME, checked against the recording by verify
+SENSOR_COLUMNS = ["amb", "r", "g", "b", "temp", "pressure", "humidity", "gas", "co2"]
+BLE_POLL_PERIOD = 10 # Seconds of replay time a NiclaSenseME poll takes, standing in for the polling interval
+
+def install_hardware_placeholders():
+    '''
+    Register placeholder modules for the hardware libraries that are not installed, so that server.py can be
+    imported without them. Creating anything from a placeholder fails, the replay components are used instead
+    '''
+    for name in HARDWARE_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            module = ModuleType(name)
+
+            def missing(attr, name=name):
+                if attr.startswith("__"):
+                    raise AttributeError(attr)
+
+                class Missing:
+                    def __init__(self, *args, **kwargs):
+                        raise ImportError(f"{name} is not installed, {name}.{attr} is only available on the Raspberry Pi")
+                return Missing
+            module.__getattr__ = missing
+            sys.modules[name] = module
+
+def replayValue(value):
+    '''Parse a cell of data.csv like storage.parseCell, converting numbers to int or float.'''
+    value = parseCell(value)
+    if isinstance(value, str):
+        for convert in (int, float):
+            try:
+                return convert(value)
+            except ValueError:
+                pass
+    return value
+
+class Recording:
+    def __init__(self, csv_path, timestamp_format = "%Y%m%d%H%M%S", timezone = None):
+        '''
+            Rows of a data.csv in capture order, looked up by the time they were captured
+            csv_path: data.csv to replay
+            timestamp_format: Format of captureTimestamp
+            timezone: Timezone of captureTimestamp, local time if None
+        '''
+        with open(csv_path, "r", encoding="utf-8", newline="") as f:
+            rows = [{key: replayValue(value) for key, value in row.items()} for row in csv.DictReader(f)]
+        if timestamp_format == TIMESTAMP_FORMAT:
+            times = parseTimestamps([str(row["captureTimestamp"]) for row in rows], timezone).tolist()
+        else:
+            times = [datetime.strptime(str(row["captureTimestamp"]), timestamp_format).replace(tzinfo=timezone).timestamp()
+                     for row in rows]
+        order = np.argsort(times, kind="stable")
+        self.rows = [rows[i] for i in order]
+        self.times = [times[i] for i in order]
+        self.start = self.times[0]
+        self.end = self.times[-1]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def row_at(self, epoch):
+        '''The last row captured at or before epoch, or the first row before the recording starts.'''
+        return self.rows[max(bisect.bisect_right(self.times, epoch) - 1, 0)]
+
+    def rows_between(self, start, end):
+        '''The rows captured between the epochs start and end, with the last row captured before start.'''
+        return self.rows[max(bisect.bisect_right(self.times, start) - 1, 0):bisect.bisect_right(self.times, end)]
+
+class ReplayClock:
+    def __init__(self, start, speed = 1000):
+        '''
+            Replay time, starting at epoch start and running speed times faster than real time
+        '''
+        self.start = start
+        self.speed = speed
+        self.started = time.monotonic()
+
+    def now(self):
+        return self.start + (time.monotonic() - self.started) * self.speed
+
+    def real(self, seconds):
+        '''Real seconds taking seconds of replay time.'''
+        return seconds / self.speed
+
+def recorded_metadata(recording, clock):
+    '''Function returning the camera metadata of the recorded row at the replay time, see FakePicamera2.'''
+    def metadata():
+        row = recording.row_at(clock.now())
+        return {column: row[column] for column in CAMERA_COLUMNS if column in row}
+    return metadata
+
+class ReplayAPDS9960:
+    def __init__(self, recording, clock):
+        '''Stand-in for APDS9960Reader returning the recorded ambient light readings.'''
+        self.recording = recording
+        self.clock = clock
+
+    def retrieve(self, buffer):
+        row = self.recording.row_at(self.clock.now())
+        for key in ("amb", "r", "g", "b"):
+            buffer[key] = row[key]
+        return buffer
+
+class ReplayMQTTSubscriber(MQTTSubscriber):
+    def __init__(self, recording, clock, image_period = 60, **kwargs):
+        '''MQTTSubscriber on the replay clock receiving an ESP32CAM image every image_period seconds of replay time instead of a broker.'''
+        super().__init__(clock=clock.now, **kwargs)
+        self.recording = recording
+        self.replay_clock = clock
+        self.image_period = image_period
+        stream = io.BytesIO()
+        Image.new("RGB", (320, 240), (128, 128, 128)).save(stream, format="JPEG")
+        self.payload = base64.b64encode(stream.getvalue())
+
+    def run(self):
+        self.start()
+        while not self.stop_event.wait(self.replay_clock.real(self.image_period)):
+            row = self.recording.row_at(self.replay_clock.now())
+            timestamp = str(row["timestamp"]).replace("_base", "")
+            payload = b"IMG" + f"{timestamp}0100100020".encode() + self.payload
+            self.on_message(None, None, SimpleNamespace(topic="sensor/cam01", payload=payload))
+        self.stop_workers()
+
+def recorded_characteristics(recording, clock, sensor_map, notif_map):
+    '''
+    Function returning the value of a NiclaSenseME characteristic by uuid, as the board would send the recorded
+    reading at the replay time, see FakeBleakBackend
+    sensor_map, notif_map: BLEClient.sensor_map and BLEClient.sensorMapNotif
+    '''
+    characteristics = {uuid: (sensor, fmt) for sensor, (uuid, fmt) in {**sensor_map, **notif_map}.items()}
+
+    def value(uuid):
+        sensor, fmt = characteristics[uuid]
+        value = recording.row_at(clock.now())[sensor]
+        values = value if isinstance(value, tuple) else (value,)
+        if value is None:
+            values = (0,) * len(struct.unpack(fmt, bytes(struct.calcsize(fmt))))
+        return struct.pack(fmt, *(float(v) if "f" in fmt else int(v) for v in values))
+    return value
+
+def verify(recording, rows, end, timezone = None, tolerance = 600, timestamp_format = "%Y%m%d%H%M%S"):
+    '''
+    Check the rows written by a replay against the recording. Every row must be timestamped in replay time, between
+    the start of the recording and end, and each of its SENSOR_COLUMNS must hold the value of a row recorded within
+    tolerance seconds of its capture. No reading, empty or the placeholder 0 of BLEClient and recorded_characteristics, matches
+    an empty recorded cell, and is allowed until a column has first been read. Returns a description of every row
+    failing the check
+    rows: Rows in capture order as dicts of column name to the cell written
+    end: Epoch replay time at the end of the replay
+    '''
+    failures = []
+    read = set() # Columns that have been read by their source
+    for i, row in enumerate(rows):
+        captured = toEpoch(row["captureTimestamp"], timezone, timestamp_format)
+        timestamp = toEpoch(row["timestamp"], timezone, timestamp_format)
+        if not recording.start <= captured <= end or timestamp > end:
+            failures.append(f"row {i} captured at {row['captureTimestamp']} with readings of {row['timestamp']}, "
+                            f"outside the replay")
+            continue
+        recorded = recording.rows_between(captured - tolerance, captured + tolerance)
+        mismatched = []
+        for column in SENSOR_COLUMNS:
+            value = replayValue(row[column])
+            if any(value == recorded_row[column] or (recorded_row[column] is None and value in (None, 0))
+                   for recorded_row in recorded):
+                read.add(column)
+            elif column in read or value not in (None, 0):
+                mismatched.append(f"{column} {value}")
+        if mismatched:
+            failures.append(f"row {i} captured at {row['captureTimestamp']} has {', '.join(mismatched)}, "
+                            f"not recorded within {tolerance} s")
+    return failures
+
+def replay(csv_path = os.path.join(DIR_PATH, "data", "data.csv"),
+           out_dir = None,
+           speed = 1000,
+           cycles = 10,
+           image_size = (320, 256),
+           image_interval = None,
+           pipelined = False,
+           log_level = "ERROR"):
+    '''
+    Run server.main for the given number of capture cycles on the replayed recording of csv_path at speed times
+    real time, writing the rows and images to out_dir. The cycles are image_interval seconds of replay time apart,
+    0 to run them back to back, or as set by server.time_dependent_settings by default, and the brackets captured
+    as set by pipelined, see PiCam. The components run on the
+    replay clock in the local timezone, as server.main runs them on the system clock. Returns the rows written,
+    the seconds taken, the latencies of the batch writes and the rows failing verify
+    '''
+    install_hardware_placeholders()
+    import server
+    from dataset import DataEntry
+    from nicla_sense import BLEClient, BLEManager
+    from picam import PiCam
+    from storage import ColumnStore
+
+    out_dir = out_dir or tempfile.mkdtemp(prefix="replay_")
+    image_dir = os.path.join(out_dir, "images")
+    os.makedirs(image_dir, exist_ok=True)
+    timezone = get_localzone()
+    recording = Recording(csv_path, timezone=timezone)
+    clock = ReplayClock(recording.start, speed)
+    server.stop_event.clear()
+    server.logger.setLevel(log_level)
+
+    data_entry = DataEntry(data_file=os.path.join(out_dir, "data.csv"), log_level=log_level,
+                           column_store=ColumnStore(os.path.join(out_dir, "columns")), timezone=timezone)
+    write_latencies = deque(maxlen=10000)
+    flush = data_entry.flush
+
+    def timed_flush():
+        start = time.perf_counter()
+        flush()
+        write_latencies.append(time.perf_counter() - start)
+    data_entry.flush = timed_flush
+
+    mqtt_sub = ReplayMQTTSubscriber(recording, clock, image_dir=image_dir, stop_event=server.stop_event,
+                                    log_level=log_level, metrics_interval=0, timezone=timezone)
+    # The board serves the recorded readings, and its reads take the polling interval of replay time
+    nicla = BLEClient(log_level=log_level)
+    backend = FakeBleakBackend([nicla.device_name], latency=clock.real(BLE_POLL_PERIOD), scan_latency=0,
+                               value=recorded_characteristics(recording, clock, nicla.sensor_map, nicla.sensorMapNotif))
+    nicla_sense = BLEManager(dev_names=[nicla.device_name], polling_interval=0, log_level=log_level,
+                             stop_event=server.stop_event, scanner=backend, client_class=backend.client,
+                             timezone=timezone, clock=clock.now)
+    # The camera captures at once with the AE converged, the frames carry the recorded metadata
+    camera = FakePicamera2(frame_period=0, control_delay=0, converge_rate=1, switch_time=0, image_size=image_size,
+                           metadata=recorded_metadata(recording, clock))
+    camera = PiCam(image_dir=image_dir, log_level=log_level, camera=camera, pipelined=pipelined, timezone=timezone,
+                   clock=clock.now)
+    apds9960 = ReplayAPDS9960(recording, clock)
+
+    def settings(timezone):
+        interval, ev_bracket = server.time_dependent_settings(timezone)
+        return clock.real(interval if image_interval is None else image_interval), ev_bracket
+
+    # The buffer starts from the first replayed row instead of the placeholders of DataEntry, so that the rows
+    # written before every source has been read carry the sensor time and readings of the replay
+    first = recording.row_at(clock.now())
+    data_entry.data.update({column: first[column] for column in SENSOR_COLUMNS if column in first})
+    data_entry.data["timestamp"] = toEpoch(str(first["timestamp"]), timezone)
+
+    start = time.perf_counter()
+    server.main(data_entry=data_entry, mqtt_sub=mqtt_sub, nicla_sense=nicla_sense, camera=camera,
+                apds9960=apds9960, timezone=timezone, settings=settings, cycles=cycles, log_level=log_level,
+                metrics_file=os.path.join(out_dir, "metrics.prom"), clock=clock.now)
+    seconds = time.perf_counter() - start
+    end = clock.now()
+    with open(data_entry.data_file, "r", encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f, fieldnames=list(data_entry.data)))
+    return {"rows": len(data_entry.column_store), "seconds": seconds, "write_latencies": list(write_latencies),
+            "out_dir": out_dir, "failures": verify(recording, rows, end, timezone)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded data.csv through server.main without hardware")
+    parser.add_argument("--csv_path", default=os.path.join(DIR_PATH, "data", "data.csv"))
+    parser.add_argument("--out_dir", default=None, help="directory to write the replayed rows and images to (default: a new temporary directory)")
+    parser.add_argument("--speed", type=float, default=1000, help="replay speed as a multiple of real time")
+    parser.add_argument("--cycles", type=int, default=10, help="capture cycles to run")
+    parser.add_argument("--image_interval", type=float, default=None,
+                        help="seconds of replay time between cycles, 0 for back to back (default: as on the Pi)")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="capture the brackets pipelined instead of one frame a second with a mode switch")
+    parser.add_argument("--log_level", default="ERROR")
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    stats = replay(args.csv_path, args.out_dir, args.speed, args.cycles, image_interval=args.image_interval,
+                   pipelined=args.pipelined, log_level=args.log_level)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies = np.array(stats["write_latencies"]) * 1000
+    print(f"Replayed {stats['rows']} rows in {stats['seconds']:.2f} s ({stats['rows'] / stats['seconds']:.1f} captures/s) to {stats['out_dir']}")
+    print(f"Write latency p50 {np.percentile(latencies, 50):.2f} ms, max {latencies.max():.2f} ms, peak memory {peak / 2 ** 20:.1f} MiB")
+    print(f"{stats['rows'] - len(stats['failures'])} of {stats['rows']} rows match the recording")
+    for failure in stats["failures"][:10]:
+        print(failure)
@@ -1,9 +1,12 @@
 from datetime import datetime
 from apds9960_reader import APDS9960Reader
 from mqtt_sub import MQTTSubscriber
-from nicla_sense import BLEClient
+from nicla_sense import BLEManager
 from dataset import DataEntry
+from storage import ColumnStore
 from picam import PiCam
+from capture import CaptureCycle
+from metrics import REGISTRY
 import threading
 import signal
 from logger import Logger
@@ -17,14 +20,14 @@ stop_event = threading.Event()
 logger = Logger("Main", "DEBUG").get()
 
 def signal_handler(sig, frame):
+    # Only signal the threads to stop, the capture cycle in progress is completed and its batch
+    # of rows flushed before main exits
     print("\nCtrl-C detected! Stopping threads...")
     stop_event.set()  # Signal threads to stop
 
-def fast_sleep(seconds, resolution=2):
-    for _ in range(int(seconds / resolution)):
-        if stop_event.is_set():
-            break
-        time.sleep(resolution)
+def wait_until(deadline):
+    # Blocks on the stop event itself, so that the process is woken only by the deadline or a stop
+    return stop_event.wait(max(0, deadline - time.monotonic()))
 
 def time_dependent_settings(timezone):
     image_interval = 30 * 60 # 30 minutes
@@ -45,54 +48,89 @@ def time_dependent_settings(timezone):
 
    
 
-def main():
+def main(data_entry = None,
+         mqtt_sub = None,
+         nicla_sense = None,
+         camera = None,
+         apds9960 = None,
+         timezone = None,
+         settings = time_dependent_settings,
+         cycles = None,
+         log_level = "INFO",
+         metrics_file = join(DATA_DIR_PATH, 'metrics.prom'),
+         metrics_port = None,
+         column_store_dir = None,
+         clock = time.time):
+    '''
+        Run the data collection loop until stopped or for the given number of capture cycles. The components
+        not given are created for the hardware, see replay.py for running without it
+        settings: Function of the timezone returning the image interval in seconds and the EV bracket
+        log_level: Logging level of the capture cycle
+        metrics_file: File the metrics are written to in the Prometheus text format after every cycle, or None
+        metrics_port: Port to serve the metrics on at /metrics, or None
+        column_store_dir: Directory of a column store the rows are also written to, e.g. data/columns, or None to
+            only write data.csv. Used when data_entry is not given
+        clock: Function returning the current epoch time, passed to the components created here and the capture
+            cycle, e.g. a replay clock. The components given are expected to use the same clock and timezone
+    '''
     # timezone = ZoneInfo("Asia/Singapore")
-    timezone = get_localzone()
-    logger.info("Starting data collection server at " + str(datetime.now(timezone)))
-    data_entry = DataEntry(log_level="DEBUG", data_file=join(DATA_DIR_PATH, 'data.csv'))
-    mqtt_sub = MQTTSubscriber(log_level="INFO", stop_event=stop_event, timezone=timezone, image_dir=join(DATA_DIR_PATH, 'images'))
-    nicla_sense = BLEClient(log_level="INFO", stop_event=stop_event, timezone=timezone)
-    camera = PiCam(log_level="INFO", timezone=timezone, image_dir=join(DATA_DIR_PATH, 'images'))
-    apds9960 = APDS9960Reader()
+    timezone = timezone or get_localzone()
+    logger.info("Starting data collection server at " + str(datetime.fromtimestamp(clock(), timezone)))
+    if data_entry is None:
+        data_entry = DataEntry(log_level="DEBUG", 
+                               data_file=join(DATA_DIR_PATH, 'data.csv'), 
+                               column_store=ColumnStore(column_store_dir) if column_store_dir else None,
+                               timezone=timezone)
+    if mqtt_sub is None:
+        # The first ESP32CAM and sensor node heard from are written, list their ids in cameras and sensor_nodes for several
+        mqtt_sub = MQTTSubscriber(log_level="INFO", stop_event=stop_event, timezone=timezone, image_dir=join(DATA_DIR_PATH, 'images'),
+                                  clock=clock)
+    if nicla_sense is None:
+        # All NiclaSenseME boards are polled from one event loop, add their names to dev_names
+        nicla_sense = BLEManager(dev_names=["NiclaSenseME-B806"], log_level="INFO", stop_event=stop_event, timezone=timezone,
+                                 clock=clock)
+    if camera is None:
+        camera = PiCam(log_level="INFO", timezone=timezone, image_dir=join(DATA_DIR_PATH, 'images'), clock=clock)
+    if apds9960 is None:
+        apds9960 = APDS9960Reader()
+    # Sensor readings are read concurrently around the bracket, and the MQTT and BLE buffers again during it once they
+    # have new readings, and every frame is paired with the readings taken closest to it
+    capture_cycle = CaptureCycle(camera, [mqtt_sub.retreive, nicla_sense.retreive, apds9960.retrieve], data_entry,
+                                 reading_times=[mqtt_sub.reading_time, nicla_sense.reading_time, None],
+                                 log_level=log_level, clock=clock)
     mqtt_thread = threading.Thread(target=mqtt_sub.run, daemon=True)
     nicla_thread = threading.Thread(target=nicla_sense.run, daemon=True)
     mqtt_thread.start()
     nicla_thread.start()
 
     signal.signal(signal.SIGINT, signal_handler)
+    if metrics_port is not None:
+        REGISTRY.serve(metrics_port)
+        logger.info(f"Serving metrics at http://127.0.0.1:{metrics_port}/metrics")
 
+    cycle = 0
+    deadline = time.monotonic()
     try:
-        while not stop_event.is_set():
+        while not stop_event.is_set() and (cycles is None or cycle < cycles):
+            cycle += 1
 
-            # Time-dependent settings
-            image_interval, ev_bracket = time_dependent_settings(timezone)   
+            # Time-dependent settings, cycles start image_interval apart unless the previous one overran
+            image_interval, ev_bracket = settings(timezone)
             logger.info(f"Using settings: {image_interval} seconds, {ev_bracket} EV bracketing")
-
-            fast_sleep(image_interval)
-        
-            # Get most recent sensor data, tolerate delay up to 600 seconds
-            mqtt_sub.retreive(data_entry.data)
-            nicla_sense.retreive(data_entry.data)
-            logger.debug(str(data_entry))
-
-            # Retrieve APDS9960 data, assumed to have negligible delay
-            apds9960.retrieve(data_entry.data)
-            # Capture image
-            metadatas = camera.ev_bracketing_capture(*ev_bracket)
-            for metadata in metadatas:
-                
-                image_timestamp = datetime.strptime(metadata["captureTimestamp"], camera.timestamp_format)
-                data_timestamp = datetime.strptime(str(data_entry.data["timestamp"]), data_entry.timestamp_format)
-                if (image_timestamp - data_timestamp).seconds > 600:
-                    logger.warning("Image timestamp is more than 10 minutes ahead of sensor data timestamp!")
-
-                for key in metadata:
-                    data_entry.data[key] = metadata[key]
-                data_entry.write_to_csv()
-            
+            deadline = max(deadline + image_interval, time.monotonic())
+            if wait_until(deadline):
+                break
+
+            # Capture image with the most recent sensor data, tolerate delay up to 600 seconds
+            skews = capture_cycle.run(ev_bracket)
+            logger.debug("%s", data_entry)
+            logger.info(f"Sensor-to-image skew of {len(skews)} rows: " + \
+                        ", ".join(f"{skew * 1000:+.0f} ms" for skew in skews))
             data_entry.print_header()
+            if metrics_file is not None:
+                REGISTRY.write(metrics_file)
 
-
+        stop_event.set() # Stop the threads if the loop ended after the given number of cycles
         mqtt_thread.join()
         nicla_thread.join()
     except KeyboardInterrupt:
@@ -101,6 +139,12 @@ def main():
         nicla_thread.join()
         logger.debug("All threads terminated successfully!")
         logger.info(data_entry.print_header())
+    finally:
+        capture_cycle.close()
+        camera.close() # Waits for the images still being written
+        data_entry.close()
+        if metrics_file is not None:
+            REGISTRY.write(metrics_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+import argparse
+import csv
+import json
+import os
+import numpy as np
+
+DIR_PATH = os.path.dirname(os.path.abspath(__file__))
+INT_MISSING = np.iinfo(np.int64).min # Marks an empty cell in integer columns, float columns use NaN
+DEFAULT_TEXT = ("S64", 1)
+DECIMAL_SUFFIX = ".decimal" # File flagging the values of a float column that were written with a decimal point
+
+# Column name: (NumPy dtype, number of values per row)
+SCHEMA = {
+    "timestamp": ("S24", 1),
+    "image": ("S32", 1),
+    "aec_level": ("i8", 1),
+    "agc_gain": ("i8", 1),
+    "amb": ("i8", 1),
+    "r": ("i8", 1),
+    "g": ("i8", 1),
+    "b": ("i8", 1),
+    "temp": ("f8", 1),
+    "pressure": ("f8", 1),
+    "humidity": ("i8", 1),
+    "gas": ("i8", 1),
+    "co2": ("i8", 1),
+    "accel": ("f8", 3),
+    "gyro": ("f8", 3),
+    "quat": ("f8", 4),
+    "AeLocked": ("i8", 1),
+    "SensorTemperature": ("f8", 1),
+    "SensorBlackLevels": ("i8", 4),
+    "AnalogueGain": ("f8", 1),
+    "ColourCorrectionMatrix": ("f8", 9),
+    "FocusFoM": ("i8", 1),
+    "ColourTemperature": ("i8", 1),
+    "ColourGains": ("f8", 2),
+    "AfPauseState": ("i8", 1),
+    "SensorTimestamp": ("i8", 1),
+    "Lux": ("f8", 1),
+    "ScalerCrop": ("i8", 4),
+    "LensPosition": ("f8", 1),
+    "FrameDuration": ("i8", 1),
+    "ExposureTime": ("i8", 1),
+    "AfState": ("i8", 1),
+    "DigitalGain": ("f8", 1),
+    "captureTimestamp": ("S16", 1),
+    "image_format": ("S128", 1),
+    "ev": ("f8", 1),
+}
+
+def parseCell(value):
+    '''
+    Convert a cell of data.csv back to the value DataEntry wrote: None for an empty cell, a tuple of
+    numbers for a tuple repr, a bool for True/False and the string otherwise
+    '''
+    if value == '':
+        return None
+    if value in ('True', 'False'):
+        return value == 'True'
+    if value.startswith('(') and value.endswith(')'):
+        return tuple(float(x) for x in value[1:-1].split(','))
+    return value
+
+class ColumnStore:
+    def __init__(self, store_dir = os.path.join(DIR_PATH, 'data', 'columns')):
+        '''
+            Append-only columnar storage of the data entries. Every column is a raw binary file
+            of fixed-width rows of the dtype given by SCHEMA, with vector fields stored as
+            `width` values per row, so that any column can be memory-mapped without parsing the others.
+            Columns not in SCHEMA are stored as fixed-width strings. The dtype and width of every
+            stored column are recorded in schema.json. The column files are kept open between
+            appends and only written to disk by sync.
+            store_dir: Directory holding the column files
+        '''
+        self.store_dir = store_dir
+        self.schema_file = os.path.join(store_dir, 'schema.json')
+        os.makedirs(store_dir, exist_ok=True)
+        self.schema = {}
+        self.files = {} # Column and flag files opened for appending by path, all at self.length rows
+        self.length = None # Rows in every open column file, None until the first append
+        self.created = False # Whether files were added to store_dir since the last sync
+        if os.path.isfile(self.schema_file):
+            with open(self.schema_file, 'r') as f:
+                self.schema = {name: tuple(spec) for name, spec in json.load(f).items()}
+
+    def column_file(self, name):
+        return os.path.join(self.store_dir, f'{name}.bin')
+
+    def decimal_file(self, name):
+        return os.path.join(self.store_dir, f'{name}{DECIMAL_SUFFIX}')
+
+    def __len__(self):
+        if self.length is not None:
+            return self.length
+        # Columns can only disagree after a crash in the middle of an append, in which case
+        # only the rows present in all columns are valid
+        return min((self.column_length(name) for name in self.schema), default=0)
+
+    def column_length(self, name):
+        dtype, width = self.schema[name]
+        path = self.column_file(name)
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        return size // (np.dtype(dtype).itemsize * width)
+
+    def to_array(self, name, values):
+        '''Convert the values of a column to an array of shape (len(values), width).'''
+        dtype, width = self.schema[name]
+        dtype = np.dtype(dtype)
+        if dtype.kind == 'S':
+            return np.array([b'' if v is None else str(v).encode() for v in values], dtype=dtype).reshape(-1, 1)
+
+        missing = INT_MISSING if dtype.kind == 'i' else np.nan
+        array = np.full((len(values), width), missing, dtype=dtype)
+        for i, value in enumerate(values):
+            if value is None or value == '':
+                continue
+            try:
+                array[i] = float(value) if isinstance(value, str) else value
+            except (TypeError, ValueError):
+                pass # Leave values that do not fit the column empty rather than stop the capture
+        return array
+
+    def to_decimals(self, name, values):
+        '''
+        Flag the values of a float column written with a decimal point, as data.csv tells by a "." in the
+        cell: 35.0 was read as a float and 35 as an integer. Returns a bool array of shape (len(values), width)
+        '''
+        width = self.schema[name][1]
+        flags = np.zeros((len(values), width), dtype=bool)
+        for i, value in enumerate(values):
+            parts = value if isinstance(value, (tuple, list)) else [value]
+            flags[i, :len(parts)] = ['.' in str(part) for part in parts[:width]]
+        return flags
+
+    def append(self, rows):
+        '''Append rows, given as dicts of column name to value, to every column, without syncing them.'''
+        if not rows:
+            return
+        length = len(self)
+        names = list(dict.fromkeys(key for row in rows for key in row))
+        new_names = [name for name in names if name not in self.schema]
+        for name in new_names:
+            self.schema[name] = SCHEMA.get(name, DEFAULT_TEXT)
+        if new_names:
+            tmp_file = self.schema_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.schema, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.schema_file)
+            self.created = True
+
+        for name, (dtype, width) in self.schema.items():
+            values = [row.get(name) for row in rows]
+            self.write(self.column_file(name), self.to_array(name, values), length,
+                       lambda count: self.to_array(name, [None] * count))
+            if np.dtype(dtype).kind == 'f':
+                # Rows of stores written before the flags count as written with a decimal point
+                self.write(self.decimal_file(name), self.to_decimals(name, values), length,
+                           lambda count: np.ones((count, width), dtype=bool))
+        self.length = length + len(rows)
+
+    def write(self, path, array, length, padding):
+        '''
+        Append the rows of array to the file at path, opening it on the first append
+        length: Rows the file holds before the append, as the other files of the store
+        padding: Function returning the given number of rows for a file that is new or behind the others
+        '''
+        f = self.files.get(path)
+        if f is None:
+            # Drop the rows left over by an interrupted append and pad files that are new or
+            # behind the others with empty rows, so that all columns stay aligned
+            self.created |= not os.path.isfile(path)
+            row_size = padding(1).nbytes
+            stored = min(os.path.getsize(path) // row_size if os.path.isfile(path) else 0, length)
+            f = self.files[path] = open(path, 'ab')
+            f.truncate(stored * row_size)
+            if stored < length:
+                f.write(padding(length - stored).tobytes())
+        f.write(array.tobytes())
+
+    def sync(self):
+        '''Write the appended rows of all columns to disk, returning once every column file holds them.'''
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        if self.created:
+            # The entries of new column files are only durable once the directory is synced
+            fd = os.open(self.store_dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.created = False
+
+    def truncate(self, length):
+        '''Cut every column back to length rows, e.g. to drop the rows of an append that failed to sync.'''
+        self.close()
+        for name, (dtype, width) in self.schema.items():
+            if os.path.isfile(self.column_file(name)) and self.column_length(name) > length:
+                os.truncate(self.column_file(name), length * np.dtype(dtype).itemsize * width)
+            if os.path.isfile(self.decimal_file(name)) and os.path.getsize(self.decimal_file(name)) > length * width:
+                os.truncate(self.decimal_file(name), length * width)
+
+    def close(self):
+        '''Close the column files, dropping the rows not synced yet if closing fails.'''
+        files, self.files, self.length = self.files, {}, None
+        for f in files.values():
+            try:
+                f.close()
+            except OSError:
+                pass
+
+    def read(self, name, length = None):
+        '''
+            Memory-map a column as an array of shape (rows,), or (rows, width) for vector fields.
+            length: Number of rows to map, len(self) by default, for reading several columns at one length
+        '''
+        dtype, width = self.schema[name]
+        length = len(self) if length is None else length
+        if length == 0:
+            return np.empty((0,) if width == 1 else (0, width), dtype=dtype)
+        shape = (length,) if width == 1 else (length, width)
+        return np.memmap(self.column_file(name), dtype=dtype, mode='r', shape=shape)
+
+    def read_decimals(self, name, length = None):
+        '''
+            Memory-map the flags of a float column telling which values were written with a decimal point, of
+            the same shape as read(name). Returns None if the store has no flags for all rows of the column
+        '''
+        width = self.schema[name][1]
+        length = len(self) if length is None else length
+        path = self.decimal_file(name)
+        if not os.path.isfile(path) or os.path.getsize(path) < length * width:
+            return None
+        if length == 0:
+            return np.empty((0,) if width == 1 else (0, width), dtype=bool)
+        return np.memmap(path, dtype=bool, mode='r', shape=(length,) if width == 1 else (length, width))
+
+    def read_float(self, name):
+        '''Read a numeric column as float64 with NaN for empty cells.'''
+        return toFloat(self.read(name))
+
+def toFloat(column):
+    '''
+    Convert (a slice of) a numeric column to float64 with NaN for empty cells
+    '''
+    if column.dtype.kind == 'i':
+        return np.where(column == INT_MISSING, np.nan, column)
+    return np.array(column, dtype=np.float64)
+
+def convertCSV(csv_path, store_dir, chunk_size=4096):
+    '''
+    Convert an existing data.csv to a column store, returning the number of rows converted
+    '''
+    store = ColumnStore(store_dir)
+    count = 0
+    with open(csv_path, 'r', encoding='utf-8', newline='') as csv_file:
+        batch = []
+        for row in csv.DictReader(csv_file):
+            batch.append({key: parseCell(value) for key, value in row.items()})
+            if len(batch) == chunk_size:
+                store.append(batch)
+                count += len(batch)
+                batch = []
+        store.append(batch)
+        count += len(batch)
+    store.sync()
+    store.close()
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert data.csv to a column store')
+    parser.add_argument('--csv_path', default=os.path.join(DIR_PATH, 'data', 'data.csv'))
+    parser.add_argument('--store_dir', default=os.path.join(DIR_PATH, 'data', 'columns'))
+    args = parser.parse_args()
+    print(f'Converted {convertCSV(args.csv_path, args.store_dir)} rows to {args.store_dir}')
@@ -1,9 +1,9 @@
-import glob
 import os
 import time
 import requests
 import json
 from data_utils import getLastRowReadable
+from image_index import ImageIndex
 
 DIR_PATH = os.path.dirname(os.path.abspath(__file__))
 
@@ -18,6 +18,7 @@ class TeleBot:
         self.offset = 0
         self.data_dir = data_dir
         self.image_dir = os.path.join(data_dir, "images")
+        self.image_index = ImageIndex(self.image_dir)
 
     def getAPIToken(self):
         with open(self.token_file, "r") as f:
@@ -106,19 +107,24 @@ class TeleBot:
         return response.json().get  
     
     def getLatestPhoto(self):
-        latest_photo = sorted(glob.glob(os.path.join(self.image_dir, "*.jpg")))
-        return latest_photo[-1]
+        # None until the first image has been captured
+        latest = self.image_index.latest()
+        return os.path.join(self.image_dir, latest) if latest is not None else None
     
     def getLatestData(self):
         return getLastRowReadable(os.path.join(self.data_dir, "data.csv"))
 
     def getCount(self):
-        return len(glob.glob(os.path.join(self.image_dir, "*.jpg")))
+        return self.image_index.count()
+
+    def reindex(self):
+        return self.image_index.reconcile()
 
 
 bot = TeleBot()
 bot.getAPIToken()
 print(bot.getMe())
+print(f"Indexed {bot.reindex()} photos")
 while True:
     
     # Input from user
@@ -130,9 +136,13 @@ while True:
         continue
     elif text == "/photo":
         photo = bot.getLatestPhoto()
-        print(f"Sending photo: {photo} to {chat_id}")
-        res = bot.sendLatestPhoto(chat_id, photo) and \
-                bot.sendMessage(chat_id, f"Latest Photo: {photo.split('/')[-1]}")
+        if photo is None:
+            print(f"No photo to send to {chat_id}")
+            res = bot.sendMessage(chat_id, "No photo yet")
+        else:
+            print(f"Sending photo: {photo} to {chat_id}")
+            res = bot.sendLatestPhoto(chat_id, photo) and \
+                    bot.sendMessage(chat_id, f"Latest Photo: {photo.split('/')[-1]}")
     elif text == "/data":
         data = bot.getLatestData()
         print(f"Sending data to {chat_id}")
@@ -141,6 +151,10 @@ while True:
         count = bot.getCount()
         print(f"Sending count to {chat_id}")
         res = bot.sendMessage(chat_id, f"Number of photos: {count}")
+    elif text == "/reindex":
+        count = bot.reindex()
+        print(f"Rebuilt image index for {chat_id}")
+        res = bot.sendMessage(chat_id, f"Indexed {count} photos")
     else:
         print(f"Received: {text} on {chat_id}")
         res = bot.sendMessage(chat_id, f"Received: {text} on at {time.ctime()}")